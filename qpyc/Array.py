@@ -0,0 +1,649 @@
+import numpy as np
+import json
+
+from qpyc.Device import Component, Waveguide, PhaseShifter, BeamSpiliter, MZI, Circuit
+from qpyc.Device import ps_matrices, bs_matrices, mzi_matrices
+from qpyc.Mesh import ClementsMZI, ClementsMesh, clements_matrices
+from qpyc.Visualize import plot_address, plot_phase
+from qpyc.Engine import apply_right, apply_right_many, apply_left, apply_left_many, chunked
+
+# device classes, the type code of a device is its index
+KINDS = [Component, Waveguide, PhaseShifter, BeamSpiliter, MZI, ClementsMZI]
+
+# closed-form batch matrices from the (theta, phi, bias) columns,
+# kinds not listed here are evaluated device by device
+BATCH = {
+    PhaseShifter: lambda theta, phi, bias: ps_matrices(theta),
+    BeamSpiliter: lambda theta, phi, bias: bs_matrices(bias[..., 0]),
+    MZI: mzi_matrices,
+    ClementsMZI: clements_matrices,
+}
+
+# circuit classes restored by to_circuit
+CIRCUITS = {cls.__name__: cls for cls in [Circuit, ClementsMesh]}
+
+# attributes set by Circuit.__init__, the others are saved along the devices
+_CIRCUIT_ATTRS = set(vars(Circuit()))
+
+# binary file layout: MAGIC, header length (uint64), JSON header, columns aligned to ALIGN bytes
+MAGIC = b'QPYCARR1'
+ALIGN = 64
+
+def _row(d):
+    """Type code, theta, phi and bias of device d"""
+    if type(d) not in KINDS:
+        raise TypeError(f'{type(d).__name__} can not be stored in ArrayCircuit.')
+    theta, phi, bias = 0., 0., (0., 0.)
+    if isinstance(d, MZI):
+        theta, phi, bias = d.theta, d.phi, d.bias
+    elif isinstance(d, PhaseShifter):
+        theta = d.phase
+    elif isinstance(d, BeamSpiliter):
+        bias = (d.bias, 0.)
+    return KINDS.index(type(d)), theta, phi, bias
+
+
+class ComponentView:
+    """Light-weight view of a device stored in ArrayCircuit
+
+    It reads and writes the arrays of the circuit, following the Component API.
+    Views are invalidated by ArrayCircuit.remove.
+    """
+    __slots__ = ('_circ', '_i')
+
+    def __init__(self, circ, i) -> None:
+        self._circ = circ
+        self._i = i
+
+    def __repr__(self) -> str:
+        return repr(self.to_device())
+
+    @property
+    def kind(self):
+        """Device class"""
+        return KINDS[self._circ._kind[self._i]]
+
+    @property
+    def addr(self):
+        return (int(self._circ._x[self._i]), int(self._circ._y[self._i]))
+
+    @addr.setter
+    def addr(self, addr):
+        self._circ._x[self._i], self._circ._y[self._i] = addr
+        self._circ._changed()
+
+    @property
+    def x(self):
+        return int(self._circ._x[self._i])
+
+    @x.setter
+    def x(self, xx):
+        self.addr = [xx, self.y]
+
+    @property
+    def y(self):
+        return int(self._circ._y[self._i])
+
+    @y.setter
+    def y(self, yy):
+        self.addr = [self.x, yy]
+
+    @property
+    def dom(self):
+        return int(self._circ._dom[self._i])
+
+    @property
+    def ports(self):
+        return list(range(self.y, self.y + self.dom))
+
+    @property
+    def matrix(self):
+        return self._circ._block(self._i)
+
+    def to_device(self):
+        """A Component object with the same parameters"""
+        return self._circ.device(self._i)
+
+
+class PhaseShifterView(ComponentView):
+    __slots__ = ()
+
+    @property
+    def phase(self):
+        return float(self._circ._theta[self._i])
+
+    @phase.setter
+    def phase(self, phase):
+        self._circ._theta[self._i] = phase
+
+
+class BeamSpiliterView(ComponentView):
+    __slots__ = ()
+
+    @property
+    def bias(self):
+        return float(self._circ._bias[self._i, 0])
+
+    @bias.setter
+    def bias(self, bias):
+        self._circ._bias[self._i, 0] = bias
+
+
+class MZIView(ComponentView):
+    __slots__ = ()
+
+    @property
+    def theta(self):
+        return float(self._circ._theta[self._i])
+
+    @theta.setter
+    def theta(self, theta):
+        self._circ._theta[self._i] = theta
+
+    @property
+    def phi(self):
+        return float(self._circ._phi[self._i])
+
+    @phi.setter
+    def phi(self, phi):
+        self._circ._phi[self._i] = phi
+
+    @property
+    def bias(self):
+        return tuple(self._circ._bias[self._i].tolist())
+
+    @bias.setter
+    def bias(self, bias):
+        self._circ._bias[self._i] = bias
+
+    @property
+    def phase(self):
+        return [self.theta, self.phi]
+
+VIEWS = {
+    Component: ComponentView,
+    Waveguide: ComponentView,
+    PhaseShifter: PhaseShifterView,
+    BeamSpiliter: BeamSpiliterView,
+    MZI: MZIView,
+    ClementsMZI: MZIView,
+}
+
+
+class ArrayCircuit:
+    """Circuit stored as a struct of arrays
+
+    Every device is a row of contiguous arrays, x, y, dom, kind (type code, see KINDS),
+    theta, phi and bias (n, 2). theta holds the phase of PhaseShifter and bias[:, 0] the
+    bias of BeamSpiliter. Devices are accessed through light-weight views following
+    the Component/MZI API, the matrix is evaluated from the arrays column by column.
+    Matrices of generic Components are kept aside.
+
+    >>> C = Circuit()
+    >>> C.add(MZI(theta=.5, addr=[0, 0]), PhaseShifter(phase=1, addr=[1, 1]))
+    >>> A = ArrayCircuit.from_circuit(C)
+    >>> A[(0, 0)].theta
+    0.5
+    >>> assert np.allclose(A.matrix, C.matrix)
+    """
+    def __init__(self, capacity=16) -> None:
+        self._n = 0
+        self._x = np.zeros(capacity, dtype=np.int64)
+        self._y = np.zeros(capacity, dtype=np.int64)
+        self._dom = np.zeros(capacity, dtype=np.int64)
+        self._kind = np.zeros(capacity, dtype=np.uint8)
+        self._theta = np.zeros(capacity)
+        self._phi = np.zeros(capacity)
+        self._bias = np.zeros((capacity, 2))
+        self._extra = {}    # index -> matrix of generic Components
+        self._meta = {'class': 'Circuit', 'attrs': {}}  # restored by to_circuit
+        self._changed()
+
+    _columns = ('_x', '_y', '_dom', '_kind', '_theta', '_phi', '_bias')
+
+    def _changed(self):
+        """Addresses changed, drop the index"""
+        self._index = None
+        self._checked = False
+
+    def __len__(self):
+        return self._n
+
+    # arrays of the stored devices, writing into them changes the devices
+    x = property(lambda self: self._x[:self._n])
+    y = property(lambda self: self._y[:self._n])
+    dom = property(lambda self: self._dom[:self._n])
+    kind = property(lambda self: self._kind[:self._n])
+    theta = property(lambda self: self._theta[:self._n])
+    phi = property(lambda self: self._phi[:self._n])
+    bias = property(lambda self: self._bias[:self._n])
+
+    @classmethod
+    def from_circuit(cls, circ):
+        """Store the devices of a Circuit"""
+        A = cls(max(len(circ._devices), 1))
+        for d in circ._devices:
+            A.add(d)
+        if type(circ).__name__ in CIRCUITS:
+            A._meta['class'] = type(circ).__name__
+        A._meta['attrs'] = {k: v for k, v in vars(circ).items() if k not in _CIRCUIT_ATTRS}
+        return A
+
+    def to_circuit(self):
+        """A Circuit with Component objects of the stored devices,
+        of the class it was stored from (Circuit or ClementsMesh)"""
+        cls = CIRCUITS[self._meta['class']]
+        C = cls.__new__(cls)
+        Circuit.__init__(C)
+        for i in range(self._n):
+            C.add(self.device(i))
+        for k, v in self._meta['attrs'].items():
+            setattr(C, k, v.copy() if isinstance(v, np.ndarray) else v)
+        return C
+
+    def save(self, path):
+        """
+        Save the devices in a binary columnar file.
+
+        The file starts with MAGIC, the length of a JSON header and the header, which holds
+        the circuit class, its attributes and the dtype, shape and offset of every column.
+        The columns x, y, dom, kind, theta, phi and bias follow as raw arrays, with the
+        matrices of generic Components flattened into extra_index/extra_offset/extra_data.
+        Array attributes are stored as columns too.
+
+        Parameters
+        ----------
+        path : str
+            file path
+        """
+        columns = {name[1:]: getattr(self, name)[:self._n] for name in self._columns}
+        idx = np.array(sorted(self._extra), dtype=np.int64)
+        mats = [self._extra[i].ravel() for i in idx]
+        columns['extra_index'] = idx
+        columns['extra_offset'] = np.cumsum([0] + [len(m) for m in mats], dtype=np.int64)
+        columns['extra_data'] = np.concatenate(mats) if mats else np.zeros(0, dtype=np.complex_)
+        attrs = {}
+        for k, v in self._meta['attrs'].items():
+            if isinstance(v, np.ndarray):
+                columns['attr.' + k] = v
+            elif v is None or isinstance(v, (bool, int, float, str)):
+                attrs[k] = v
+            else:
+                raise TypeError(f'Attribute {k} of type {type(v).__name__} can not be saved.')
+        header = {'version': 1, 'class': self._meta['class'], 'attrs': attrs, 'n': self._n, 'columns': {}}
+        # the offsets depend on the header length, grow it until it is stable
+        start = 0
+        while True:
+            offset, layout = start, {}
+            for name, arr in columns.items():
+                layout[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+                offset += -(-arr.nbytes // ALIGN) * ALIGN
+            header['columns'] = layout
+            raw = json.dumps(header).encode()
+            begin = -(-(len(MAGIC) + 8 + len(raw)) // ALIGN) * ALIGN
+            if begin == start:
+                break
+            start = begin
+        with open(path, 'wb') as f:
+            f.write(MAGIC + np.uint64(len(raw)).tobytes() + raw)
+            for name, arr in columns.items():
+                f.seek(layout[name]['offset'])
+                f.write(np.ascontiguousarray(arr).tobytes())
+            f.truncate(max(offset, start))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a file written by save.
+
+        With mmap, the columns are memory mapped copy-on-write, so that only the header is
+        read at once, the pages are read on access and changes stay in memory.
+
+        Parameters
+        ----------
+        path : str
+            file path
+        mmap : bool, optional
+            memory map the columns, by default True
+
+        Returns
+        -------
+        ArrayCircuit
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a qpyc circuit file.')
+            length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(length))
+            columns = {}
+            for name, col in header['columns'].items():
+                dtype, shape = np.dtype(col['dtype']), tuple(col['shape'])
+                if 0 in shape:
+                    columns[name] = np.zeros(shape, dtype=dtype)
+                elif mmap:
+                    columns[name] = np.memmap(path, dtype=dtype, mode='c', offset=col['offset'], shape=shape)
+                else:
+                    f.seek(col['offset'])
+                    columns[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        A = cls.__new__(cls)
+        A._n = header['n']
+        for name in cls._columns:
+            arr = columns[name[1:]]
+            setattr(A, name, arr if len(arr) != 0 else np.zeros((1,) + arr.shape[1:], dtype=arr.dtype))
+        data, offset, dom = columns['extra_data'], columns['extra_offset'], A._dom
+        A._extra = {int(i): np.array(data[offset[k]:offset[k+1]]).reshape(dom[i], dom[i])
+                    for k, i in enumerate(columns['extra_index'])}
+        attrs = dict(header['attrs'])
+        attrs.update({name[5:]: np.array(arr) for name, arr in columns.items() if name.startswith('attr.')})
+        A._meta = {'class': header['class'], 'attrs': attrs}
+        A._changed()
+        return A
+
+    def device(self, i):
+        """Component object of the i-th device"""
+        cls = KINDS[self._kind[i]]
+        addr = [int(self._x[i]), int(self._y[i])]
+        theta, phi = float(self._theta[i]), float(self._phi[i])
+        if issubclass(cls, MZI):
+            return cls(theta=theta, phi=phi, bias=self._bias[i].tolist(), addr=addr)
+        elif cls is PhaseShifter:
+            return PhaseShifter(phase=theta, addr=addr)
+        elif cls is BeamSpiliter:
+            return BeamSpiliter(bias=float(self._bias[i, 0]), addr=addr)
+        elif cls is Waveguide:
+            return Waveguide(dom=int(self._dom[i]), addr=addr)
+        d = Component(addr=addr, dom=int(self._dom[i]))
+        d.matrix = self._extra[i]
+        return d
+
+    def view(self, i):
+        """View of the i-th device"""
+        return VIEWS[KINDS[self._kind[i]]](self, i)
+
+    def _grow(self):
+        for name in self._columns:
+            arr = getattr(self, name)
+            new = np.zeros((2*len(arr),) + arr.shape[1:], dtype=arr.dtype)
+            new[:len(arr)] = arr
+            setattr(self, name, new)
+
+    def __add_single(self, d):
+        if isinstance(d, Component) is False:
+            raise TypeError('Only Component can be added into Circuit.')
+        if self._n == len(self._x):
+            self._grow()
+        i = self._n
+        addr = d._addr if d._addr is not None else [self.depth + 1, 1]
+        self._kind[i], self._theta[i], self._phi[i], self._bias[i] = _row(d)
+        self._x[i], self._y[i] = addr
+        self._dom[i] = d.dom
+        if type(d) is Component:
+            self._extra[i] = np.reshape(d.matrix, (d.dom, d.dom)).copy()
+        self._n += 1
+        self._changed()
+
+    def add(self, d, *dd):
+        """
+        Add devices into the circiut, their parameters are copied into the arrays.
+        """
+        self.__add_single(d)
+        for d in dd:
+            self.__add_single(d)
+
+    def remove(self, device):
+        """
+        Remove single device by view or by its address.
+        """
+        i = device._i if isinstance(device, ComponentView) else self._lookup(device)
+        for name in self._columns:
+            arr = getattr(self, name)
+            arr[i:self._n-1] = arr[i+1:self._n]
+        self._extra = {j - (j > i): m for j, m in self._extra.items() if j != i}
+        self._n -= 1
+        self._changed()
+
+    def _validate(self):
+        """Raise if devices overlap on their ports"""
+        if self._checked:
+            return
+        order = np.lexsort((self.y, self.x))
+        x, y, dom = self.x[order], self.y[order], self.dom[order]
+        clash = (x[1:] == x[:-1]) & (y[1:] < y[:-1] + dom[:-1])
+        if np.any(clash):
+            i = order[np.argmax(clash) + 1]
+            raise Warning(f'Overlap Component at {[int(self._x[i]), int(self._y[i])]}')
+        self._checked = True
+
+    def _lookup(self, item):
+        if self._index is None:
+            self._validate()
+            self._index = {(int(x), int(y)): i for i, (x, y) in enumerate(zip(self.x, self.y))}
+        try:
+            return self._index[tuple(item)]
+        except (KeyError, TypeError):
+            raise ValueError('Required address has no Component.')
+
+    def __getitem__(self, item):
+        return self.view(self._lookup(item))
+
+    def __iter__(self):
+        return (self.view(i) for i in range(self._n))
+
+    @property
+    def _devices(self):
+        """Views of all devices in storage order"""
+        return list(self)
+
+    @property
+    def devices(self):
+        """A dictionary of device views sorted by address"""
+        order = np.lexsort((self.y, self.x))
+        return {(int(self._x[i]), int(self._y[i])): self.view(i) for i in order}
+
+    @property
+    def addrs(self):
+        return list(self.devices.keys())
+
+    @property
+    def width(self):
+        """
+        Circuit width, maximal y coordinate
+        """
+        return int(np.max(self.y + self.dom)) if self._n != 0 else 0
+
+    @property
+    def depth(self):
+        """
+        Circuit depth, maximal x coordinate
+        """
+        return int(np.max(self.x)) if self._n != 0 else 0
+
+    def _block(self, i):
+        """dom x dom matrix of the i-th device"""
+        cls = KINDS[self._kind[i]]
+        if cls in BATCH:
+            return BATCH[cls](self._theta[i], self._phi[i], self._bias[i])
+        elif cls is Component:
+            return self._extra[i]
+        return np.reshape(self.device(i).matrix, (self._dom[i], self._dom[i]))
+
+    def blocks(self, theta=None, phi=None, bias=None):
+        """Batch matrices of every kind with a closed form
+
+        Parameters
+        ----------
+        theta, phi : np.array, optional
+            shape (n,) or (M, n), by default the stored values
+        bias : np.array, optional
+            shape (n, 2) or (M, n, 2), by default the stored values
+
+        Returns
+        -------
+        dict
+            type code -> (indices, matrices of shape (..., len(indices), dom, dom))
+        """
+        theta, phi, bias = self._params(theta, phi, bias)
+        out = {}
+        for cls, func in BATCH.items():
+            code = KINDS.index(cls)
+            idx = np.flatnonzero(self.kind == code)
+            if len(idx) != 0:
+                out[code] = (idx, func(theta[..., idx], phi[..., idx], bias[..., idx, :]))
+        return out
+
+    def _params(self, theta, phi, bias):
+        """Stored parameters where not given"""
+        theta = self.theta if theta is None else np.asarray(theta, dtype=float)
+        phi = self.phi if phi is None else np.asarray(phi, dtype=float)
+        bias = self.bias if bias is None else np.asarray(bias, dtype=float)
+        for name, arr, tail in (('theta', theta, ()), ('phi', phi, ()), ('bias', bias, (2,))):
+            if arr.shape[arr.ndim-len(tail)-1:] != (self._n,) + tail:
+                raise ValueError(f'{name} should have shape (..., {self._n}{", 2" if tail else ""}), got {arr.shape}.')
+        return theta, phi, bias
+
+    def _groups(self, blocks=None):
+        """Devices grouped by column and kind, sorted by x, with the batch matrices
+
+        Yields
+        ------
+        tuple
+            (indices, matrices of shape (..., len(indices), dom, dom)),
+            matrices is None for kinds without a closed form
+        """
+        blocks = self.blocks() if blocks is None else blocks
+        where = np.zeros(self._n, dtype=np.int64)
+        for idx, _ in blocks.values():
+            where[idx] = np.arange(len(idx))
+        order = np.lexsort((self.kind, self.x))
+        key = self.x[order] * len(KINDS) + self.kind[order]
+        for group in np.split(order, np.flatnonzero(np.diff(key)) + 1):
+            if len(group) == 0:
+                continue
+            code = int(self._kind[group[0]])
+            if KINDS[code] is Waveguide:
+                continue
+            yield group, blocks[code][1][..., where[group], :, :] if code in blocks else None
+
+    @property
+    def matrix(self):
+        """
+        Calculate the circuit matrix from the arrays.
+        The matrices of each kind are computed in one batch, then the devices of a
+        column sharing a kind are applied together (see Engine.apply_right_many).
+        """
+        self._validate()
+        mat = np.eye(self.width, dtype=np.complex_)
+        for group, mats in self._groups():
+            if mats is not None:
+                mat = apply_right_many(mat, self._y[group], mats)
+            else:
+                for i in group:
+                    mat = apply_right(mat, self._y[i], self._block(i))
+        return mat
+
+    def propagate(self, fields):
+        """
+        Apply the circuit to input amplitudes of shape (width,) or (width, B),
+        streaming the columns from the arrays, equal to self.matrix @ fields.
+        """
+        self._validate()
+        out = np.array(fields, dtype=np.complex_)
+        if out.ndim not in (1, 2) or out.shape[0] != self.width:
+            raise ValueError(f'Fields should have shape ({self.width},) or ({self.width}, B), got {out.shape}.')
+        for group, mats in reversed(list(self._groups())):
+            if mats is not None:
+                out = apply_left_many(out, self._y[group], mats)
+            else:
+                for i in group:
+                    out = apply_left(out, self._y[i], self._block(i))
+        return out
+
+    def _sample_block(self, i, theta, phi, bias):
+        """dom x dom matrix of the i-th device with the given parameters"""
+        cls = KINDS[self._kind[i]]
+        if issubclass(cls, MZI):
+            d = cls(theta=float(theta), phi=float(phi), bias=list(bias))
+        elif cls is PhaseShifter:
+            d = PhaseShifter(phase=float(theta))
+        elif cls is BeamSpiliter:
+            d = BeamSpiliter(bias=float(bias[0]))
+        else:
+            return self._block(i)
+        return np.reshape(d.matrix, (self._dom[i], self._dom[i]))
+
+    def _matrix_batch(self, theta, phi, bias):
+        """Stack of matrices for parameters of shape (M, n), (M, n), (M, n, 2)"""
+        mat = np.broadcast_to(np.eye(self.width, dtype=np.complex_), (len(theta), self.width, self.width)).copy()
+        for group, mats in self._groups(self.blocks(theta, phi, bias)):
+            if mats is not None:
+                mat = apply_right_many(mat, self._y[group], mats)
+                continue
+            for i in group:
+                sub = np.array([self._sample_block(i, *p) for p in zip(theta[:, i], phi[:, i], bias[:, i])])
+                mat = apply_right(mat, self._y[i], sub)
+        return mat
+
+    def matrix_batch(self, theta=None, phi=None, bias=None, chunk=None, processes=None, out=None):
+        """
+        Circuit matrices for M sets of parameters, e.g. random bias draws for a yield estimate.
+
+        The batch matrices of each kind and the column updates are vectorized over the samples,
+        kinds without a closed form are evaluated sample by sample. Samples can be chunked to
+        bound the memory of intermediates, and spread over a process pool (see Engine.chunked).
+
+        Parameters
+        ----------
+        theta, phi : array_like, optional
+            shape (M, n) with n the number of devices, by default the stored values.
+            theta holds the phase of PhaseShifter
+        bias : array_like, optional
+            shape (M, n, 2), by default the stored values.
+            bias[..., 0] holds the bias of BeamSpiliter
+        chunk : int, optional
+            samples evaluated at once
+        processes : int, optional
+            size of the process pool, by default evaluate in this process
+        out : np.array, optional
+            output of shape (M, width, width), e.g. a np.memmap
+
+        Returns
+        -------
+        np.array
+            shape (M, width, width)
+
+        >>> C = Circuit()
+        >>> C.add(MZI(theta=.5, addr=[0, 0]), PhaseShifter(phase=1, addr=[1, 1]))
+        >>> A = ArrayCircuit.from_circuit(C)
+        >>> bias = np.random.default_rng(0).normal(0, .01, (100, 2, 2))
+        >>> A.matrix_batch(bias=bias).shape
+        (100, 2, 2)
+        """
+        self._validate()
+        given = [a for a in (theta, phi, bias) if a is not None]
+        if len(given) == 0:
+            raise ValueError('At least one of theta, phi and bias should be given.')
+        M = len(given[0])
+        theta, phi, bias = self._params(theta, phi, bias)
+        theta = np.broadcast_to(theta, (M, self._n))
+        phi = np.broadcast_to(phi, (M, self._n))
+        bias = np.broadcast_to(bias, (M, self._n, 2))
+        return chunked(self._matrix_batch, (theta, phi, bias), M, (self.width, self.width),
+                       chunk=chunk, processes=processes, out=out)
+
+    def copy(self):
+        A = ArrayCircuit(max(self._n, 1))
+        for name in self._columns:
+            getattr(A, name)[:self._n] = getattr(self, name)[:self._n]
+        A._n = self._n
+        A._extra = {i: m.copy() for i, m in self._extra.items()}
+        A._meta = {'class': self._meta['class'], 'attrs': dict(self._meta['attrs'])}
+        return A
+
+    def plot(self, label='address'):
+        import matplotlib.pyplot as plt
+        _, ax = plt.subplots()
+        if label == 'address':
+            ax = plot_address(self, ax)
+        elif label == 'phase':
+            ax = plot_phase(self, ax)
+        plt.show()
@@ -1,10 +1,8 @@
 from qpyc.Device import Component
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 import datetime, time
-from qpyc.Mesh import ClementsMesh
+from qpyc.Mesh import ClementsMesh, route_table
 
 # calibration data structure
 cdt = np.dtype([
@@ -13,6 +11,113 @@ cdt = np.dtype([
     ('time', np.datetime64('today', 's')) # calibration operated time
 ])
 
+# calibration plan data structure, one row per MZI in calibration order
+pdt = np.dtype([
+    ('addr', np.int32, (2,)),       # address of the MZI
+    ('clements_idx', np.int32),     # index in the diagonal order
+    ('port_in', np.uint16),         # laser input port
+    ('port_out', np.uint16),        # power meter port
+    ('diagonal', np.uint8, (2,)),   # diagonals of Route used for the input and the output
+    ('changes', np.int32),          # MZIs set to the routing (cross) state before the sweep
+    ('start', np.float64),          # estimated start time of the step, in s
+])
+
+def _route_mzis(N, path):
+    """Order indices of the MZIs on a route path, leaving out the bottom waveguide"""
+    path = path[path[:, 1] <= N - 2]
+    return (path[:, 0]*(N-1) + path[:, 1])//2
+
+def plan_calibration(mesh, order=None, laser_time=1., meter_time=1., pin_time=1e-3, settle_time=.1, sweep_time=.3):
+    """Calibration schedule of the MZIs of a Clements mesh and its estimated total time
+
+    Each MZI is swept with light injected at the input port of one of its two diagonals and
+    read at the output port of one of them (see ClementsMesh.Route), the MZIs along both paths
+    being set to the cross state. An MZI can only be swept once the MZIs of its input path are
+    calibrated; the diagonal order of clements_idx always allows it.
+
+    A step costs laser_time if the input port changes, meter_time if the output port changes,
+    pin_time per MZI to set to cross plus one settle_time if any, and sweep_time. A swept MZI
+    leaves the cross state. By default the next step is chosen greedily among the MZIs that can
+    be swept, the cheapest first, which batches MZIs sharing ports and routes; ties follow
+    clements_idx.
+
+    Parameters
+    ----------
+    mesh : ClementsMesh
+        mesh with the clements layout
+    order : list, optional
+        addresses to evaluate in this order instead, e.g. mesh.addrs, with the cheapest diagonals
+    laser_time, meter_time : float, optional
+        time to switch the laser input and the power meter port, in s
+    pin_time, settle_time : float, optional
+        time to set a pin and to wait for the phase shifters to settle, in s
+    sweep_time : float, optional
+        time of the sweep of one MZI, in s, e.g. num x rising_time of SweepFitPhase
+
+    Returns
+    -------
+    tuple
+        (plan, total), plan a structured array of dtype pdt, total the estimated time in s
+
+    >>> mesh = ClementsMesh(6)
+    >>> plan, total = plan_calibration(mesh)
+    >>> assert total < plan_calibration(mesh, order=mesh.addrs)[1]
+    """
+    if getattr(mesh, 'layout', 'clements') != 'clements':
+        raise ValueError(f'Calibration plans need the clements layout, got {mesh.layout}.')
+    N = mesh.N
+    table = route_table(N)
+    K = len(table['route'])
+    ins = [[_route_mzis(N, r[0]), _route_mzis(N, r[1])] for r in table['route']]
+    outs = [[_route_mzis(N, r[2]), _route_mzis(N, r[3])] for r in table['route']]
+    addrs = [tuple(a) for a in mesh.placement.tolist()]
+    cidx = np.array([mesh.clements_idx(a) for a in addrs])
+    # uncalibrated MZIs on the input path of every (MZI, diagonal), and the paths through each MZI
+    waiting = np.array([[len(p) for p in k] for k in ins])
+    users = [[] for _ in range(K)]
+    for k in range(K):
+        for i in range(2):
+            for m in ins[k][i].tolist():
+                users[m].append((k, i))
+    if order is not None:
+        sequence = [mesh.order(a) for a in order]
+        if sorted(sequence) != list(range(K)):
+            raise ValueError('order should hold every MZI address once.')
+    cross = np.zeros(K, dtype=bool)
+    done = np.zeros(K, dtype=bool)
+    port_in, port_out = -1, -1
+    plan = np.zeros(K, dtype=pdt)
+    clock = 0.
+    for step in range(K):
+        candidates = [sequence[step]] if order is not None else np.flatnonzero(~done & (waiting.min(axis=1) == 0)).tolist()
+        best = None
+        for k in candidates:
+            for i in range(2):
+                if waiting[k, i] != 0:
+                    continue
+                set_in = np.count_nonzero(~cross[ins[k][i]])
+                pin = int(table['port_in'][k, i])
+                for j in range(2):
+                    pout = int(table['port_out'][k, j])
+                    changes = set_in + np.count_nonzero(~cross[outs[k][j]])
+                    cost = laser_time*(pin != port_in) + meter_time*(pout != port_out) \
+                        + pin_time*changes + settle_time*(changes != 0) + sweep_time
+                    key = (cost, cidx[k], i, j)
+                    if best is None or key < best[0]:
+                        best = (key, k, i, j, pin, pout, changes)
+        if best is None:
+            raise ValueError(f'MZI at {list(addrs[sequence[step]])} is swept before the MZIs of its input paths.')
+        (cost, _, _, _), k, i, j, port_in, port_out, changes = best
+        plan[step] = (addrs[k], cidx[k], port_in, port_out, (i, j), changes, clock)
+        clock += cost
+        cross[ins[k][i]] = True
+        cross[outs[k][j]] = True
+        cross[k] = False
+        done[k] = True
+        for user in users[k]:
+            waiting[user] -= 1
+    return plan, clock
+
 def new_calidata(N):
     calidata = np.zeros((N,N), dtype=cdt)
     calidata['pin'] = np.arange(N**2).reshape(N,N)
@@ -105,9 +210,11 @@ class PinPhaseShifter(Component):
         rms = paras[0]*0.01
         op = fit_func(pp, *paras) + np.random.normal(0, rms, size=30)
 
+        from scipy.optimize import curve_fit
         popt, pcov = curve_fit(fit_func, pp, op)
         self.paras = popt
         if plot is True:
+            import matplotlib.pyplot as plt
             plt.plot(pp, op, 'r*')
             plt.plot(pp, fit_func(pp, *popt))
             plt.show()
@@ -123,6 +230,7 @@ class PinPhaseShifter(Component):
             time.sleep(self.rising_time)
             op[i] = opm.read()
         pp = currs*volts
+        from scipy.optimize import curve_fit
         popt, pcov = curve_fit(fit_func, pp, op)
         self.paras = popt
         return popt
@@ -151,6 +259,10 @@ class ClementsCali(ClementsMesh):
     def __getitem__(self, addr):
         # return super().__getitem__(item)
         return self.phaseshitfers[addr[0]*self.dimension+addr[1]]
+
+    def plan(self, order=None, **times):
+        """Calibration schedule of the MZIs and its estimated total time, see plan_calibration"""
+        return plan_calibration(self, order, **times)
     
 
 class Crosstalk(ClementsCali):
@@ -1,8 +1,10 @@
 import numpy as np
 import copy
-import matplotlib.pyplot as plt
+import weakref
 
 from qpyc.Visualize import plot_address, plot_phase
+from qpyc.Engine import layers, layered_matrix, block, propagate, apply_right, apply_left
+from qpyc.Engine import jacobian, fidelity, fidelity_gradient, backend, stack2
 
 def checkAddr(addr):
     """
@@ -15,6 +17,108 @@ def checkAddr(addr):
     # else:
         # pass
 
+def ps_matrices(phase):
+    """Phase shifter matrices for an array of phases
+
+    Parameters
+    ----------
+    phase : array_like
+        phases in unit of pi, shape (...)
+
+    Returns
+    -------
+    np.array
+        shape (..., 1, 1)
+
+    >>> assert np.allclose(ps_matrices([0, 1]).ravel(), [1, -1])
+    """
+    xp = backend()
+    phase = xp.asarray(phase, dtype=float)
+    return xp.exp(1j*np.pi*phase)[..., None, None]
+
+def bs_matrices(bias):
+    """Beam spiliter matrices for an array of biases
+
+    Parameters
+    ----------
+    bias : array_like
+        bias angles in unit of pi, shape (...)
+
+    Returns
+    -------
+    np.array
+        shape (..., 2, 2)
+
+    >>> assert np.allclose(bs_matrices([0, .25])[1], [[1, 0], [0, 1]])
+    """
+    xp = backend()
+    bias = xp.asarray(bias, dtype=float)
+    sin = xp.sin((0.25 + bias) * np.pi)
+    cos = xp.cos((0.25 + bias) * np.pi)
+    return stack2(sin, 1j * cos, 1j * cos, sin)
+
+def mzi_matrices(theta, phi, bias=(0, 0)):
+    """MZI matrices for arrays of phases and biases, in closed form
+
+    The MZI is PhaseShifter(phi) >> BeamSpiliter(bias[0]) >> PhaseShifter(theta) >> BeamSpiliter(bias[1]),
+    the phase shifters acting on the upper waveguide.
+
+    Parameters
+    ----------
+    theta : array_like
+        internal phases in unit of pi, shape (...)
+    phi : array_like
+        external phases in unit of pi, shape (...)
+    bias : array_like, optional
+        biases of the two beam spiliters, shape (..., 2), by default (0, 0)
+
+    Returns
+    -------
+    np.array
+        shape (..., 2, 2), broadcast over all inputs
+
+    >>> mat = mzi_matrices(np.zeros(3), np.zeros(3))
+    >>> assert mat.shape == (3, 2, 2) and np.allclose(mat[0], [[0, 1j], [1j, 0]])
+    """
+    xp = backend()
+    theta = xp.asarray(theta, dtype=float)
+    phi = xp.asarray(phi, dtype=float)
+    bias = xp.asarray(bias, dtype=float)
+    s0, c0 = xp.sin((0.25 + bias[..., 0]) * np.pi), xp.cos((0.25 + bias[..., 0]) * np.pi)
+    s1, c1 = xp.sin((0.25 + bias[..., 1]) * np.pi), xp.cos((0.25 + bias[..., 1]) * np.pi)
+    et = xp.exp(1j*np.pi*theta)
+    ep = xp.exp(1j*np.pi*phi)
+    return stack2(ep * (s1*s0*et - c1*c0), 1j * (s1*c0*et + c1*s0),
+                  1j * ep * (c1*s0*et + s1*c0), s1*s0 - c1*c0*et)
+
+def mzi_derivatives(theta, phi, bias=(0, 0)):
+    """Derivatives of the MZI matrices with respect to theta and phi, see mzi_matrices
+
+    Phases are in unit of pi, so are the derivatives, i.e. d/d(theta) with theta in unit of pi.
+
+    Returns
+    -------
+    tuple
+        (d/d theta, d/d phi), both of shape (..., 2, 2)
+
+    >>> t, p, e = .3, .2, 1e-6
+    >>> dt, dp = mzi_derivatives(t, p)
+    >>> assert np.allclose(dt, (mzi_matrices(t+e, p) - mzi_matrices(t-e, p))/2/e)
+    >>> assert np.allclose(dp, (mzi_matrices(t, p+e) - mzi_matrices(t, p-e))/2/e)
+    """
+    xp = backend()
+    theta = xp.asarray(theta, dtype=float)
+    phi = xp.asarray(phi, dtype=float)
+    bias = xp.asarray(bias, dtype=float)
+    s0, c0 = xp.sin((0.25 + bias[..., 0]) * np.pi), xp.cos((0.25 + bias[..., 0]) * np.pi)
+    s1, c1 = xp.sin((0.25 + bias[..., 1]) * np.pi), xp.cos((0.25 + bias[..., 1]) * np.pi)
+    det = 1j*np.pi*xp.exp(1j*np.pi*theta)
+    ep = xp.exp(1j*np.pi*phi)
+    dt = stack2(ep * s1*s0*det, 1j * s1*c0*det, 1j * ep * c1*s0*det, -c1*c0*det)
+    mat = mzi_matrices(theta, phi, bias)
+    dp = stack2(1j*np.pi*mat[..., 0, 0], 0, 1j*np.pi*mat[..., 1, 0], 0)
+    return dt, dp
+
 class Component:
     def __init__(self, addr=None, dom=None) -> None:
         """Optical Component
@@ -35,12 +139,34 @@ class Component:
             i.e. the waveguides/input ports/output ports number, by default None
         """
         # check(addr)
-        self._addr = addr
+        self._addr = None if addr is None else list(addr)
         self.dom = dom
         self._matrix = np.array([], dtype=np.complex_)
+        # circuits holding this component, notified before it moves or changes,
+        # held weakly so that snapshots no circuit shares any more go away
+        self._circuits = weakref.WeakSet()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_circuits', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._circuits = weakref.WeakSet()
+
+    def _relocate(self, addr):
+        """Tell the circuits holding this component it moves to addr"""
+        for circ in list(self._circuits):
+            circ._move(self, addr)
+
+    def _touch(self):
+        """Tell the circuits holding this component its matrix changes"""
+        for circ in list(self._circuits):
+            circ._changed(self)
 
     def __repr__(self) -> str:
-        return f'Component ({self.addr})'
+        return f'Component ({self._addr})'
 
     @property
     def addr(self):
@@ -48,17 +174,23 @@ class Component:
 
         Returns
         -------
-        list
+        tuple
             (x, y)
             x is the column index
             y is the index of the first input port
+            It is a copy, assign addr, x or y to move the Component.
+
+        >>> W = Waveguide(addr=[1, 1])
+        >>> W.addr = [2, 1]
+        >>> assert W.addr == (2, 1)
         """
-        return self._addr
+        return None if self._addr is None else tuple(self._addr)
 
     @addr.setter
     def addr(self, addr):
         checkAddr(addr)
-        self._addr = addr
+        self._relocate(addr)
+        self._addr = list(addr)
 
     @property
     def x(self):
@@ -74,7 +206,7 @@ class Component:
     @x.setter
     def x(self, xx):
         assert type(xx) is int
-        self._addr[0] = xx
+        self.addr = [xx, self.y]
 
     @property
     def y(self):
@@ -90,7 +222,7 @@ class Component:
     @y.setter
     def y(self, yy):
         assert type(yy) is int
-        self._addr[1] = yy
+        self.addr = [self.x, yy]
 
     @property
     def ports(self):
@@ -120,6 +252,7 @@ class Component:
 
     @matrix.setter
     def matrix(self, mat):
+        self._touch()
         self._matrix = np.array(mat, dtype=np.complex_)
 
     def merge(self, other):
@@ -220,7 +353,7 @@ class Waveguide(Component):
         super().__init__(addr, dom)
 
     def __repr__(self) -> str:
-        return f'Waveguide ({self.addr}, Dim={self.dom})'
+        return f'Waveguide ({self._addr}, Dim={self.dom})'
 
     @property
     def matrix(self):
@@ -252,11 +385,32 @@ class PhaseShifter(Component):
         self.phase = phase
 
     def __repr__(self) -> str:
-        return f'PhaseShifter({self.addr}, Phase={self.phase})'
+        return f'PhaseShifter({self._addr}, Phase={self.phase})'
+
+    @property
+    def phase(self):
+        """phase in unit of pi"""
+        return self._phase
+
+    @phase.setter
+    def phase(self, phase):
+        self._touch()
+        self._phase = phase
 
     @property
     def matrix(self):
-        return np.array([np.exp(1j*self.phase*np.pi)], dtype=np.complex_)
+        """1 x 1 matrix of the phase shifter, see ps_matrices"""
+        return ps_matrices(self.phase)
+
+    def derivatives(self):
+        """Derivative of matrix with respect to phase (in unit of pi)
+
+        Returns
+        -------
+        dict
+            {'phase': 1 x 1 array}
+        """
+        return {'phase': 1j*np.pi*self.matrix}
 
     def dagger(self):
         return PhaseShifter(phase=-self.phase, addr=self.addr)
@@ -275,13 +429,21 @@ class BeamSpiliter(Component):
         self.bias = bias
 
     def __repr__(self):
-        return f'BeamSpiliter ({self.addr}, Bias={self.bias})'
+        return f'BeamSpiliter ({self._addr}, Bias={self.bias})'
+
+    @property
+    def bias(self):
+        """bias angle in unit of pi"""
+        return self._bias
+
+    @bias.setter
+    def bias(self, bias):
+        self._touch()
+        self._bias = bias
 
     @property
     def matrix(self):
-        sin = np.sin((0.25 + self.bias) * np.pi)
-        cos = np.cos((0.25 + self.bias) * np.pi)
-        return np.array([[sin, 1j * cos], [1j * cos, sin]], dtype=np.complex_)
+        return bs_matrices(self.bias)
 
     def dagger(self):
         """Conjugate transpose of BeamSpiliter by changing the matrix
@@ -301,7 +463,7 @@ class BeamSpiliter(Component):
 
 
 class MZI(Component):
-    def __init__(self, theta=0, phi=0, bias=[0, 0], addr=None) -> None:
+    def __init__(self, theta=0, phi=0, bias=None, addr=None) -> None:
         """Mach-Zehnder interferometor consisting of 2 biased beam spilitters and 2 phase shifters.
 
         Parameters
@@ -310,21 +472,60 @@ class MZI(Component):
             internal phase, by default 0
         phi : int, optional
             external phase, by default 0
-        bias : list, optional
-            biases of two beam spiliters, by default [0, 0]
+        bias : array_like, optional
+            biases of two beam spiliters, by default (0, 0)
         addr : list, optional
             address, by default None        
 
-        TODO: change the parameters into property
-
+        Assigning theta, phi or bias marks the MZI as changed in its circuits.
+        bias is kept as a tuple, so that it is only changed by assignment.
         """
         super().__init__(addr, dom=2)
         self.theta = theta
         self.phi = phi
-        self.bias = bias
+        self.bias = (0, 0) if bias is None else bias
 
     def __repr__(self) -> str:
-        return f'MZI ({self.addr}, Phase={self.theta}, {self.phi})'
+        return f'MZI ({self._addr}, Phase={self.theta}, {self.phi})'
+
+    @property
+    def theta(self):
+        """internal phase in unit of pi"""
+        return self._theta
+
+    @theta.setter
+    def theta(self, theta):
+        self._touch()
+        self._theta = theta
+
+    @property
+    def phi(self):
+        """external phase in unit of pi"""
+        return self._phi
+
+    @phi.setter
+    def phi(self, phi):
+        self._touch()
+        self._phi = phi
+
+    @property
+    def bias(self):
+        """biases of two beam spiliters in unit of pi, a tuple
+
+        >>> mzi = MZI()
+        >>> mzi.bias = [.01, -.02]
+        >>> mzi.bias
+        (0.01, -0.02)
+        """
+        return self._bias
+
+    @bias.setter
+    def bias(self, bias):
+        bias = tuple(float(b) for b in np.asarray(bias, dtype=float).reshape(-1))
+        if len(bias) != 2:
+            raise ValueError(f'MZI takes the biases of 2 beam spiliters, got {len(bias)}.')
+        self._touch()
+        self._bias = bias
 
     @property
     def phase(self):
@@ -332,16 +533,25 @@ class MZI(Component):
     
     @property
     def matrix(self):
+        """Matrix of MZI in closed form, see mzi_matrices
+
+        >>> U2 = MZI(theta=.3, phi=.25, bias=[.01, -.02])
+        >>> mzi = PhaseShifter(U2.phi) @ Waveguide() >> BeamSpiliter(U2.bias[0]) >> \\
+        ...     PhaseShifter(U2.theta) @ Waveguide() >> BeamSpiliter(U2.bias[1])
+        >>> assert np.allclose(U2.matrix, mzi.matrix)
         """
-        TODO: rewrite the matrix representation here
-        
-        >>> U2 = MZI(phase=.3, phi=.25)
-        >>> np.allclose(U2.matrix, )
+        return mzi_matrices(self.theta, self.phi, self.bias)
+
+    def derivatives(self):
+        """Derivatives of matrix with respect to theta and phi (in unit of pi), see mzi_derivatives
+
+        Returns
+        -------
+        dict
+            {'theta': 2 x 2 array, 'phi': 2 x 2 array}
         """
-        mzi = PhaseShifter(self.phi) @ Waveguide() >> BeamSpiliter(self.bias[0]) >> \
-            PhaseShifter(
-                self.theta) @ Waveguide() >> BeamSpiliter(self.bias[1])
-        return mzi.matrix
+        dt, dp = mzi_derivatives(self.theta, self.phi, self.bias)
+        return {'theta': dt, 'phi': dp}
 
 class Circuit:
     """Cricuit class
@@ -351,13 +561,325 @@ class Circuit:
     1.  coordinated and not overlapped
     2.  added or removed by objects or coordinates
     Likewise, Circuit can of course be extended in parallel or in series
+
+    Composition (copy, multiple, stack) shares the devices of the operands instead of copying them:
+    the new Circuit references frozen snapshots of the operands with an (x, y) offset.
+    A snapshot keeps a copy of a device only when the device is about to change (copy-on-write),
+    and a shared block is copied into the composed Circuit only when one of its devices is looked up
+    by address or the Circuit changes where the block lies.
     """
 
     def __init__(self) -> None:
-        self._devices = []
+        self._own = []          # devices owned by the circuit
+        self._blocks = []       # shared blocks (snapshot, dx, dy)
+        self._bxmin = np.inf    # minimal x of the shared blocks
+        self._frozen = False    # snapshot shared by other circuits
+        self._snap = None       # snapshot of the current state, None if outdated
+        # index kept up to date by add/remove and Component._relocate
+        self._index = {}    # (x, y) -> device
+        self._keys = {}     # id(device) -> (x, y) the device is indexed with
+        self._cols = {}     # x -> devices in the column
+        self._ports = {}    # x -> {port: device}, waveguide occupancy of the column
+        self._width = 0     # None if it has to be recomputed
+        self._depth = 0
+        self._sorted = None # devices dict in (x, y) order, None if outdated
+        # matrix cache, see _update
+        self._invalidate()
 
     def __repr__(self) -> str:
-        return [d.__repr__() for d in self._devices]
+        return [d.__repr__() for d in self._flat()]
+
+    # index and caches, keyed by object ids and rebuilt by __setstate__
+    _cache = ('_own', '_blocks', '_bxmin', '_frozen', '_snap',
+              '_index', '_keys', '_cols', '_ports', '_width', '_depth', '_sorted',
+              '_matrix', '_mats', '_dirty', '_prefix', '_suffix')
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items() if k not in Circuit._cache}
+        state['_devices'] = self._flat()
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        devices = state.pop('_devices')
+        Circuit.__init__(self)
+        self.__dict__.update(state)
+        for d in devices:
+            self.__add_single(d)
+
+    @property
+    def _devices(self):
+        """List of devices, the devices of shared blocks are copied in first"""
+        self._materialize()
+        return self._own
+
+    def _flat(self):
+        """List of devices, those of shared blocks as shallow copies at their address, the Circuit is left as it is"""
+        devices = list(self._own)
+        for x, y, d in list(self._placed())[len(self._own):]:
+            d = copy.copy(d)
+            d._addr = [x, y]
+            devices.append(d)
+        return devices
+
+    def _placed(self):
+        """Placements (x, y, device) of all devices, shared blocks included, without copying"""
+        stack = [(self, 0, 0)]
+        while len(stack) != 0:
+            circ, dx, dy = stack.pop()
+            for d in circ._own:
+                yield d.x + dx, d.y + dy, d
+            stack.extend((snap, dx + bx, dy + by) for snap, bx, by in reversed(circ._blocks))
+
+    def _materialize(self, spans=None):
+        """Copy the devices of the shared blocks into the circuit.
+
+        With spans, a list of (addr, dom), only the blocks covering the ports addr[1] to addr[1]+dom-1
+        of a column addr[0] are copied. The blocks they are composed of are shared in turn and are
+        copied only if they cover a span as well. The content is the same, so is the cached matrix.
+        """
+        if len(self._blocks) == 0:
+            return
+        matrix, dirty = self._matrix, self._dirty
+        while True:
+            hit = [b for b in self._blocks if spans is None or any(self._covers(b, a, dom) for a, dom in spans)]
+            if len(hit) == 0:
+                break
+            self._blocks = [b for b in self._blocks if all(b is not h for h in hit)]
+            for snap, dx, dy in hit:
+                for d in snap._own:
+                    c = copy.deepcopy(d)
+                    c._addr = [d.x + dx, d.y + dy]
+                    self._insert(c, c._addr)
+                    self._own.append(c)
+                    c._circuits.add(self)
+                self._blocks.extend((s, dx + bx, dy + by) for s, bx, by in snap._blocks)
+        self._bxmin = min((dx + snap.xmin for snap, dx, _ in self._blocks), default=np.inf)
+        self._matrix, self._dirty = matrix, dirty
+
+    @staticmethod
+    def _covers(blk, addr, dom):
+        """If the bounding box of the shared block blk covers one of the ports of (addr, dom)"""
+        snap, dx, dy = blk
+        return dx + snap.xmin <= addr[0] <= dx + snap.depth and dy < addr[1] + dom and addr[1] < dy + snap.width
+
+    def _freeze(self):
+        """Snapshot of the circuit to be shared by composed circuits"""
+        if self._frozen:
+            return self
+        if self._snap is None:
+            snap = Circuit()
+            for d in self._own:
+                snap.__add_single(d)
+            snap._blocks, snap._bxmin = list(self._blocks), self._bxmin
+            snap._width, snap._depth = self.width, self.depth
+            snap._frozen = True
+            self._snap = snap
+        return self._snap
+
+    def _compose(self, snap, dx, dy):
+        """Share the snapshot snap at offset (dx, dy)"""
+        if snap._empty:
+            return
+        self._blocks.append((snap, dx, dy))
+        self._bxmin = min(self._bxmin, dx + snap.xmin)
+        self._width = max(self.width, dy + snap.width)
+        self._depth = max(self.depth, dx + snap.depth)
+        self._invalidate()
+
+    def _swap(self, d):
+        """Replace device d of a snapshot by a copy before d changes"""
+        c = copy.deepcopy(d)
+        key = self._keys.pop(id(d))
+        self._keys[id(c)] = key
+        self._index[key] = c
+        col = self._cols[key[0]]
+        col[col.index(d)] = c
+        occupied = self._ports[key[0]]
+        for p in self._span(d, key):
+            occupied[p] = c
+        self._own[self._own.index(d)] = c
+        if id(d) in self._mats:
+            self._mats[id(c)] = self._mats.pop(id(d))
+        self._sorted = None
+        d._circuits.discard(self)
+        c._circuits.add(self)
+
+    @property
+    def _empty(self):
+        return len(self._own) == 0 and len(self._blocks) == 0
+
+    @staticmethod
+    def _span(d, addr):
+        """Ports occupied by device d at addr"""
+        return range(addr[1], addr[1] + (d.dom or 1))
+
+    def _check(self, d, addr):
+        """Raise if device d at addr overlaps another device of the Circuit"""
+        occupied = self._ports.get(addr[0], {})
+        for p in self._span(d, addr):
+            if occupied.get(p, d) is not d:
+                raise Warning(f'Overlap Component at {list(addr)} with {occupied[p]} on port {p}')
+
+    def _insert(self, d, addr):
+        key = tuple(addr)
+        self._index[key] = d
+        self._keys[id(d)] = key
+        self._cols.setdefault(key[0], []).append(d)
+        occupied = self._ports.setdefault(key[0], {})
+        for p in self._span(d, key):
+            occupied[p] = d
+        if self._width is not None:
+            self._width = max(self._width, key[1] + (d.dom or 1))
+        if self._depth is not None:
+            self._depth = max(self._depth, key[0])
+        self._sorted = None
+        self._snap = None
+        self._invalidate()
+
+    def _discard(self, d):
+        key = self._keys.pop(id(d))
+        del self._index[key]
+        col = self._cols[key[0]]
+        col.remove(d)
+        if len(col) == 0:
+            del self._cols[key[0]]
+        occupied = self._ports[key[0]]
+        for p in self._span(d, key):
+            del occupied[p]
+        if len(occupied) == 0:
+            del self._ports[key[0]]
+        if self._width is not None and key[1] + (d.dom or 1) >= self._width:
+            self._width = None
+        if self._depth is not None and key[0] >= self._depth:
+            self._depth = None
+        self._sorted = None
+        self._snap = None
+        self._invalidate()
+
+    def _move(self, d, addr):
+        """Re-index device d before its address changes to addr"""
+        if self._frozen:
+            return self._swap(d)
+        self._materialize([(addr, d.dom or 1)])
+        key = self._keys[id(d)]
+        self._discard(d)
+        try:
+            self._check(d, addr)
+        except Warning:
+            self._insert(d, key)
+            raise
+        self._insert(d, addr)
+
+    def _invalidate(self):
+        """Drop all cached matrices"""
+        self._matrix = None # cached circuit matrix
+        self._mats = {}     # id(device) -> device matrix used in _matrix
+        self._dirty = {}    # id(device) -> device changed since _matrix was computed
+        self._prefix = {}   # x -> product of the columns before x
+        self._suffix = {}   # x -> product of the columns after x
+
+    def _changed(self, d):
+        """Mark device d as changed, called by the device before its parameters change"""
+        if self._frozen:
+            return self._swap(d)
+        self._snap = None
+        if self._matrix is None:
+            self._mats.pop(id(d), None)
+        else:
+            self._dirty[id(d)] = d
+
+    def _block(self, d):
+        """Cached matrix of device d"""
+        mat = self._mats.get(id(d))
+        if mat is None:
+            mat = self._mats[id(d)] = block(d)
+        return mat
+
+    def _fresh_block(self, d):
+        """Matrix of device d, not taken from the cache while d is pending an update"""
+        return block(d) if id(d) in self._dirty else self._block(d)
+
+    def _prefix_at(self, x, xs):
+        """Product of the columns before x, extended column by column from the nearest cached one, O(N^2) per column"""
+        start = max((k for k in self._prefix if k <= x), default=None)
+        if start is None:
+            start = xs[0]
+            self._prefix[start] = np.eye(self.width, dtype=complex)
+        P = self._prefix[start]
+        i = xs.index(start)
+        while xs[i] < x:
+            P = P.copy()
+            for d in self._cols[xs[i]]:
+                P = apply_right(P, d.y, self._block(d))
+            i += 1
+            self._prefix[xs[i]] = P
+        return P
+
+    def _suffix_at(self, x, xs):
+        """Product of the columns after x, extended column by column from the nearest cached one, O(N^2) per column"""
+        start = min((k for k in self._suffix if k >= x), default=None)
+        if start is None:
+            start = xs[-1]
+            self._suffix[start] = np.eye(self.width, dtype=complex)
+        S = self._suffix[start]
+        i = xs.index(start)
+        while xs[i] > x:
+            S = S.copy()
+            for d in self._cols[xs[i]]:
+                S = apply_left(S, d.y, self._block(d))
+            i -= 1
+            self._suffix[xs[i]] = S
+        return S
+
+    def _update(self):
+        """Bring the cached matrix up to date.
+
+        The changed columns x are updated in increasing order: the matrix P @ C_x @ S, with P/S the
+        products of the columns before/after x, is updated by P[:, rows] @ (new - old) @ S[rows, :]
+        for each changed device, O(N^2). P and S are cached for every column and, after a change in
+        column x, the products crossing x are extended again from the nearest ones left, one column
+        at a time, so that tuning devices one after another across the columns costs O(N^2) per change.
+        With more changed devices than the width, the matrix is evaluated again.
+        Shared blocks never change, so a composed circuit is evaluated once.
+        """
+        if self._matrix is not None and len(self._dirty) != 0:
+            dirty = list(self._dirty.values())
+            self._dirty = {}
+            changed = {}
+            for d in dirty:
+                changed.setdefault(self._keys[id(d)][0], []).append(d)
+            if len(self._blocks) == 0 and len(dirty) <= self.width and all(id(d) in self._mats for d in dirty):
+                xs = sorted(self._cols)
+                for x in sorted(changed):
+                    self._prefix = {k: P for k, P in self._prefix.items() if k <= x}
+                    self._suffix = {k: S for k, S in self._suffix.items() if k >= x}
+                    P, S = self._prefix_at(x, xs), self._suffix_at(x, xs)
+                    for d in changed[x]:
+                        old = self._mats.pop(id(d))
+                        rows = slice(d.y, d.y + d.dom)
+                        self._matrix += P[:, rows] @ (self._block(d) - old) @ S[rows, :]
+            else:
+                self._prefix = {k: P for k, P in self._prefix.items() if k <= min(changed)}
+                self._suffix = {k: S for k, S in self._suffix.items() if k >= max(changed)}
+                for d in dirty:
+                    self._mats.pop(id(d), None)
+                self._matrix = None
+        if self._matrix is None:
+            if len(self._blocks) == 0:
+                self._matrix = layered_matrix(self._own, self.width, self._block)
+            else:
+                self._matrix = layered_matrix(self._placed(), self.width, self._shared_block())
+
+    @staticmethod
+    def _shared_block():
+        """Block function with a memo for one evaluation of shared devices"""
+        memo = {}
+        def shared(d):
+            if id(d) not in memo:
+                memo[id(d)] = block(d)
+            return memo[id(d)]
+        return shared
 
     @property
     def devices(self):
@@ -367,11 +889,14 @@ class Circuit:
         -------
         dict
             A dictionary including all Circuit devices, the key is address tuple and the value is Component.
+            It is sorted by (x, y) and cached until the Circuit changes, do not modify it.
+            The devices of shared blocks are copied into the Circuit first, use addrs to only list them.
             Note that _devices attribute is list.
         """
-        self._devices.sort(key=lambda d: d.y)
-        self._devices.sort(key=lambda d: d.x)
-        return {tuple(d.addr): d for d in self._devices}
+        self._materialize()
+        if self._sorted is None:
+            self._sorted = {key: self._index[key] for key in sorted(self._index)}
+        return self._sorted
     
     @property
     def addrs(self):
@@ -381,21 +906,34 @@ class Circuit:
         >>> C.add(Waveguide(dom=2), Waveguide(dom=3))
         >>> assert C.addrs == [(1,1), (2,1)]
         """
-        return list(self.devices.keys())
+        if len(self._blocks) == 0:
+            return list(self.devices.keys())
+        return sorted((x, y) for x, y, _ in self._placed())
 
     @property
     def width(self):
         """
         Circuit width, maximal y coordinate 
         """
-        return max([d.y+d.dom for d in self._devices]) if len(self._devices) != 0 else 0
+        if self._width is None:
+            self._width = max([d.y+(d.dom or 1) for d in self._own] + [dy + snap.width for snap, _, dy in self._blocks], default=0)
+        return self._width
 
     @property
     def depth(self):
         """
         Circuit depth, maximal x coordinate 
         """
-        return max([d.x for d in self._devices]) if len(self._devices) != 0 else 0
+        if self._depth is None:
+            self._depth = max(list(self._cols) + [dx + snap.depth for snap, dx, _ in self._blocks], default=0)
+        return self._depth
+
+    @property
+    def xmin(self):
+        """
+        Minimal x coordinate, inf for an empty Circuit
+        """
+        return min(min(self._cols, default=np.inf), self._bxmin)
     
     def __contains__(self, d):
         """If Device in Circuit.
@@ -410,7 +948,8 @@ class Circuit:
         >>> assert W in C
         
         """
-        return d in self._devices
+        # the devices of shared blocks are never handed out, only their copies
+        return id(d) in self._keys
 
     def __getitem__(self, item):
         """Get Device item in Circuit.
@@ -430,9 +969,11 @@ class Circuit:
         >>> print(C[(1,1)])
         Waveguide ([1, 1], Dim=2)
         """
-        if item in self.addrs:
-            return self.devices[item]
-        else:
+        try:
+            if len(self._blocks) != 0 and tuple(item) not in self._index:
+                self._materialize([(item, 1)])
+            return self._index[tuple(item)]
+        except (KeyError, TypeError, IndexError):
             raise ValueError('Required address has no Component.')
 
     def __add_single(self, d):
@@ -443,20 +984,27 @@ class Circuit:
         d : Device
             The single device to be added
 
+        Raises
+        ------
+        Warning
+            If the device is already in Circuit or overlaps the ports of another device in its column
+
         >>> C = Circuit()
         >>> C.add(Waveguide(dom=2), Waveguide(dom=3))
-        >>> assert C.width == 3
+        >>> assert C.width == 4
         """
         if isinstance(d, Component) is False:
             raise TypeError('Only Component can be added into Circuit.')
-        elif d in self._devices:
+        elif d in self:
             raise Warning('Device is already in Circuit.')
         else:
-            if d._addr == None:
+            if d._addr is None:
                 d._addr = [self.depth + 1, 1]
-            elif d._addr in self.addrs:
-                raise Warning(f'Overlap Component at {d.addr}')
-            self._devices.append(d)
+            self._materialize([(d._addr, d.dom or 1)])
+            self._check(d, d._addr)
+            self._insert(d, d._addr)
+            self._own.append(d)
+            d._circuits.add(self)
 
     def add(self, d, *dd):
         """
@@ -464,61 +1012,241 @@ class Circuit:
         
         >>> C = Circuit()
         >>> C.add(Waveguide(dom=2), Waveguide(dom=3))
-        >>> assert C.width == 3
+        >>> assert C.width == 4
         
         """
         self.__add_single(d)
         if dd is not None:
             [self.__add_single(d) for d in dd]
 
+    def extend(self, devices):
+        """
+        Add many devices with their addresses at once, in linear time.
+
+        All devices are checked before any is added and the index is updated once,
+        instead of once per device as in add.
+
+        Parameters
+        ----------
+        devices : iterable
+            Components with addresses
+
+        Raises
+        ------
+        Warning
+            If a device is already in Circuit, has no address or overlaps another device
+
+        >>> C = Circuit()
+        >>> C.extend([Waveguide(addr=[1, 1], dom=2), Waveguide(addr=[1, 3])])
+        >>> assert C.width == 4
+        """
+        devices = list(devices)
+        if len(devices) == 0:
+            return
+        for d in devices:
+            if isinstance(d, Component) is False:
+                raise TypeError('Only Component can be added into Circuit.')
+            if d._addr is None:
+                raise Warning('Devices added by extend need an address.')
+        self._materialize([(d._addr, d.dom or 1) for d in devices])
+        ids = [id(d) for d in devices]
+        if len(set(ids)) != len(ids) or any(i in self._keys for i in ids):
+            raise Warning('Device is already in Circuit.')
+        keys = [tuple(d._addr) for d in devices]
+        xy = np.array(keys, dtype=np.int64).reshape(-1, 2)
+        dom = np.array([d.dom or 1 for d in devices], dtype=np.int64)
+        # every (x, port) taken by a device, once
+        owner = np.repeat(np.arange(len(devices)), dom)
+        ports = np.repeat(xy[:, 1] - np.cumsum(dom) + dom, dom) + np.arange(dom.sum())
+        taken = np.column_stack([xy[owner, 0], ports])
+        if len(self._ports) != 0 or len(np.unique(taken, axis=0)) != len(taken):
+            seen = {}
+            for (x, p), i in zip(taken.tolist(), owner.tolist()):
+                other = seen.get((x, p), self._ports.get(x, {}).get(p))
+                if other is not None:
+                    raise Warning(f'Overlap Component at {list(devices[i]._addr)} with {other} on port {p}')
+                seen[(x, p)] = devices[i]
+        self._index.update(zip(keys, devices))
+        self._keys.update(zip(ids, keys))
+        for d, key in zip(devices, keys):
+            self._cols.setdefault(key[0], []).append(d)
+            d._circuits.add(self)
+        for (x, p), i in zip(taken.tolist(), owner.tolist()):
+            self._ports.setdefault(x, {})[p] = devices[i]
+        self._own.extend(devices)
+        self._width = max(self.width, int((xy[:, 1] + dom).max()))
+        self._depth = max(self.depth, int(xy[:, 0].max()))
+        self._sorted = None
+        self._snap = None
+        self._invalidate()
+
     def remove(self, device):
         """
-        Remove single device by device obejct.
+        Remove single device by device obejct or by its address.
+
+        >>> C = Circuit()
+        >>> W = Waveguide(addr=[0, 0])
+        >>> C.add(W)
+        >>> C.remove((0, 0))
+        >>> assert W not in C and C.width == 0
+        """
+        if isinstance(device, Component) is False:
+            device = self[device]
+        assert device in self
+        self._discard(device)
+        self._own.remove(device)
+        device._circuits.discard(self)
+
+    @property
+    def layers(self):
+        """Devices grouped into columns
+
+        Returns
+        -------
+        list
+            list of (x, [devices]) sorted by the column index x
         """
-        #todo: by coordinate
-        if type(device) is Component:
-            assert device in self._devices
-            self._devices.remove(device)
+        return layers(self._devices)
 
     @property
     def matrix(self):
         """
         Calculate the circuit matrix.
-        To do: split the devices by columns
-        """
-        mat = np.eye(self.width)
-        for d in self._devices:
-            assert isinstance(d, Component)
-            submat = np.eye(self.width, dtype=np.complex_)
-            submat[d.y-1:d.y+d.dom-1, d.y-1:d.y+d.dom-1] = d.matrix
-            mat = np.matmul(mat, submat)
-        return mat
+        Devices are applied column by column, each one only updating its own ports (see qpyc.Engine).
+        The device at column x acts on rows y, ..., y+dom-1, i.e. its ports.
+        The result is cached, changing the parameters of devices in a single column
+        only costs an O(N^2) update (see _update).
+
+        >>> C = Circuit()
+        >>> C.add(BeamSpiliter(addr=[0, 0]), PhaseShifter(phase=1, addr=[1, 1]))
+        >>> assert np.allclose(C.matrix, BeamSpiliter().matrix @ np.diag([1, -1]))
+        """
+        self._update()
+        return self._matrix.copy()
+
+    def propagate(self, fields):
+        """
+        Apply the circuit to input amplitudes, column by column without forming the matrix.
+
+        Parameters
+        ----------
+        fields : array_like
+            input amplitudes, shape (width,) or (width, B) for a batch of B inputs
+
+        Returns
+        -------
+        np.array
+            output amplitudes, equal to self.matrix @ fields
+
+        >>> C = Circuit()
+        >>> C.add(MZI(theta=.3, addr=[0, 0]), MZI(phi=.2, addr=[1, 1]))
+        >>> assert np.allclose(C.propagate(np.eye(3)[:, :2]), C.matrix[:, :2])
+        """
+        if len(self._blocks) == 0:
+            return propagate(self._own, fields, self.width, self._fresh_block)
+        return propagate(self._placed(), fields, self.width, self._shared_block())
+
+    def jacobian(self):
+        """
+        Derivatives of the circuit matrix with respect to every phase of MZIs and PhaseShifters,
+        in one forward and one backward sweep (see Engine.jacobian).
+
+        Returns
+        -------
+        tuple
+            (keys, grads), keys is a list of ((x, y), name), name being 'theta', 'phi' or 'phase',
+            grads has shape (len(keys), width, width)
+
+        >>> C = Circuit()
+        >>> C.add(MZI(theta=.3, addr=[0, 0]), PhaseShifter(phase=.2, addr=[1, 1]))
+        >>> keys, grads = C.jacobian()
+        >>> keys
+        [((0, 0), 'theta'), ((0, 0), 'phi'), ((1, 1), 'phase')]
+        """
+        if len(self._blocks) == 0:
+            return jacobian(self._own, self.width, self._fresh_block)
+        return jacobian(self._placed(), self.width, self._shared_block())
+
+    def matrix_batch(self, theta=None, phi=None, bias=None, chunk=None, processes=None, out=None):
+        """
+        Circuit matrices for M sets of parameters, see ArrayCircuit.matrix_batch.
+
+        The columns of the parameter arrays follow the order of the devices property,
+        theta holds the phase of PhaseShifter and bias[..., 0] the bias of BeamSpiliter.
+
+        Returns
+        -------
+        np.array
+            shape (M, width, width)
+        """
+        from qpyc.Array import ArrayCircuit
+        A = ArrayCircuit(max(len(self.devices), 1))
+        for d in self.devices.values():
+            A.add(d)
+        return A.matrix_batch(theta, phi, bias, chunk, processes, out)
+
+    def save(self, path):
+        """
+        Save the circuit in a binary columnar file, see ArrayCircuit.save.
+        """
+        from qpyc.Array import ArrayCircuit
+        ArrayCircuit.from_circuit(self).save(path)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a file written by save, the circuit is of the class it was saved from,
+        e.g. ClementsMesh. Use ArrayCircuit.load for a lazy memory mapped circuit.
+        """
+        from qpyc.Array import ArrayCircuit
+        return ArrayCircuit.load(path, mmap=False).to_circuit()
+
+    def fidelity(self, target):
+        """
+        Fidelity |Tr(target^dagger matrix)|^2 / N^2 of the circuit to a target unitary.
+        """
+        return fidelity(self.matrix, target)
+
+    def fidelity_gradient(self, target):
+        """
+        Fidelity to a target unitary and its gradient with respect to every phase,
+        in one forward and one backward sweep (see Engine.fidelity_gradient).
+
+        Returns
+        -------
+        tuple
+            (fidelity, keys, grad), keys as in jacobian and grad of shape (len(keys),)
+        """
+        if len(self._blocks) == 0:
+            return fidelity_gradient(self._own, self.width, target, self._fresh_block)
+        return fidelity_gradient(self._placed(), self.width, target, self._shared_block())
 
     def copy(self):
+        """
+        Copy of the Circuit sharing its devices until either of them changes.
+        """
         Circ = Circuit()
-        Circ._devices = [copy.deepcopy(d) for d in self._devices]
+        Circ._compose(self._freeze(), 0, 0)
         return Circ
 
     def multiple(self, other):
         """
         Multiple Circuit in series.
+        The first column of other is placed right after the last column of self.
 
         >>> C1 = Circuit()
         >>> C1.add(Waveguide(dom=2))
         >>> C2 = Circuit()
         >>> C2.add(MZI(theta=1))
         >>> C3 = C1.multiple(C2)
-        >>> print(C3.matrix)
-        # >>> assert np.allclose(C3.matrix, [[1,1],[1,1]] )
+        >>> assert C3.addrs == [(1, 1), (2, 1)]
+        >>> assert np.allclose(C3.matrix[1:, 1:], MZI(theta=1).matrix)
         """
         if isinstance(other, Circuit) is not True:
             raise TypeError('Circuit can only be merged with Circuit.')
-        Circ = Circuit()
-        Circ._devices += copy.deepcopy(self._devices)
-        other_devices = copy.deepcopy(other._devices)
-        for d in other_devices:
-            d.x += self.depth
-        Circ._devices += other_devices
+        Circ = self.copy()
+        dx = self.depth + 1 - other.xmin if not self._empty and not other._empty else 0
+        Circ._compose(other._freeze(), int(dx), 0)
         return Circ
 
     def stack(self, other):
@@ -530,16 +1258,12 @@ class Circuit:
         >>> C2 = Circuit()
         >>> C2.add(PhaseShifter(phase=0))
         >>> C3 = C1.stack(C2)
-        >>> assert np.allclose(C3.matrix, np.diag([1,1,1]))
+        >>> assert np.allclose(C3.matrix, np.eye(C3.width))
         """
         if isinstance(other, Circuit) is not True:
             raise TypeError('Circuit can only be merged with Circuit.')
-        Circ = Circuit()
-        Circ._devices += copy.deepcopy(self._devices)
-        other_devices = copy.deepcopy(other._devices)
-        for d in other_devices:
-            d.y += self.width
-        Circ._devices += other_devices
+        Circ = self.copy()
+        Circ._compose(other._freeze(), 0, self.width)
         return Circ
 
     def __rshift__(self, other):
@@ -552,6 +1276,7 @@ class Circuit:
         return self.stack(other)
 
     def plot(self, label='address'):
+        import matplotlib.pyplot as plt
         _, ax = plt.subplots()
         if label == 'address':
             ax = plot_address(self, ax)
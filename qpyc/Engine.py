@@ -0,0 +1,408 @@
+import numpy as np
+import sys
+import multiprocessing
+import mmap
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# array module of the numeric kernels, see set_backend
+_backend = {'name': 'numpy', 'xp': np}
+
+def set_backend(name):
+    """Select the array module of the numeric kernels, 'numpy' or 'jax'
+
+    The kernels are the closed-form device matrices (Device.mzi_matrices, ...), the
+    column updates and the circuit evaluations of this module. jax is imported on first
+    use, with 64-bit floats enabled, so that the kernels can be traced, e.g. by jax.grad.
+    The caches of Circuit stay whatever the kernels return.
+
+    >>> set_backend('numpy')
+    >>> get_backend()
+    'numpy'
+    """
+    if name == 'numpy':
+        xp = np
+    elif name == 'jax':
+        import jax
+        jax.config.update('jax_enable_x64', True)
+        import jax.numpy as xp
+    else:
+        raise ValueError(f'Unknown backend {name}, should be numpy or jax.')
+    _backend.update(name=name, xp=xp)
+
+def get_backend():
+    """Name of the selected backend"""
+    return _backend['name']
+
+def backend():
+    """Array module of the selected backend"""
+    return _backend['xp']
+
+def pool_context():
+    """multiprocessing context of the parallel kernels
+
+    The workers are forked, unless jax is imported, as forking its threads may deadlock,
+    then they are spawned, which is cheap as qpyc imports its heavy dependencies lazily.
+    """
+    return multiprocessing.get_context('spawn' if 'jax' in sys.modules else None)
+
+def process_pool(processes):
+    """ProcessPoolExecutor of the parallel kernels, see pool_context"""
+    return ProcessPoolExecutor(processes, mp_context=pool_context())
+
+def assign(arr, index, value):
+    """arr[index] = value, in place for NumPy arrays and functional for jax arrays.
+    Returns the updated array, which callers should use."""
+    if isinstance(arr, np.ndarray):
+        arr[index] = value
+        return arr
+    return arr.at[index].set(value)
+
+def stack2(m00, m01, m10, m11):
+    """2 x 2 matrices of shape (..., 2, 2) from their broadcast entries"""
+    xp = backend()
+    m00, m01, m10, m11 = xp.broadcast_arrays(*(xp.asarray(m, dtype=complex) for m in (m00, m01, m10, m11)))
+    return xp.stack([xp.stack([m00, m01], axis=-1), xp.stack([m10, m11], axis=-1)], axis=-2)
+
+def columns(devices):
+    """Group devices into columns by their x coordinate
+
+    Parameters
+    ----------
+    devices : iterable
+        Components with valid addresses, or placements (x, y, Component)
+        for devices shared at another address
+
+    Returns
+    -------
+    list
+        list of (x, [(y, device)]) sorted by x, devices of a column keep their input order
+    """
+    cols = {}
+    for d in devices:
+        x, y, d = d if isinstance(d, tuple) else (d.x, d.y, d)
+        cols.setdefault(x, []).append((y, d))
+    return [(x, cols[x]) for x in sorted(cols)]
+
+def layers(devices):
+    """Group devices into columns by their x coordinate
+
+    Parameters
+    ----------
+    devices : iterable
+        Components with valid addresses
+
+    Returns
+    -------
+    list
+        list of (x, [devices]) sorted by x, devices of a column keep their input order
+
+    >>> from qpyc.Device import Waveguide
+    >>> [x for x, _ in layers([Waveguide(addr=[2, 0]), Waveguide(addr=[1, 0])])]
+    [1, 2]
+    """
+    return [(x, [d for _, d in col]) for x, col in columns(devices)]
+
+def block(d):
+    """Matrix of a device as a dom x dom array"""
+    return np.reshape(d.matrix, (d.dom, d.dom))
+
+def apply_right(mat, y, sub):
+    """Multiply a square block acting on rows y, y+1, ... on the right of mat, see assign.
+
+    Only the columns touched by the block are updated, O(N dom^2) instead of O(N^3).
+    """
+    rows = slice(y, y + sub.shape[-1])
+    return assign(mat, (..., rows), mat[..., rows] @ sub)
+
+def apply_right_many(mat, ys, blocks):
+    """Multiply K non-overlapping blocks of the same size on the right of mat, see assign.
+
+    All blocks of a column are applied in one strided update.
+
+    Parameters
+    ----------
+    mat : np.array
+        shape (..., N, N)
+    ys : array_like
+        first row of each block, shape (K,)
+    blocks : np.array
+        shape (K, dom, dom) or (..., K, dom, dom)
+    """
+    dom = blocks.shape[-1]
+    rows = np.asarray(ys)[:, None] + np.arange(dom)
+    xp = backend()
+    cols = xp.moveaxis(mat[..., rows], -2, -3)
+    return assign(mat, (..., rows), xp.moveaxis(cols @ blocks, -3, -2))
+
+def apply_left(fields, y, sub):
+    """Multiply a square block acting on rows y, y+1, ... on the left of fields, see assign.
+
+    fields has shape (N,) or (N, B), only the rows of the block are updated.
+    """
+    rows = slice(y, y + sub.shape[-1])
+    return assign(fields, rows, sub @ fields[rows])
+
+def apply_left_many(fields, ys, blocks):
+    """Multiply K non-overlapping blocks of the same size on the left of fields, see assign.
+
+    Parameters
+    ----------
+    fields : np.array
+        shape (N,) or (N, B)
+    ys : array_like
+        first row of each block, shape (K,)
+    blocks : np.array
+        shape (K, dom, dom)
+    """
+    dom = blocks.shape[-1]
+    rows = np.asarray(ys)[:, None] + np.arange(dom)
+    sub = fields[rows].reshape(len(rows), dom, -1)
+    return assign(fields, rows, (blocks @ sub).reshape(fields[rows].shape))
+
+def layered_matrix(devices, width, block=block):
+    """Circuit matrix evaluated column by column
+
+    Each device only updates its own ports, so the cost is O(N) per device
+    and O(N^3) for a full mesh.
+
+    Parameters
+    ----------
+    devices : iterable
+        Components with valid addresses, or placements (x, y, Component)
+    width : int
+        circuit width
+    block : callable, optional
+        returns the dom x dom matrix of a device, by default block
+
+    Returns
+    -------
+    np.array
+        width x width matrix, identical to dense_matrix
+    """
+    mat = backend().eye(width, dtype=complex)
+    for _, col in columns(devices):
+        for y, d in col:
+            mat = apply_right(mat, y, block(d))
+    return mat
+
+def dense_matrix(devices, width):
+    """Reference evaluation embedding every device into a full width x width matrix.
+
+    Kept for tests and benchmarks, it costs O(N^3) per device.
+    """
+    mat = np.eye(width, dtype=np.complex_)
+    for _, col in layers(devices):
+        for d in col:
+            submat = np.eye(width, dtype=np.complex_)
+            submat[d.y:d.y+d.dom, d.y:d.y+d.dom] = block(d)
+            mat = np.matmul(mat, submat)
+    return mat
+
+def propagate(devices, fields, width, block=block):
+    """Apply the circuit to input fields without forming its matrix
+
+    The columns are streamed from the last to the first, so that the result
+    equals layered_matrix(devices, width) @ fields. Each device only touches
+    its own ports, O(dom^2 B) per device and O(N B) memory.
+
+    Parameters
+    ----------
+    devices : iterable
+        Components with valid addresses, or placements (x, y, Component)
+    fields : array_like
+        input amplitudes, shape (N,) or (N, B) with N the circuit width
+    width : int
+        circuit width
+    block : callable, optional
+        returns the dom x dom matrix of a device, by default block
+
+    Returns
+    -------
+    np.array
+        output amplitudes, same shape as fields
+    """
+    out = backend().array(fields, dtype=complex)
+    if out.ndim not in (1, 2) or out.shape[0] != width:
+        raise ValueError(f'Fields should have shape ({width},) or ({width}, B), got {out.shape}.')
+    for _, col in reversed(columns(devices)):
+        for y, d in reversed(col):
+            out = apply_left(out, y, block(d))
+    return out
+
+def derivatives(d):
+    """Derivatives of the device matrix with respect to its phases, {} if it has none"""
+    return d.derivatives() if hasattr(d, 'derivatives') else {}
+
+def _forward(cols, width, block):
+    """Forward sweep keeping the columns of the running product seen by every device with phases
+
+    Returns
+    -------
+    tuple
+        (matrix, [(x, [(y, device, product[:, rows] before the column)])])
+    """
+    mat = backend().eye(width, dtype=complex)
+    sweep = []
+    for x, col in cols:
+        seen = [(y, d, mat[:, y:y+d.dom].copy()) for y, d in col if hasattr(d, 'derivatives')]
+        sweep.append((x, seen))
+        for y, d in col:
+            mat = apply_right(mat, y, block(d))
+    return mat, sweep
+
+def jacobian(devices, width, block=block):
+    """Derivatives of the circuit matrix with respect to every phase
+
+    The matrix is P_x @ C_x @ S_x, with P_x/S_x the products of the columns before/after x,
+    so the derivative for a device on rows r is P_x[:, r] @ dD @ S_x[r, :].
+    P_x[:, r] are kept in a forward sweep, S_x is built in a backward sweep,
+    about two matrix evaluations plus writing the derivatives.
+
+    Parameters
+    ----------
+    devices : iterable
+        Components with valid addresses, or placements (x, y, Component)
+    width : int
+        circuit width
+    block : callable, optional
+        returns the dom x dom matrix of a device, by default block
+
+    Returns
+    -------
+    tuple
+        (keys, grads), keys is a list of ((x, y), name) in column order,
+        grads has shape (len(keys), width, width)
+    """
+    cols = columns(devices)
+    _, sweep = _forward(cols, width, block)
+    S = backend().eye(width, dtype=complex)
+    keys, grads = [], []
+    for (x, seen), (_, col) in zip(reversed(sweep), reversed(cols)):
+        for y, d, P in reversed(seen):
+            for name, dD in reversed(list(derivatives(d).items())):
+                keys.append(((x, y), name))
+                grads.append(P @ np.reshape(dD, (d.dom, d.dom)) @ S[y:y+d.dom, :])
+        for y, d in reversed(col):
+            S = apply_left(S, y, block(d))
+    grads = np.array(grads[::-1]).reshape(-1, width, width)
+    return keys[::-1], grads
+
+def fidelity(mat, target):
+    """Fidelity |Tr(target^dagger mat)|^2 / N^2 of a matrix to a target unitary"""
+    target = np.asarray(target)
+    return np.abs(np.trace(target.conj().T @ mat))**2 / target.shape[0]**2
+
+def fidelity_gradient(devices, width, target, block=block):
+    """Fidelity to a target unitary and its gradient with respect to every phase
+
+    With Q_x = S_x @ target^dagger built in the backward sweep, the derivative of
+    Tr(target^dagger M) for a device on rows r is Tr(Q_x[r, :] @ P_x[:, r] @ dD),
+    O(N dom^2) per device, so the gradient costs about two matrix evaluations.
+
+    Parameters
+    ----------
+    devices : iterable
+        Components with valid addresses, or placements (x, y, Component)
+    width : int
+        circuit width
+    target : array_like
+        target unitary, width x width
+    block : callable, optional
+        returns the dom x dom matrix of a device, by default block
+
+    Returns
+    -------
+    tuple
+        (fidelity, keys, grad), keys as in jacobian, grad of shape (len(keys),)
+    """
+    target = np.asarray(target)
+    if target.shape != (width, width):
+        raise ValueError(f'Target should have shape ({width}, {width}), got {target.shape}.')
+    cols = columns(devices)
+    mat, sweep = _forward(cols, width, block)
+    tr = np.trace(target.conj().T @ mat)
+    Q = backend().array(target.conj().T, dtype=complex)
+    keys, dtr = [], []
+    for (x, seen), (_, col) in zip(reversed(sweep), reversed(cols)):
+        for y, d, P in reversed(seen):
+            G = Q[y:y+d.dom, :] @ P
+            for name, dD in reversed(list(derivatives(d).items())):
+                keys.append(((x, y), name))
+                dtr.append(np.sum(G.T * np.reshape(dD, (d.dom, d.dom))))
+        for y, d in reversed(col):
+            Q = apply_left(Q, y, block(d))
+    grad = 2 * np.real(np.conj(tr) * np.array(dtr[::-1])) / width**2
+    return np.abs(tr)**2 / width**2, keys[::-1], grad
+
+def _chunk_worker(func, target, start, stop, args):
+    """Evaluate func on one chunk, write it into the file of target if any, else return it"""
+    if target is None:
+        return func(*args)
+    filename, offset, shape, dtype = target
+    out = np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=shape)
+    out[start:stop] = func(*args)
+    out.flush()
+
+def chunked(func, args, M, shape, dtype=np.complex_, chunk=None, processes=None, out=None):
+    """Evaluate func over the leading axis of args in chunks, stacking the results
+
+    Only one chunk of intermediates is alive per worker. With processes, the chunks
+    are spread over a process pool, func and args must then be picklable. The workers
+    write into out directly when it is a writable np.memmap of its own file, otherwise they
+    return their chunks, copied into out as they complete, with at most two chunks per
+    process in flight. Nothing is staged beyond out, so a np.memmap out keeps the memory bounded.
+
+    Parameters
+    ----------
+    func : callable
+        func(*args[start:stop]) returns an array of shape (stop - start,) + shape
+    args : tuple
+        arrays with leading axis M, None entries are passed as is
+    M : int
+        number of samples
+    shape : tuple
+        shape of one sample of the result
+    dtype : data-type, optional
+        by default np.complex_
+    chunk : int, optional
+        samples per chunk, by default all at once, or split evenly over processes
+    processes : int, optional
+        size of the process pool, by default evaluate in this process
+    out : np.array, optional
+        output of shape (M,) + shape, e.g. a np.memmap
+
+    Returns
+    -------
+    np.array
+        shape (M,) + shape
+    """
+    shape = (M,) + tuple(shape)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f'Output should have shape {shape}, got {out.shape}.')
+    if chunk is None:
+        chunk = max(-(-M // processes), 1) if processes else max(M, 1)
+    starts = range(0, M, chunk)
+    def part(start):
+        return tuple(a if a is None else a[start:start+chunk] for a in args)
+    if not processes:
+        for start in starts:
+            out[start:start+chunk] = func(*part(start))
+        return out
+    target = None
+    if isinstance(out, np.memmap) and isinstance(out.base, mmap.mmap) and out.flags.writeable and out.flags.c_contiguous:
+        out.flush()
+        target = (out.filename, out.offset, shape, out.dtype)
+    todo, pending = list(starts), {}
+    with process_pool(processes) as pool:
+        while len(todo) != 0 or len(pending) != 0:
+            while len(todo) != 0 and len(pending) < 2*processes:
+                start = todo.pop(0)
+                pending[pool.submit(_chunk_worker, func, target, start, min(start+chunk, M), part(start))] = start
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for job in done:
+                start, res = pending.pop(job), job.result()
+                if target is None:
+                    out[start:start+chunk] = res
+    return out
@@ -0,0 +1,130 @@
+import numpy as np
+from math import comb
+
+# dtype of occupation arrays, up to 255 photons per mode
+STATE = np.uint8
+
+def num_states(modes, photons):
+    """Number of occupations of photons in modes, C(modes + photons - 1, photons)"""
+    return comb(modes + photons - 1, photons)
+
+def _binom(modes, photons):
+    """Table C(t, r) for t <= modes + photons, r <= photons + 1, as int64"""
+    if num_states(modes, photons) >= 2**63:
+        raise ValueError(f'{photons} photons in {modes} modes can not be ranked with int64.')
+    return np.array([[comb(t, r) for r in range(photons + 2)] for t in range(modes + photons + 1)], dtype=np.int64)
+
+def patterns(states):
+    """Sorted mode indices of the photons of each state, the vectorized s2p
+
+    Parameters
+    ----------
+    states : array_like
+        occupations, shape (M, modes), with the same photon number
+
+    Returns
+    -------
+    np.array
+        shape (M, photons)
+
+    >>> patterns([[0, 2, 1], [1, 1, 1]]).tolist()
+    [[1, 1, 2], [0, 1, 2]]
+    """
+    states = np.asarray(states)
+    M, modes = states.shape
+    n = states.sum(axis=1)
+    if M and np.any(n != n[0]):
+        raise ValueError('States should have the same photon number.')
+    return np.repeat(np.tile(np.arange(modes), M), states.ravel().astype(np.int64)).reshape(M, -1)
+
+def states(patterns, modes):
+    """Occupations of sorted or unsorted mode indices, the vectorized p2s
+
+    Parameters
+    ----------
+    patterns : array_like
+        mode indices of the photons, shape (M, photons)
+    modes : int
+        number of modes
+
+    Returns
+    -------
+    np.array
+        shape (M, modes), dtype STATE
+    """
+    patterns = np.asarray(patterns, dtype=np.int64)
+    M, n = patterns.shape
+    out = np.zeros((M, modes), dtype=STATE)
+    np.add.at(out, (np.repeat(np.arange(M), n), patterns.ravel()), 1)
+    return out
+
+def rank(states):
+    """Dense index of occupations among all those with the same modes and photons
+
+    The states are ordered as their sorted patterns in lexicographic order, the order
+    of output_distribution, e.g. [2, 0], [1, 1], [0, 2]. Placing the k-th photon in a mode
+    v before the one of the pattern skips the C(modes - v + r - 1, r) completions of the
+    r = photons - k other photons, summed over v in closed form.
+
+    Parameters
+    ----------
+    states : array_like
+        occupations, shape (M, modes) or (modes,)
+
+    Returns
+    -------
+    np.array
+        int64 ranks, shape (M,) or ()
+
+    >>> rank([[2, 0], [1, 1], [0, 2]]).tolist()
+    [0, 1, 2]
+    """
+    states = np.asarray(states)
+    single = states.ndim == 1
+    states = np.atleast_2d(states)
+    modes = states.shape[1]
+    pat = patterns(states)
+    n = pat.shape[1]
+    C = _binom(modes, n)
+    prev = np.column_stack([np.zeros(len(pat), dtype=np.int64), pat[:, :-1]])
+    r = n - 1 - np.arange(n)
+    out = (C[modes - prev + r, r + 1] - C[modes - pat + r, r + 1]).sum(axis=1)
+    return out[0] if single else out
+
+def unrank(ranks, modes, photons):
+    """Occupations of dense indices, the inverse of rank
+
+    Parameters
+    ----------
+    ranks : array_like
+        integers in [0, num_states(modes, photons))
+    modes, photons : int
+
+    Returns
+    -------
+    np.array
+        shape (len(ranks), modes), dtype STATE
+
+    >>> unrank([0, 1, 2], 2, 2).tolist()
+    [[2, 0], [1, 1], [0, 2]]
+    """
+    ranks = np.atleast_1d(np.asarray(ranks, dtype=np.int64))
+    if np.any(ranks < 0) or np.any(ranks >= num_states(modes, photons)):
+        raise ValueError(f'Ranks should be in [0, {num_states(modes, photons)}).')
+    C = _binom(modes, photons)
+    rem = ranks.copy()
+    prev = np.zeros(len(ranks), dtype=np.int64)
+    pat = np.empty((len(ranks), photons), dtype=np.int64)
+    v = np.arange(modes)
+    for k in range(photons):
+        r = photons - 1 - k
+        # ranks skipped by choosing mode v, increasing in v and negative below prev
+        skip = C[modes - prev + r, r + 1][:, None] - C[modes - v + r, r + 1][None, :]
+        pat[:, k] = (skip <= rem[:, None]).sum(axis=1) - 1
+        rem -= skip[np.arange(len(ranks)), pat[:, k]]
+        prev = pat[:, k]
+    return states(pat, modes)
+
+def all_states(modes, photons):
+    """All occupations of photons in modes in rank order, shape (num_states, modes)"""
+    return unrank(np.arange(num_states(modes, photons)), modes, photons)
@@ -1,11 +1,315 @@
 import numpy as np
+import hashlib
+from collections import OrderedDict
 from qpyc.Device import Circuit, MZI
+from qpyc.Unitary import square_decomposition_right_batch
+from qpyc.Engine import backend, stack2, assign, process_pool, pool_context
+
+# decompositions kept by ClementsMesh.compile, least recently used first
+COMPILE_CACHE = OrderedDict()
+COMPILE_CACHE_SIZE = 256
+# unitaries equal after rounding to this step share a cache entry
+COMPILE_QUANTUM = 1e-12
+
+def unitary_key(U, quantum=COMPILE_QUANTUM):
+    """Hash of the unitary rounded to quantum, the key of COMPILE_CACHE"""
+    U = np.asarray(U, dtype=np.complex_)
+    q = np.round(np.stack([U.real, U.imag]) / quantum).astype(np.int64)
+    return U.shape[0], hashlib.sha1(q.tobytes()).hexdigest()
+
+# routing tables of route_table, shared by all meshes of a dimension
+ROUTE_CACHE = {}
+
+def _frozen(arr):
+    """Read-only array, shared by the routing tables"""
+    arr.setflags(write=False)
+    return arr
+
+def route_table(N):
+    """Routes of all MZIs of a N-mode Clements mesh, computed once per N in ROUTE_CACHE
+
+    The two diagonals through each MZI, y = x - x0 + y0 and y = -x + x0 + y0, are reflected
+    at the edges -1 and N of the mesh for all MZIs at once, see ClementsMesh.Route.
+
+    Returns
+    -------
+    dict
+        'paths': (K, 2, N) waveguide of both diagonals at every column, -1 at the edges,
+        'port_in', 'port_out': (K, 2) ports of both diagonals,
+        'route': list of the Route results indexed by order,
+        'ext': list of the RouteExt results indexed by order, None without both neighbours.
+        All arrays are read-only.
+    """
+    if N in ROUTE_CACHE:
+        return ROUTE_CACHE[N]
+    xy = clements_layout(N)
+    K = len(xy)
+    X = np.arange(N)
+    x0, y0 = xy[:, 0, None, None], xy[:, 1, None, None]
+    y = np.concatenate([X - x0 + y0, -X + x0 + y0], axis=1)
+    y = np.where(y < -1, -2 - y, np.where(y > N - 1, 2*N - 2 - y, y))
+    port_in = np.where(y[..., 1] - y[..., 0] == 1, y[..., 0], y[..., 0] + 1)
+    port_out = np.where(y[..., -1] - y[..., -2] == 1, y[..., -1] + 1, y[..., -1])
+    # waveguide numbers, avoiding N and -1
+    port_in, port_out = (np.clip(p, 0, N - 1) for p in (port_in, port_out))
+    valid = (y != N) & (y != -1)
+    paths = np.where(valid, y, -1)
+    coords = np.broadcast_to(np.stack([np.broadcast_to(X, y.shape), y], axis=-1), y.shape + (2,))
+    def split(mask):
+        """(x, y) arrays of mask for every MZI and diagonal, shape (K, 2) of arrays"""
+        counts = mask.sum(axis=2).ravel()
+        parts = np.split(coords[mask], np.cumsum(counts)[:-1])
+        return [[_frozen(parts[2*k]), _frozen(parts[2*k+1])] for k in range(K)]
+    ins = split(valid & (X < x0))
+    outs = split(valid & (X > x0))
+    port_in, port_out = _frozen(port_in), _frozen(port_out)
+    route = [(*ins[k], *outs[k], port_in[k], port_out[k]) for k in range(K)]
+    # RouteExt joins the inputs of the MZI (x-1, y-1) and the outputs of (x+1, y-1)
+    order = lambda x, y: (x*(N-1) + y)//2
+    has = lambda x, y: (0 <= x) & (x < N) & (0 <= y) & (y < N - 1)
+    left = np.where(has(xy[:, 0] - 1, xy[:, 1] - 1), order(xy[:, 0] - 1, xy[:, 1] - 1), -1)
+    right = np.where(has(xy[:, 0] + 1, xy[:, 1] - 1), order(xy[:, 0] + 1, xy[:, 1] - 1), -1)
+    ext = [None if l < 0 or r < 0 else route[l][:2] + route[r][2:4] + (route[l][4], route[r][5])
+           for l, r in zip(left.tolist(), right.tolist())]
+    ROUTE_CACHE[N] = {'paths': _frozen(paths), 'port_in': port_in, 'port_out': port_out,
+                      'route': route, 'ext': ext}
+    return ROUTE_CACHE[N]
+
+def _clements_terms(theta, phi, bias):
+    """exp(1j*phi), exp(+-1j*theta) and the sines and cosines of the two biased beam splitters"""
+    xp = backend()
+    theta = xp.asarray(theta, dtype=float)
+    bias = xp.asarray(bias, dtype=float)
+    ep = xp.exp(1j*xp.asarray(phi, dtype=float))
+    u, v = xp.exp(1j*theta), xp.exp(-1j*theta)
+    s0, c0 = xp.sin((0.25 + bias[..., 0]) * np.pi), xp.cos((0.25 + bias[..., 0]) * np.pi)
+    s1, c1 = xp.sin((0.25 + bias[..., 1]) * np.pi), xp.cos((0.25 + bias[..., 1]) * np.pi)
+    return ep, u, v, s0, c0, s1, c1
+
+def clements_matrices(theta, phi, bias=(0, 0)):
+    """ClementsMZI matrices for arrays of phases and biases, in closed form
+
+    Without bias, [[exp(1j*phi)*sin(theta), exp(1j*phi)*cos(theta)], [cos(theta), -sin(theta)]],
+    the 2x2 unitary of square_decomposition_right, theta and phi in radian.
+    It is -1j*exp(-1j*theta) diag(exp(1j*phi), 1) @ B(bias[0]) @ diag(exp(2j*theta), 1) @ B(bias[1])
+    with B the BeamSpiliter matrices (bs_matrices), biases in unit of pi as in MZI.
+
+    Parameters
+    ----------
+    theta, phi : array_like
+        shape (...)
+    bias : array_like, optional
+        shape (..., 2), by default (0, 0)
+
+    Returns
+    -------
+    np.array
+        shape (..., 2, 2), broadcast over all inputs
+
+    >>> assert np.allclose(clements_matrices(np.pi/2, 0), [[1, 0], [0, -1]])
+    >>> from qpyc.Device import bs_matrices
+    >>> t, p, b = .3, .2, np.array([.01, -.02])
+    >>> ref = -1j*np.exp(-1j*t) * np.diag([np.exp(1j*p), 1]) @ bs_matrices(b[0]) @ np.diag([np.exp(2j*t), 1]) @ bs_matrices(b[1])
+    >>> assert np.allclose(clements_matrices(t, p, b), ref)
+    """
+    ep, u, v, s0, c0, s1, c1 = _clements_terms(theta, phi, bias)
+    return stack2(-1j*ep*(s0*s1*u - c0*c1*v), ep*(s0*c1*u + c0*s1*v),
+                  c0*s1*u + s0*c1*v, -1j*(s0*s1*v - c0*c1*u))
+
+def clements_derivatives(theta, phi, bias=(0, 0)):
+    """Derivatives of clements_matrices with respect to theta and phi (in radian)
+
+    Returns
+    -------
+    tuple
+        (d/d theta, d/d phi), both of shape (..., 2, 2)
+
+    >>> t, p, b, e = .3, .2, [.01, -.02], 1e-6
+    >>> dt, dp = clements_derivatives(t, p, b)
+    >>> assert np.allclose(dt, (clements_matrices(t+e, p, b) - clements_matrices(t-e, p, b))/2/e)
+    >>> assert np.allclose(dp, (clements_matrices(t, p+e, b) - clements_matrices(t, p-e, b))/2/e)
+    """
+    ep, u, v, s0, c0, s1, c1 = _clements_terms(theta, phi, bias)
+    dt = stack2(ep*(s0*s1*u + c0*c1*v), 1j*ep*(s0*c1*u - c0*s1*v),
+                1j*(c0*s1*u - s0*c1*v), -(s0*s1*v + c0*c1*u))
+    mat = clements_matrices(theta, phi, bias)
+    dp = stack2(1j*mat[..., 0, 0], 1j*mat[..., 0, 1], 0, 0)
+    return dt, dp
+
+def _mesh_columns(placement):
+    """(k0, k1, y0) of each column of a layout, the MZIs of order k0 <= k < k1 on the pairs y0, y0 + 2, ..."""
+    x = placement[:, 0]
+    edges = np.concatenate([[0], np.flatnonzero(np.diff(x)) + 1, [len(x)]]).tolist()
+    return [(k0, k1, int(placement[k0, 1])) for k0, k1 in zip(edges[:-1], edges[1:])]
+
+def _right_column(mat, mats, k0, k1, y0):
+    """mat @ column, the column holding mats[..., k0:k1, :, :] on the pairs y0, y0 + 2, ..., see assign"""
+    top, bottom = slice(y0, y0 + 2*(k1 - k0), 2), slice(y0 + 1, y0 + 2*(k1 - k0), 2)
+    T = mats[..., None, k0:k1, :, :]
+    a, b = mat[..., top], mat[..., bottom]
+    # both new columns before writing, a and b are views of mat
+    new_a = a*T[..., 0, 0] + b*T[..., 1, 0]
+    new_b = a*T[..., 0, 1] + b*T[..., 1, 1]
+    mat = assign(mat, (..., top), new_a)
+    return assign(mat, (..., bottom), new_b)
+
+def _left_column(mat, mats, k0, k1, y0):
+    """column @ mat, the column holding mats[k0:k1] on the pairs y0, y0 + 2, ..., see _right_column"""
+    top, bottom = slice(y0, y0 + 2*(k1 - k0), 2), slice(y0 + 1, y0 + 2*(k1 - k0), 2)
+    T = mats[k0:k1, :, :, None]
+    a, b = mat[top], mat[bottom]
+    new_a = T[:, 0, 0]*a + T[:, 0, 1]*b
+    new_b = T[:, 1, 0]*a + T[:, 1, 1]*b
+    mat = assign(mat, top, new_a)
+    return assign(mat, bottom, new_b)
+
+def mesh_residuals(x, U, bias, cols):
+    """Residuals of a mesh to U and their Jacobian, for the fit of ClementsMesh.fit
+
+    The residuals are the real and imaginary parts of M diag(exp(1j*alpha)) - U, alpha the output
+    phases. For the MZIs of column x, M = P_x C_x S_x and the derivative of a MZI on the rows
+    (r, r + 1) is P_x[:, r:r+2] dT S_x[r:r+2, :], so the prefixes P_x of a forward sweep and the
+    suffixes S_x of a backward sweep give the whole Jacobian column by column.
+
+    Parameters
+    ----------
+    x : np.array
+        theta, phi then alpha, shape (2K + N,), in radian
+    U : np.array
+        N x N target
+    bias : np.array
+        shape (K, 2)
+    cols : list
+        columns of the layout, see _mesh_columns
+
+    Returns
+    -------
+    tuple
+        (residuals of shape (2N^2,), Jacobian of shape (2N^2, 2K + N), M)
+    """
+    N, K = len(U), len(bias)
+    theta, phi, alpha = x[:K], x[K:2*K], x[2*K:]
+    T = clements_matrices(theta, phi, bias)
+    dt, dp = clements_derivatives(theta, phi, bias)
+    mat = np.eye(N, dtype=np.complex_)
+    prefixes = []
+    for col in cols:
+        prefixes.append(mat.copy())
+        mat = _right_column(mat, T, *col)
+    out = np.exp(1j*alpha)
+    R = mat*out - U
+    J = np.zeros((2*K + N, N, N), dtype=np.complex_)
+    suffix = np.eye(N, dtype=np.complex_)
+    for (k0, k1, y0), P in zip(reversed(cols), reversed(prefixes)):
+        rows = y0 + 2*np.arange(k1 - k0)[:, None] + np.arange(2)
+        A, B = P[:, rows].transpose(1, 0, 2), suffix[rows]
+        J[k0:k1] = np.einsum('kia,kab,kbj->kij', A, dt[k0:k1], B)
+        J[K + k0:K + k1] = np.einsum('kia,kab,kbj->kij', A, dp[k0:k1], B)
+        suffix = _left_column(suffix, T, k0, k1, y0)
+    J[:2*K] *= out
+    J[2*K + np.arange(N), :, np.arange(N)] = 1j*R.T + 1j*U.T
+    J = J.reshape(len(J), -1).T
+    return np.concatenate([R.real.ravel(), R.imag.ravel()]), np.concatenate([J.real, J.imag]), mat
+
+def _fidelity(M, U):
+    """(sum_j |(M^dag U)_jj| / N)^2, the fidelity up to output phases"""
+    return (np.abs(np.einsum('ij,ij->j', M.conj(), U)).sum() / len(U))**2
+
+def _fit_start(x0, U, bias, cols, fidelity, maxiter, stop=None, stall=100):
+    """(x, F) of one start of ClementsMesh.fit, x holding theta and phi
+
+    Levenberg-Marquardt on mesh_residuals, the damping being a multiple of the identity since all
+    parameters are angles. It stops at the target fidelity, after maxiter steps, when the cost
+    decreased less than 0.1% over the last stall steps, e.g. for a target out of reach, or once
+    the event stop, shared by the starts of a process pool, is set.
+    """
+    K = len(bias)
+    M = mesh_residuals(np.concatenate([x0, np.zeros(len(U))]), U, bias, cols)[2]
+    # the best output phases of the start
+    x = np.concatenate([x0, np.angle(np.einsum('ij,ij->j', M.conj(), U))])
+    r, J, M = mesh_residuals(x, U, bias, cols)
+    cost, damping, history = r @ r, 1e-3, []
+    for _ in range(maxiter):
+        if _fidelity(M, U) >= fidelity or damping > 1e12 or (stop is not None and stop.is_set()):
+            break
+        history.append(cost)
+        if len(history) > stall and cost > (1 - 1e-3) * history[-stall - 1]:
+            break
+        step = np.linalg.solve(J.T @ J + damping * np.eye(len(x)), -J.T @ r)
+        r1, J1, M1 = mesh_residuals(x + step, U, bias, cols)
+        if r1 @ r1 < cost:
+            x, r, J, M, cost = x + step, r1, J1, M1, r1 @ r1
+            damping = max(damping / 3, 1e-15)
+        else:
+            damping *= 4
+    return x[:2*K], _fidelity(M, U)
+
+def clements_layout(N):
+    """Addresses of the MZIs of a N-mode Clements mesh, in order
+
+    Column x holds the MZIs on the pairs starting at y = x % 2, N columns in total.
+
+    Returns
+    -------
+    np.array
+        shape (N(N-1)/2, 2), (x, y) sorted by x then y, the k-th row being the MZI of order k
+
+    >>> clements_layout(3).tolist()
+    [[0, 0], [1, 1], [2, 0]]
+    """
+    x, y = np.meshgrid(np.arange(N), np.arange(N - 1), indexing='ij')
+    keep = (x % 2 == y % 2)
+    return np.column_stack([x[keep], y[keep]])
+
+def reck_layout(N):
+    """Addresses of the MZIs of a N-mode Reck (triangular) mesh, in order
+
+    Reck, Michael, et al. "Experimental realization of any discrete unitary operator."
+    Physical Review Letters 73.1 (1994): 58.
+
+    The MZIs fill the triangle y <= x, x + y <= 2N - 4 of 2N - 3 columns, with y = x (mod 2).
+
+    Returns
+    -------
+    np.array
+        shape (N(N-1)/2, 2), (x, y) sorted by x then y
+
+    >>> reck_layout(3).tolist()
+    [[0, 0], [1, 1], [2, 0]]
+    """
+    x, y = np.meshgrid(np.arange(max(2*N - 3, 0)), np.arange(N - 1), indexing='ij')
+    keep = (x % 2 == y % 2) & (y <= x) & (x + y <= 2*N - 4)
+    return np.column_stack([x[keep], y[keep]])
+
+LAYOUTS = {
+    'clements': clements_layout,
+    'reck': reck_layout,
+}
+
+def _placement(N, modes):
+    """Order index of every beam splitter of a decomposition
+
+    The beam splitters are placed column by column as early as their two modes allow,
+    on a column of the parity of their first mode, so that the product of the mesh
+    columns equals the product of the list.
+    """
+    last = [-1] * N
+    idx = np.empty(len(modes), dtype=np.int64)
+    for k, (m1, _) in enumerate(modes):
+        y = int(m1) - 1
+        x = max(last[y], last[y+1]) + 1
+        x += (x - y) % 2
+        last[y] = last[y+1] = x
+        idx[k] = (x*(N-1) + y)//2
+    if sorted(idx.tolist()) != list(range(len(modes))) or max(last) >= N:
+        raise ValueError('The beam splitters do not fit a Clements mesh.')
+    return idx
     
 class ClementsMZI(MZI):
     def __init__(self,
                  theta=0,
                  phi=0,
-                 bias=[0,0], 
+                 bias=None, 
                  addr=None,
                 #  convention = 'luu'
                  ) -> None:
@@ -14,7 +318,7 @@ class ClementsMZI(MZI):
         Args:
             theta (int, optional): _description_. Defaults to 0.
             phi (int, optional): _description_. Defaults to 0.
-            bias (_type_, optional): _description_. Defaults to ....
+            bias (_type_, optional): _description_. Defaults to (0, 0).
             addr (_type_, optional): _description_. Defaults to None.
         """        
         
@@ -23,13 +327,13 @@ class ClementsMZI(MZI):
     
     @property
     def matrix(self):
-        # ps_mat = []
-        mat = np.array([
-            [np.exp(np.j*self.phi)*np.cos(self.theta),   np.sin(self.theta)],
-            [np.exp(np.j*self.phi)*np.sin(self.theta),   np.cos(self.theta)], 
-            ], dtype=np.complex_)
-        # return super().matrix
-        return mat
+        """matrix of the MZI, see clements_matrices"""
+        return clements_matrices(self.theta, self.phi, self.bias)
+
+    def derivatives(self):
+        """Derivatives of matrix with respect to theta and phi (in radian)"""
+        dt, dp = clements_derivatives(self.theta, self.phi, self.bias)
+        return {'theta': dt, 'phi': dp}
 
     # @property
     # def clements_index(self):
@@ -44,32 +348,195 @@ class ClementsMesh(Circuit):
     Clements, William R., et al. "Optimal design for universal multiport interferometers." Optica 3.12 (2016): 1460-1465.
 
     Note the definition of 2x2 unitary is different from the original matrix.
-    In this package, it is defined as
+    In this package, it is the one of square_decomposition_right, theta and phi in radian
 
-    exp(j*phi)*cos(theta)   sin(theta)
-    exp(j*phi)*sin(theta)   cos(theta)
+    exp(j*phi)*sin(theta)   exp(j*phi)*cos(theta)
+    cos(theta)              -sin(theta)
+
+    The MZIs are generated at once from the index arrays of the layout and added by
+    Circuit.extend, in linear time.
 
     Parameters
     ----------
-    Circuit : _type_
-        _description_
+    dimension : int, optional
+        number of modes, by default 2
+    theta, phi : array_like, optional
+        initial phases in radian, of shape (N(N-1)/2,) indexed by order, by default 0
+    layout : str, optional
+        one of LAYOUTS, 'clements' or 'reck' (triangular), by default 'clements'
+
+    >>> M = ClementsMesh(4, theta=np.arange(6))
+    >>> assert len(M.devices) == 6 and M[(2, 2)].theta == M.order((2, 2)) == 4
     """
-    def __init__(self, dimension=2) -> None:
+    def __init__(self, dimension=2, theta=None, phi=None, layout='clements') -> None:
         super().__init__()
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown layout {layout}, should be one of {list(LAYOUTS)}.')
         self.dimension = dimension
-        for xx in range(self.dimension):
-            for yy in range(xx%2, self.dimension-1, 2):
-                self.add(ClementsMZI(addr=[xx, yy]))
+        self.layout = layout
+        # addresses of the MZIs in order
+        self.placement = LAYOUTS[layout](dimension)
+        K = len(self.placement)
+        theta = np.zeros(K) if theta is None else np.asarray(theta, dtype=float)
+        phi = np.zeros(K) if phi is None else np.asarray(phi, dtype=float)
+        if theta.shape != (K,) or phi.shape != (K,):
+            raise ValueError(f'theta and phi should have shape ({K},), got {theta.shape} and {phi.shape}.')
+        self.extend(ClementsMZI(t, p, addr=[x, y]) for (x, y), t, p in
+                    zip(self.placement.tolist(), theta.tolist(), phi.tolist()))
         self.N = self.width
 
         # hardware
         self.pin_array = None
 
+    def _phases(self, theta=None, phi=None, bias=None):
+        """theta, phi and bias of the MZIs indexed by order where not given"""
+        if theta is None or phi is None or bias is None:
+            devices = [self.devices[addr] for addr in map(tuple, self.placement.tolist())]
+            theta = [d.theta for d in devices] if theta is None else theta
+            phi = [d.phi for d in devices] if phi is None else phi
+            bias = [d.bias for d in devices] if bias is None else bias
+        return theta, phi, bias
+
+    def unitary(self, theta=None, phi=None, bias=None, chunk=32):
+        """
+        Mesh matrix for arrays of phases, using the fixed structure of the layout.
+
+        The MZIs of a column sit on the pairs y0, y0 + 2, ..., so each column is applied
+        as one 2x2 update of strided views of all its pairs, vectorized over a leading batch.
+        Equal to the matrix of the mesh with these phases.
+
+        Parameters
+        ----------
+        theta, phi : array_like, optional
+            phases in radian of shape (..., N(N-1)/2) indexed by order,
+            by default the phases of the MZIs
+        bias : array_like, optional
+            biases of shape (..., N(N-1)/2, 2), by default the biases of the MZIs
+        chunk : int, optional
+            matrices evaluated at once, small batches stay in cache, by default 32
+
+        Returns
+        -------
+        np.array
+            shape (..., N, N)
+
+        >>> M = ClementsMesh(5)
+        >>> theta, phi = np.random.default_rng(0).uniform(0, np.pi, (2, 3, 10))
+        >>> mats = M.unitary(theta, phi)
+        >>> M.compile(mats[1], program=True) and None
+        >>> assert mats.shape == (3, 5, 5) and np.allclose(M.matrix, M.unitary())
+        """
+        xp = backend()
+        K = len(self.placement)
+        theta, phi, bias = self._phases(theta, phi, bias)
+        theta, phi, bias = (xp.asarray(a, dtype=float) for a in (theta, phi, bias))
+        if theta.shape[-1:] != (K,) or phi.shape[-1:] != (K,) or bias.shape[-2:] != (K, 2):
+            raise ValueError(f'theta, phi and bias should have shape (..., {K}) and (..., {K}, 2), '
+                             f'got {theta.shape}, {phi.shape} and {bias.shape}.')
+        mats = clements_matrices(theta, phi, bias)
+        batch = mats.shape[:-3]
+        mats = mats.reshape((-1, K, 2, 2))
+        cols = _mesh_columns(self.placement)
+        out = []
+        for b0 in range(0, len(mats), chunk):
+            mat = xp.array(xp.broadcast_to(xp.eye(self.N, dtype=complex), (len(mats[b0:b0+chunk]), self.N, self.N)))
+            for col in cols:
+                mat = _right_column(mat, mats[b0:b0+chunk], *col)
+            out.append(mat)
+        mat = xp.concatenate(out) if len(out) != 0 else xp.zeros((0, self.N, self.N), dtype=complex)
+        return mat.reshape(batch + (self.N, self.N))
+
+    def fit(self, U, bias=None, starts=8, processes=None, fidelity=1 - 1e-10, maxiter=1000, seed=None, program=False):
+        """
+        Phases programming a unitary on the mesh with its beam splitter biases, by a numerical fit.
+
+        With biased beam splitters the phases of compile no longer give U. The phases and the output
+        phases are fitted by Levenberg-Marquardt on the residuals of mesh_residuals, with its analytic
+        Jacobian. The first start is the ideal compile (Clements layout), the others are random. The
+        starts stop once F = (sum_j |(M^dag U)_jj| / N)^2 reaches fidelity, and once a start reaches it
+        the pending ones are cancelled and the running ones stopped.
+
+        Parameters
+        ----------
+        U : array_like
+            N x N unitary
+        bias : array_like, optional
+            biases of shape (N(N-1)/2, 2) indexed by order, by default the biases of the MZIs
+        starts : int, optional
+            number of starting points, by default 8
+        processes : int, optional
+            run the starts in a process pool of this size, by default in this process
+        fidelity : float, optional
+            target fidelity, by default 1 - 1e-10
+        maxiter : int, optional
+            maximal number of Levenberg-Marquardt steps per start, by default 1000
+        seed : int, optional
+            seed of the random starts
+        program : bool, optional
+            set theta and phi of the MZIs, by default False
+
+        Returns
+        -------
+        tuple
+            (theta, phi, output_phases, F) as in compile, U ~ unitary(theta, phi, bias) @ diag(exp(1j*output_phases))
+
+        >>> M = ClementsMesh(4)
+        >>> U = M.unitary(*np.random.default_rng(1).uniform(0, np.pi, (2, 6)))
+        >>> theta, phi, phases, F = M.fit(U, bias=np.full((6, 2), .02), starts=2, seed=0)
+        >>> assert F > 1 - 1e-10
+        """
+        U = np.asarray(U, dtype=np.complex_)
+        K = len(self.placement)
+        if U.shape != (self.N, self.N):
+            raise ValueError(f'Unitary should have shape ({self.N}, {self.N}), got {U.shape}.')
+        bias = np.asarray(self._phases(0, 0, bias)[2], dtype=float)
+        if bias.shape != (K, 2):
+            raise ValueError(f'bias should have shape ({K}, 2), got {bias.shape}.')
+        rng = np.random.default_rng(seed)
+        x0 = list(rng.uniform(0, 2*np.pi, (starts, 2*K)))
+        if getattr(self, 'layout', 'clements') == 'clements' and starts != 0:
+            x0[0] = np.concatenate(self.compile(U)[:2])
+        args = (U, bias, _mesh_columns(self.placement), fidelity, maxiter)
+        best = None
+        if not processes:
+            for x in x0:
+                res = _fit_start(x, *args)
+                best = res if best is None or res[1] > best[1] else best
+                if best[1] >= fidelity:
+                    break
+        else:
+            from concurrent.futures import as_completed
+            with pool_context().Manager() as manager, process_pool(processes) as pool:
+                stop = manager.Event()
+                jobs = [pool.submit(_fit_start, x, *args, stop) for x in x0]
+                for job in as_completed(jobs):
+                    res = job.result()
+                    best = res if best is None or res[1] > best[1] else best
+                    if best[1] >= fidelity:
+                        stop.set()
+                        for j in jobs:
+                            j.cancel()
+                        break
+        if best is None:
+            raise ValueError('fit needs at least one start.')
+        x, F = best
+        theta, phi = np.mod(x[:K], 2*np.pi), np.mod(x[K:], 2*np.pi)
+        c = np.einsum('ij,ij->j', self.unitary(theta, phi, bias).conj(), U)
+        if program:
+            for addr, t, p in zip(map(tuple, self.placement.tolist()), theta, phi):
+                self.devices[addr].theta, self.devices[addr].phi = t, p
+        return theta, phi, np.angle(c), F
+
     def clements_idx(self, addr):
         """
         Convert the xy coordinates into the index using in clements coding, in the diagonal order.
+
+        The MZIs are numbered diagonal by diagonal (x + y = 0, 2, ...), from the top (largest y)
+        of each diagonal, from 0 to N(N-1)/2 - 1.
         """
-        return int(sum(addr)**2*.25 - addr[1])
+        x, y = addr
+        diag = lambda s: min(self.N - 2, s) - max(0, s - self.N + 1) + 1
+        return int(sum(diag(s) for s in range(0, x + y, 2)) + min(self.N - 2, x + y) - y)
 
     def order(self, addr):
         """
@@ -77,41 +544,90 @@ class ClementsMesh(Circuit):
         """
         # checkAddr(addr)
         x, y = addr
-        return int( ((x-1)*(self.N-1) + (y-1))//2 )
+        if getattr(self, 'layout', 'clements') == 'clements':
+            return int( (x*(self.N-1) + y)//2 )
+        k = int(np.searchsorted(self.placement[:, 0]*self.N + self.placement[:, 1], x*self.N + y))
+        if k == len(self.placement) or tuple(self.placement[k]) != (x, y):
+            raise ValueError(f'No MZI at {list(addr)} in the {self.layout} layout.')
+        return k
+
+    def compile(self, U, program=False):
+        """
+        Phases of the mesh implementing a unitary, decomposed by square_decomposition_right.
+
+        The 2x2 unitaries follow square_decomposition_right, theta and phi in radian.
+        Decompositions are kept in an LRU cache keyed by unitary_key(U), so repeated
+        programs are not decomposed again. Only finite phases are cached, a ValueError is raised otherwise.
+
+        Parameters
+        ----------
+        U : array_like
+            N x N unitary
+        program : bool, optional
+            set theta and phi of the MZIs, by default False
+
+        Returns
+        -------
+        tuple
+            (theta, phi, output_phases), theta and phi of shape (N(N-1)/2,) indexed by order,
+            output_phases of shape (N,) to apply after the mesh, such that
+            U = mesh matrix @ diag(exp(1j*output_phases))
+        """
+        U = np.asarray(U)
+        if getattr(self, 'layout', 'clements') != 'clements':
+            raise ValueError(f'compile needs the clements layout, got {self.layout}.')
+        if U.shape != (self.N, self.N):
+            raise ValueError(f'Unitary should have shape ({self.N}, {self.N}), got {U.shape}.')
+        if not np.all(np.isfinite(U)):
+            raise ValueError('Unitary should be finite.')
+        key = unitary_key(U)
+        if key in COMPILE_CACHE:
+            COMPILE_CACHE.move_to_end(key)
+        else:
+            BS, phases = square_decomposition_right_batch(U[None])
+            if not (np.all(np.isfinite(BS)) and np.all(np.isfinite(phases))):
+                raise ValueError('The decomposition of U is not finite, U should be a unitary.')
+            theta, phi = np.zeros(len(BS[0])), np.zeros(len(BS[0]))
+            idx = _placement(self.N, BS[0, :, :2])
+            theta[idx], phi[idx] = BS[0, :, 2], BS[0, :, 3]
+            COMPILE_CACHE[key] = (theta, phi, phases[0])
+            while len(COMPILE_CACHE) > COMPILE_CACHE_SIZE:
+                COMPILE_CACHE.popitem(last=False)
+        theta, phi, phases = (a.copy() for a in COMPILE_CACHE[key])
+        if program:
+            for addr, d in self.devices.items():
+                d.theta, d.phi = theta[self.order(addr)], phi[self.order(addr)]
+        return theta, phi, phases
+
+    def _route_index(self, dev_addr):
+        """Order of the MZI at dev_addr in the routing table"""
+        if getattr(self, 'layout', 'clements') != 'clements':
+            raise ValueError(f'Routes need the clements layout, got {self.layout}.')
+        if tuple(dev_addr) not in self.devices:
+            raise ValueError(f'No MZI at {list(dev_addr)}.')
+        return self.order(dev_addr)
 
     def Route(self, dev_addr):
         """
         Route the output port for a given phaseshifter
+
+        The routes of all MZIs are taken from route_table, computed once per dimension.
+
+        Returns
+        -------
+        tuple
+            (in1, in2, out1, out2, port_in, port_out), the (x, y) addresses on both diagonals
+            before and after the MZI as read-only arrays of shape (m, 2), and the ports of
+            both diagonals as arrays of shape (2,)
         """
-        assert tuple(dev_addr) in self.addrs
-        xx = range(self.N)
-        
-        # plot two guiding function
-        y1 = [ x - dev_addr[0] + dev_addr[1] for x in range(self.N) ]
-        y2 = [ -x + dev_addr[0] + dev_addr[1] for x in range(self.N) ]        
-        # get two parametric func
-        y1 = [ -2 - y if y <-1 else 2*self.N-2 - y if y > self.N-1 else y for y in y1]
-        y2 = [ -2 - y if y <-1 else 2*self.N-2 - y if y > self.N-1 else y for y in y2] 
-        # reflect the func 
-        r1 = [(x,y) for x,y in zip(xx, y1)]
-        r2 = [(x,y) for x,y in zip(xx, y2)]
-
-        # determine orientation
-        port_in = [ y[0] if y[1] - y[0] == 1 else y[0] + 1 for y in [y1, y2]]
-        port_out = [ y[-1] + 1 if y[-1] - y[-2] == 1 else y[-1]  for y in [y1, y2]]
-        # yield waveguide number to avoid N and -1
-        port_in = [ self.N-1 if i == self.N else 0 if i == -1 else i for i in port_in]
-        port_out = [ self.N-1 if i == self.N else 0 if i == -1 else i for i in port_out]
-
-        in1 = [ (x,y) for x,y in r1 if y != self.N and y != -1 and x < dev_addr[0]]
-        in2 = [ (x,y) for x,y in r2 if y != self.N and y != -1 and x < dev_addr[0]]
-        out1 = [ (x,y) for x,y in r1 if y != self.N and y != -1 and x > dev_addr[0]]
-        out2 = [ (x,y) for x,y in r2 if y != self.N and y != -1 and x > dev_addr[0]]
-        return in1, in2, out1, out2, port_in, port_out
-    
+        return route_table(self.N)['route'][self._route_index(dev_addr)]
+
     def RouteExt(self, dev_addr):
-        MZILeft = [dev_addr[0]-1, dev_addr[1]-1]
-        MZIRight = [dev_addr[0]+1, dev_addr[1]-1]
-        in1, in2, _, _, port_in, _  = self.Route(MZILeft)
-        _, _, out1, out2, _, port_out = self.Route(MZIRight)
-        return in1, in2, out1, out2, port_in, port_out
+        """
+        Route of the external phase of a MZI, through the inputs of the MZI at
+        (x-1, y-1) and the outputs of the MZI at (x+1, y-1), see Route.
+        """
+        route = route_table(self.N)['ext'][self._route_index(dev_addr)]
+        if route is None:
+            raise ValueError(f'MZI at {list(dev_addr)} has no neighbours at (x-1, y-1) and (x+1, y-1).')
+        return route
@@ -0,0 +1,384 @@
+import numpy as np
+from itertools import permutations, combinations
+from math import comb
+from qpyc.Engine import process_pool
+
+# Gray-code steps evaluated at once, the memory of a chunk is CHUNK x n
+CHUNK = 1 << 12
+
+def _gray_terms(base, vecs, k0, k1):
+    """v_k for k0 <= k < k1, shape (k1 - k0, len(base))
+
+    v_k = base + sum_i bit_i(g_k) vecs[i] with g_k = k ^ (k >> 1) the k-th Gray code.
+    The first sum is computed directly, the next ones by adding or removing the vector
+    of the single bit flipped at each step, all steps of the chunk in one cumulative sum.
+    """
+    g0 = k0 ^ (k0 >> 1)
+    bits = (g0 >> np.arange(len(vecs))) & 1
+    start = base + bits @ vecs
+    if k1 - k0 == 1:
+        terms = start[None, :]
+    else:
+        k = np.arange(k0 + 1, k1, dtype=np.int64)
+        j = np.log2(k & -k).astype(np.int64)     # the bit flipped at step k
+        new = ((k ^ (k >> 1)) >> j) & 1
+        steps = np.where(new, 1, -1)[:, None] * vecs[j]
+        terms = np.empty((k1 - k0, len(base)), dtype=steps.dtype)
+        terms[0] = start
+        np.cumsum(steps, axis=0, out=terms[1:])
+        terms[1:] += start
+    return terms
+
+def _gray_chunk(base, vecs, k0, k1):
+    """Sum of (-1)^k prod(v_k) for k0 <= k < k1, see _gray_terms
+
+    The sign (-1)^k is the parity of g_k, it alternates since one bit flips per step.
+    """
+    prods = np.prod(_gray_terms(base, vecs, k0, k1), axis=1)
+    sign = 1 - 2 * (k0 & 1)
+    return sign * (np.sum(prods[0::2]) - np.sum(prods[1::2]))
+
+def _gray_range(base, vecs, k0, k1, chunk=CHUNK):
+    """Sum of _gray_chunk over [k0, k1) in chunks"""
+    return sum(_gray_chunk(base, vecs, k, min(k + chunk, k1)) for k in range(k0, k1, chunk))
+
+def _gray_sum(base, vecs, chunk=CHUNK, processes=None):
+    """Sum over all 2^len(vecs) Gray codes, split over a process pool if processes"""
+    total = 1 << len(vecs)
+    if not processes or total <= chunk:
+        return _gray_range(base, vecs, 0, total, chunk)
+    # contiguous ranges, a multiple of chunk each
+    size = -(-total // processes // chunk) * chunk
+    with process_pool(processes) as pool:
+        jobs = [pool.submit(_gray_range, base, vecs, k, min(k + size, total), chunk)
+                for k in range(0, total, size)]
+        return sum(job.result() for job in jobs)
+
+def glynn(M, chunk=CHUNK, processes=None):
+    """Permanent by the Glynn formula in Gray-code order, O(2^n n)
+
+    perm(M) = 1/2^(n-1) sum_d (prod_k d_k) prod_j sum_i d_i M_ij over d in {1, -1}^n with d_0 = 1.
+    The row sums are updated by one row per Gray-code step, see _gray_chunk.
+
+    Parameters
+    ----------
+    M : array_like
+        n x n matrix
+    chunk : int, optional
+        Gray-code steps evaluated at once, by default CHUNK
+    processes : int, optional
+        split the 2^(n-1) terms over a process pool of this size, by default in this process
+    """
+    M = _square(M)
+    n = len(M)
+    if n == 0:
+        return M.dtype.type(1)
+    base = M.sum(axis=0)
+    return _gray_sum(base, -2 * M[1:], chunk, processes) / 2 ** (n - 1)
+
+def ryser(M, chunk=CHUNK, processes=None):
+    """Permanent by the Ryser formula in Gray-code order, O(2^n n)
+
+    perm(M) = (-1)^n sum_S (-1)^|S| prod_i sum_{j in S} M_ij over the column subsets S.
+    Parameters as in glynn.
+    """
+    M = _square(M)
+    n = len(M)
+    if n == 0:
+        return M.dtype.type(1)
+    base = np.zeros(n, dtype=M.dtype)
+    return (-1) ** n * _gray_sum(base, M.T.copy(), chunk, processes)
+
+def minors(B, chunk=CHUNK):
+    """Permanents of a (n-1) x n matrix with one column removed, for every column, O(2^n n)
+
+    The Glynn sums of the rows are shared by all minors, the product of the sums over
+    the other columns is taken from prefix and suffix products.
+
+    Parameters
+    ----------
+    B : array_like
+        (n-1) x n matrix
+    chunk : int, optional
+        Gray-code steps evaluated at once, by default CHUNK
+
+    Returns
+    -------
+    np.array
+        shape (n,), the l-th entry is perm(B without column l)
+
+    >>> B = np.arange(6).reshape(2, 3)
+    >>> assert np.allclose(minors(B), [brute(np.delete(B, l, axis=1)) for l in range(3)])
+    """
+    B = np.asarray(B)
+    B = B.astype(np.result_type(B.dtype, np.float64))
+    rows, n = B.shape
+    if rows != n - 1:
+        raise ValueError(f'Minors need a (n-1) x n matrix, got shape {B.shape}.')
+    if rows == 0:
+        return np.ones(n, dtype=B.dtype)
+    base, vecs = B.sum(axis=0), -2 * B[1:]
+    total = np.zeros(n, dtype=B.dtype)
+    for k0 in range(0, 1 << len(vecs), chunk):
+        terms = _gray_terms(base, vecs, k0, min(k0 + chunk, 1 << len(vecs)))
+        left = np.ones_like(terms)
+        right = np.ones_like(terms)
+        np.cumprod(terms[:, :-1], axis=1, out=left[:, 1:])
+        np.cumprod(terms[:, :0:-1], axis=1, out=right[:, -2::-1])
+        prods = left * right
+        sign = 1 - 2 * (k0 & 1)
+        total += sign * (prods[0::2].sum(axis=0) - prods[1::2].sum(axis=0))
+    return total / 2 ** (rows - 1)
+
+def brute(M):
+    """Permanent by the definition, O(n! n), for tests"""
+    M = _square(M)
+    n = len(M)
+    return sum(np.prod(M[np.arange(n), list(p)]) for p in permutations(range(n))) if n else M.dtype.type(1)
+
+def _square(M):
+    M = np.asarray(M)
+    M = M.astype(np.result_type(M.dtype, np.float64))
+    if M.ndim != 2 or M.shape[0] != M.shape[1]:
+        raise ValueError(f'Permanent needs a square matrix, got shape {M.shape}.')
+    return M
+
+# permanent backends, functions of (M, chunk, processes)
+BACKENDS = {
+    'glynn': glynn,
+    'ryser': ryser,
+    'brute': lambda M, chunk=CHUNK, processes=None: brute(M),
+}
+
+def permanent(M, backend='auto', chunk=CHUNK, processes=None):
+    """Permanent of a square matrix
+
+    Parameters
+    ----------
+    M : array_like
+        n x n matrix
+    backend : str, optional
+        one of BACKENDS, by default 'auto', closed forms up to n = 2 and glynn otherwise
+    chunk : int, optional
+        Gray-code steps evaluated at once, by default CHUNK
+    processes : int, optional
+        split the sum over a process pool of this size, by default in this process
+
+    Returns
+    -------
+    scalar
+        real for real matrices, complex otherwise
+
+    >>> permanent([[1, 2], [3, 4]])
+    10.0
+    >>> M = np.arange(16).reshape(4, 4)
+    >>> assert np.isclose(permanent(M), brute(M))
+    """
+    if backend == 'auto':
+        M = _square(M)
+        if len(M) == 0:
+            return M.dtype.type(1)
+        elif len(M) == 1:
+            return M[0, 0]
+        elif len(M) == 2:
+            return M[0, 0] * M[1, 1] + M[0, 1] * M[1, 0]
+        backend = 'glynn'
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown permanent backend {backend}, should be one of {list(BACKENDS)}.')
+    return BACKENDS[backend](M, chunk=chunk, processes=processes)
+
+def multiplicity(M, rows, cols, chunk=CHUNK):
+    """Permanent of M with row i repeated rows[i] times and column j repeated cols[j] times
+
+    Summing the Glynn formula over all signs, the terms only depend on the number k_i of
+    negative signs among the copies of row i, so that with n = sum(rows)
+
+    perm = 1/2^n sum_k prod_i (-1)^k_i C(rows_i, k_i) prod_j (sum_i (rows_i - 2 k_i) M_ij)^cols_j
+
+    with prod(rows + 1) terms instead of 2^(n-1), the gain is large for bunched states.
+
+    Parameters
+    ----------
+    M : array_like
+        r x s matrix of the distinct rows and columns
+    rows, cols : array_like
+        multiplicities, of length r and s, with sum(rows) == sum(cols)
+    chunk : int, optional
+        terms evaluated at once, by default CHUNK
+    """
+    M = np.asarray(M)
+    M = M.astype(np.result_type(M.dtype, np.float64))
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    if M.shape != (len(rows), len(cols)):
+        raise ValueError(f'Matrix of shape {M.shape} does not match multiplicities of length {len(rows)} and {len(cols)}.')
+    if rows.sum() != cols.sum():
+        raise ValueError(f'Multiplicities should have the same sum, got {rows.sum()} and {cols.sum()}.')
+    n = int(rows.sum())
+    if n == 0:
+        return M.dtype.type(1)
+    binom = [np.array([(-1)**k * comb(int(m), k) for k in range(m + 1)], dtype=float) for m in rows]
+    total = 0
+    count = int(np.prod(rows + 1))
+    for start in range(0, count, chunk):
+        k = np.stack(np.unravel_index(np.arange(start, min(start + chunk, count)), rows + 1), axis=1)
+        weight = np.prod([b[k[:, i]] for i, b in enumerate(binom)], axis=0)
+        sums = (rows - 2 * k) @ M
+        total += weight @ np.prod(sums ** cols, axis=1)
+    return total / 2 ** n
+
+def _cost(rows):
+    """Number of terms of multiplicity with these row multiplicities"""
+    return int(np.prod(np.asarray(rows, dtype=float) + 1))
+
+def fock_permanent(M, x, y, backend='auto', chunk=CHUNK, processes=None):
+    """Permanent of M with rows and columns taken from occupation vectors
+
+    Equal to permanent(M[s2p(x)][:, s2p(y)]). For bunched states, the multiplicity-aware
+    formula is used over the occupied rows or columns, whichever has fewer terms,
+    when it is cheaper than the plain 2^(n-1) Gray-code sum.
+
+    Parameters
+    ----------
+    M : array_like
+        N x N matrix
+    x, y : array_like
+        occupation vectors of the rows and columns, with sum(x) == sum(y)
+    backend : str, optional
+        'auto', 'multiplicity' or one of BACKENDS for the expanded matrix, by default 'auto'
+    chunk, processes : optional
+        see permanent
+
+    >>> M = np.arange(9).reshape(3, 3)
+    >>> assert np.isclose(fock_permanent(M, [2, 0, 1], [0, 3, 0]), brute(M[[0, 0, 2]][:, [1, 1, 1]]))
+    """
+    x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+    if x.sum() != y.sum():
+        raise ValueError(f'Occupations should have the same photon number, got {x.sum()} and {y.sum()}.')
+    M = np.asarray(M)
+    ix, iy = np.flatnonzero(x), np.flatnonzero(y)
+    sub, rows, cols = M[np.ix_(ix, iy)], x[ix], y[iy]
+    if _cost(cols) < _cost(rows):
+        sub, rows, cols = sub.T, cols, rows
+    n = int(x.sum())
+    if backend == 'auto':
+        # terms times their cost, O(r s) against O(n) for the Gray-code sum
+        backend = 'multiplicity' if _cost(rows) * len(rows) * len(cols) < 2 ** max(n - 1, 0) * n else 'permanent'
+    if backend == 'multiplicity':
+        return multiplicity(sub, rows, cols, chunk)
+    full = np.repeat(np.repeat(sub, rows, axis=0), cols, axis=1)
+    return permanent(full, 'auto' if backend == 'permanent' else backend, chunk, processes)
+
+def num_moves(n, order):
+    """Number of permutations of range(n) moving at most order points, len(moves(n, order))"""
+    der = [1, 0]
+    for j in range(2, n + 1):
+        der.append((j - 1) * (der[-1] + der[-2]))
+    return sum(comb(n, j) * der[j] for j in range(min(order, n) + 1))
+
+def moves(n, order):
+    """Permutations of range(n) moving at most order points, the identity first
+
+    Returns
+    -------
+    np.array
+        shape (T, n), T = sum_j C(n, j) D_j over j <= order, D_j the derangements of j points
+
+    >>> moves(3, 2).tolist()
+    [[0, 1, 2], [1, 0, 2], [2, 1, 0], [0, 2, 1]]
+    """
+    out = [np.arange(n)]
+    for j in range(2, min(order, n) + 1):
+        der = [p for p in permutations(range(j)) if all(p[i] != i for i in range(j))]
+        for A in combinations(range(n), j):
+            for p in der:
+                tau = np.arange(n)
+                tau[list(A)] = np.array(A)[list(p)]
+                out.append(tau)
+    return np.array(out, dtype=np.int64).reshape(-1, n)
+
+def _gram_exact(M, S, chunk=CHUNK):
+    """gram_permanent by a Glynn sum over both permutations, O(4^n n)
+
+    The sum runs over pairs of permutations of prod_j conj(M[rho(j), j]) S[rho(j), sigma(j)] M[sigma(j), j].
+    With the signs d of the Glynn sum over rho outside, the inner sum over sigma is the
+    permanent of G_d[b, j] = M[b, j] sum_a d_a conj(M[a, j]) S[a, b].
+    """
+    n = len(M)
+    total = 0
+    for k in range(1 << (n - 1)):
+        g = k ^ (k >> 1)
+        d = np.concatenate([[1], 1 - 2 * ((g >> np.arange(n - 1)) & 1)])
+        G = M * (S.T @ (d[:, None] * M.conj()))
+        total += (1 - 2 * (k & 1)) * glynn(G, chunk)
+    return total / 2 ** (n - 1)
+
+def gram_permanent(M, S, order=None, chunk=CHUNK, taus=None):
+    """Sum over permutations tau of prod_a S[a, tau(a)] perm(M[tau] * conj(M))
+
+    The probability weight of partially distinguishable photons, M being the rows of the
+    photons and the columns of the output, S their Gram matrix <psi_a|psi_b>. It equals
+    |perm(M)|^2 for S = 1 and perm(|M|^2) for S = I.
+
+    Truncated to the tau moving at most order photons, the error is of the order of the
+    off-diagonal |S|^(order + 1) (Renema et al., PRL 120, 220502 (2018)). The permanents
+    of all tau share the Glynn sums of the rows |M|^2 they leave in place: each Gray-code
+    step only adds the corrections of the moved rows, O(2^n n T) for the T = len(moves(n, order))
+    terms. The exact value uses a double Glynn sum, O(4^n n), also taken when it is cheaper.
+
+    Parameters
+    ----------
+    M : array_like
+        n x n matrix
+    S : array_like
+        n x n Gram matrix
+    order : int, optional
+        maximal number of moved photons, the cost knob, by default None, exact
+    chunk : int, optional
+        Gray-code steps evaluated at once, by default CHUNK
+    taus : array_like, optional
+        moves(n, order), to share the enumeration between calls
+
+    >>> M = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+    >>> [round(float(gram_permanent(M, [[1, s], [s, 1]]).real), 3) for s in (0, 0.5, 1)]
+    [0.5, 0.375, 0.0]
+    """
+    M = _square(M).astype(np.complex_)
+    S = np.asarray(S, dtype=np.complex_)
+    n = len(M)
+    if S.shape != (n, n):
+        raise ValueError(f'Gram matrix should have shape ({n}, {n}), got {S.shape}.')
+    if n == 0:
+        return np.complex_(1)
+    if order is None or order >= n or num_moves(n, order) >= 1 << (n - 1):
+        return _gram_exact(M, S, chunk)
+    return _gram_moves(M, S, moves(n, order) if taus is None else np.asarray(taus), chunk)
+
+def _gram_moves(M, S, taus, chunk=CHUNK):
+    """gram_permanent restricted to the permutations taus, see gram_permanent"""
+    n = len(M)
+    W = (M * M.conj())
+    weights = np.prod(S[np.arange(n), taus], axis=1)
+    # rows moved by each tau and the change of those rows from |M|^2
+    groups = {}
+    for t, tau in enumerate(taus):
+        groups.setdefault(int((tau != np.arange(n)).sum()), []).append(t)
+    corrections = []
+    for j, ts in groups.items():
+        A = np.array([np.flatnonzero(taus[t] != np.arange(n)) for t in ts], dtype=np.int64).reshape(len(ts), j)
+        delta = M[taus[ts][np.arange(len(ts))[:, None], A]] * M.conj()[A] - W[A]
+        corrections.append((A, delta, weights[ts]))
+    base, vecs = W.sum(axis=0), -2 * W[1:]
+    total, steps = 0, 1 << (n - 1)
+    batch = max(1, (1 << 16) // min(chunk, steps))
+    for k0 in range(0, steps, chunk):
+        k1 = min(k0 + chunk, steps)
+        k = np.arange(k0, k1, dtype=np.int64)
+        g = k ^ (k >> 1)
+        d = np.column_stack([np.ones(len(k)), 1 - 2 * ((g[:, None] >> np.arange(n - 1)) & 1)])
+        sign = 1 - 2 * (k & 1)
+        terms = _gray_terms(base, vecs, k0, k1)
+        for A, delta, w in corrections:
+            for t in range(0, len(A), batch):
+                corr = np.einsum('ktj,tjn->ktn', d[:, A[t:t+batch]], delta[t:t+batch])
+                total += sign @ np.prod(terms[:, None, :] + corr, axis=2) @ w[t:t+batch]
+    return total / 2 ** (n - 1)
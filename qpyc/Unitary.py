@@ -1,8 +1,11 @@
 from qpyc.Device import Circuit, MZI
 import numpy as np
 from math import factorial
+from collections.abc import MutableSequence
 
-from jax import jit
+from qpyc.Permanent import permanent, fock_permanent, minors, gram_permanent, moves, num_moves, CHUNK
+from qpyc.Engine import process_pool
+from qpyc.Fock import STATE, states as fock_states, all_states
 
 def p2s(pat, width):
     '''
@@ -10,7 +13,7 @@ def p2s(pat, width):
     eg [3,4] width 6 <=> [0,0,1,1,0,0]
     '''
     assert max(pat) <= width
-    return [pat.count(i) for i in range(width)]
+    return np.bincount(pat, minlength=width).tolist()
 
 
 def s2p(state):
@@ -18,39 +21,293 @@ def s2p(state):
     Convert state tp pattern number.
     eg [0,0,1,1,0,0] <=> [3,4] width 6  
     '''
-    ll = [[i]*state[i] for i in range(len(state)) if state[i] != 0]
-    return [i for l in ll for i in l]
+    return np.repeat(np.arange(len(state)), state).tolist()
 
-@jit
 def nnperm(M):
     """
-    Numpy code for computing the permanent of a matrix,
-    from https://github.com/scipy/scipy/issues/7151.
-    """
-    n = M.shape[0]
-    d = np.ones(n)
-    j = 0
-    s = 1
-    f = np.arange(n)
-    v = M.sum(axis=0)
-    p = np.prod(v)
-    while (j < n - 1):
-        v -= 2 * d[j] * M[j]
-        d[j] = -d[j]
-        s = -s
-        prod = np.prod(v)
-        p += s * prod
-        f[0] = 0
-        f[j] = f[j + 1]
-        f[j + 1] = j + 1
-        j = f[0]
-    return p / 2 ** (n - 1)
+    Permanent of a matrix, kept for compatibility, see Permanent.permanent.
+    """
+    return permanent(M)
 
 def samp(mat, x, y):
+    """
+    Amplitude of output occupation y for input occupation x,
+    perm(mat[s2p(x)][:, s2p(y)]) / sqrt(prod(x!) prod(y!)).
+    Bunched states use the multiplicity-aware permanent, see Permanent.fock_permanent.
+    """
     assert sum(x) == sum(y)
-    matrix = mat[s2p(x)][:, s2p(y)]
-    divisor = np.sqrt(np.prod([factorial(n) for n in x + y]))
-    return nnperm(matrix) / divisor
+    divisor = np.sqrt(np.prod([factorial(int(n)) for n in list(x) + list(y)], dtype=float))
+    return fock_permanent(mat, x, y) / divisor
+
+def _extend(cols, N):
+    """Column multisets of size k+1 extending sorted patterns cols (M, k) by one column >= the last
+
+    Returns
+    -------
+    tuple
+        (index of the prefix, new column), both of shape (M',), in lexicographic order
+    """
+    last = cols[:, -1] if cols.shape[1] else np.zeros(len(cols), dtype=np.int64)
+    counts = N - last
+    prefix = np.repeat(np.arange(len(cols)), counts)
+    starts = np.cumsum(counts) - counts
+    new = np.arange(counts.sum()) - np.repeat(starts, counts) + np.repeat(last, counts)
+    return prefix, new
+
+def _suboccupations(x):
+    """Occupations s <= x grouped by photon number
+
+    Returns
+    -------
+    tuple
+        (levels, pos), levels[k] is an array of shape (R_k, len(x)) of the s with sum(s) == k,
+        pos[code] is the index of s in its level, code = np.ravel_multi_index(s, x + 1)
+    """
+    subs = np.stack(np.unravel_index(np.arange(int(np.prod(x + 1))), x + 1), axis=1)
+    size = subs.sum(axis=1)
+    levels = [subs[size == k] for k in range(int(x.sum()) + 1)]
+    pos = np.empty(len(subs), dtype=np.int64)
+    for level in levels:
+        pos[np.ravel_multi_index(level.T, x + 1)] = np.arange(len(level))
+    return levels, pos
+
+def _expand(F, A, prefix, new, level, children):
+    """Laplace expansion along the new column, F'[p+c, s] = sum_i s_i A[i, c] F[p, s - e_i]"""
+    out = np.zeros((len(prefix), len(level)), dtype=np.complex_)
+    for i in range(A.shape[0]):
+        valid = level[:, i] > 0
+        if valid.any():
+            out[:, valid] += (A[i, new][:, None] * level[valid, i]) * F[prefix][:, children[valid, i]]
+    return out
+
+def _check(U, x):
+    """Unitary of U, which may be a Circuit, and input occupation as arrays"""
+    U = np.asarray(U.matrix if hasattr(U, 'matrix') else U)
+    x = np.asarray(x, dtype=np.int64)
+    N = len(x)
+    if U.shape != (N, N):
+        raise ValueError(f'Unitary should have shape ({N}, {N}), got {U.shape}.')
+    return U, x
+
+def output_distribution(U, x, stream=False, chunk=1 << 16):
+    """
+    Probabilities of all outputs with sum(x) photons for the input occupation x,
+    |perm(U[s2p(x)][:, s2p(y)])|^2 / (prod(x!) prod(y!)) as in samp.
+
+    The permanents share their work: the outputs are built column by column as sorted
+    patterns, and the permanents of every pattern prefix with every sub-occupation of
+    the input rows are kept for one level, the next level follows by Laplace expansion
+    along the new column. Outputs sharing a prefix share all the sub-permanents below it.
+
+    Parameters
+    ----------
+    U : array_like or Circuit
+        N x N unitary, or an object with a matrix property
+    x : array_like
+        input occupation of length N
+    stream : bool, optional
+        return a generator of blocks instead of the whole distribution, so that it can be
+        reduced on the fly, by default False. The prefixes are expanded depth first by blocks,
+        so that the memory in use grows with chunk and not with the number of outputs.
+    chunk : int, optional
+        rough number of outputs per block in stream mode
+
+    Returns
+    -------
+    tuple or generator
+        (states, probs), states of shape (M, N) and dtype Fock.STATE in rank order
+        (see Fock.rank), so that probs of shape (M,) is indexed by rank.
+        In stream mode, a generator of such blocks, in rank order.
+
+    >>> U = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+    >>> states, probs = output_distribution(U, [1, 1])
+    >>> states.tolist(), np.round(probs, 3).tolist()
+    ([[2, 0], [1, 1], [0, 2]], [0.5, 0.0, 0.5])
+
+    Top-k of a large distribution, reduced block by block
+
+    >>> best = max((p.max(), s[p.argmax()].tolist()) for s, p in output_distribution(U, [1, 1], stream=True))
+    """
+    U, x = _check(U, x)
+    blocks = _distribution(U, x, chunk)
+    if stream:
+        return blocks
+    states, probs = zip(*blocks)
+    return np.concatenate(states), np.concatenate(probs)
+
+def _distribution(U, x, chunk):
+    """Generator of (states, probs) blocks of output_distribution"""
+    N, n = len(x), int(x.sum())
+    if n == 0:
+        yield np.zeros((1, N), dtype=STATE), np.ones(1)
+        return
+    ix = np.flatnonzero(x)
+    A, occ = U[ix], x[ix]
+    levels, pos = _suboccupations(occ)
+    strides = np.array([int(np.prod(occ[i+1:] + 1)) for i in range(len(occ))], dtype=np.int64)
+    def children(k):
+        """Index of s - e_i at level k - 1 for every s of level k"""
+        codes = np.ravel_multi_index(levels[k].T, occ + 1)
+        return pos[np.clip(codes[:, None] - strides, 0, None)]
+    fact = np.array([factorial(k) for k in range(n + 1)], dtype=float)
+    norm = np.prod(fact[occ])
+    child = [None] + [children(k) for k in range(1, n + 1)]
+    # prefixes per block, so that a block of the last level holds about chunk outputs
+    step = max(chunk // N, 1)
+    parents = max(step // N, 1)
+    def descend(cols, F, k):
+        """Blocks below the prefixes cols of level k, depth first so that only one chain of blocks is alive"""
+        if k == n - 1:
+            for start in range(0, len(cols), step):
+                part = cols[start:start + step]
+                prefix, new = _extend(part, N)
+                perm = _expand(F[start:start + step], A, prefix, new, levels[n], child[n])[:, 0]
+                states = fock_states(np.column_stack([part[prefix], new]), N)
+                yield states, np.abs(perm)**2 / (norm * np.prod(fact[states], axis=1))
+            return
+        # a block of parents has at most step children
+        for start in range(0, len(cols), parents):
+            part = cols[start:start + parents]
+            prefix, new = _extend(part, N)
+            yield from descend(np.column_stack([part[prefix], new]),
+                               _expand(F[start:start + parents], A, prefix, new, levels[k + 1], child[k + 1]), k + 1)
+    yield from descend(np.zeros((1, 0), dtype=np.int64), np.ones((1, 1), dtype=np.complex_), 0)
+
+def _sample_block(A, count, seed):
+    """count output occupations by the Clifford & Clifford algorithm B
+
+    A[j, i] is the amplitude of photon i to output j. With the photons in random order,
+    output k is drawn from |sum_l A[j, l] perm(A[r, [0..k-1] without l])|^2 over j,
+    r being the outputs drawn so far, all the minors coming from one Glynn sum.
+    """
+    rng = np.random.default_rng(seed)
+    m, n = A.shape
+    patterns = np.empty((count, n), dtype=np.int64)
+    for c in range(count):
+        B = A[:, rng.permutation(n)]
+        r = []
+        for k in range(1, n + 1):
+            w = np.abs(B[:, :k] @ minors(B[r, :k]))**2
+            cum = np.cumsum(w)
+            r.append(min(int(np.searchsorted(cum, rng.random() * cum[-1], side='right')), m - 1))
+        patterns[c] = r
+    return fock_states(patterns, m)
+
+def boson_sampling(U, x, size=1, seed=None, processes=None, chunk=256):
+    """
+    Output occupations sampled for the input occupation x, by the Clifford & Clifford
+    algorithm with incremental sub-permanents, O(n 2^n) per sample instead of
+    enumerating the C(N+n-1, n) outputs.
+
+    Clifford, Peter, and Raphaël Clifford. "The classical complexity of boson sampling."
+    Proceedings of SODA 2018, 146-155.
+
+    Parameters
+    ----------
+    U : array_like or Circuit
+        N x N unitary, or an object with a matrix property such as Circuit or ClementsMesh
+    x : array_like
+        input occupation of length N
+    size : int, optional
+        number of samples, by default 1
+    seed : int or np.random.SeedSequence, optional
+        the samples are drawn in blocks of chunk samples, each with a seed spawned from it,
+        so that they do not depend on processes
+    processes : int, optional
+        spread the blocks over a process pool of this size, by default in this process
+    chunk : int, optional
+        samples per block, by default 256
+
+    Returns
+    -------
+    np.array
+        shape (size, N) and dtype Fock.STATE, output occupations, each row drawn with probability abs(samp(U, x, y))**2
+
+    >>> U = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+    >>> sorted({tuple(y) for y in boson_sampling(U, [1, 1], size=20, seed=0).tolist()})
+    [(0, 2), (2, 0)]
+    """
+    U, x = _check(U, x)
+    A = U[s2p(x.tolist())].T
+    seeds = np.random.SeedSequence(seed).spawn(-(-size // chunk))
+    counts = [min(chunk, size - k*chunk) for k in range(len(seeds))]
+    if not processes:
+        blocks = [_sample_block(A, c, s) for c, s in zip(counts, seeds)]
+    else:
+        with process_pool(processes) as pool:
+            blocks = list(pool.map(_sample_block, [A]*len(seeds), counts, seeds))
+    return np.concatenate(blocks) if blocks else np.zeros((0, len(x)), dtype=STATE)
+
+def _gram(S, x):
+    """Gram matrix of the photons of x as an array, and the norm of the input state"""
+    n = int(np.sum(x))
+    S = np.asarray(S, dtype=np.complex_)
+    if S.shape != (n, n):
+        raise ValueError(f'Gram matrix should have shape ({n}, {n}) for {n} photons, got {S.shape}.')
+    # photons sharing an input mode are symmetrized, prod(x!) for identical ones
+    edges = np.cumsum(np.concatenate([[0], np.asarray(x)[np.flatnonzero(x)]]))
+    norm = np.prod([permanent(S[a:b, a:b]).real for a, b in zip(edges[:-1], edges[1:])])
+    return S, norm
+
+def partial_distribution(U, x, gram, outputs=None, order=None, chunk=CHUNK):
+    """
+    Output probabilities for the input occupation x of partially distinguishable photons,
+
+    sum_tau prod_a gram[a, tau(a)] perm(M[tau] * conj(M)) / (prod(y!) norm), M = U[s2p(x)][:, s2p(y)],
+
+    norm being 1 for photons in distinct modes and prod(x!) for identical ones, see
+    Permanent.gram_permanent. A gram of ones gives abs(samp(U, x, y))**2, the identity
+    the probabilities of distinguishable photons.
+
+    The permutations tau and their weights are enumerated once and reused for all outputs.
+    order truncates the sum to the tau moving at most order photons, which trades accuracy
+    for speed when the photons are mostly distinguishable: the error is of the order of
+    the off-diagonal |gram|^(order + 1).
+
+    Parameters
+    ----------
+    U : array_like or Circuit
+        N x N unitary, or an object with a matrix property
+    x : array_like
+        input occupation of length N
+    gram : array_like
+        n x n Gram matrix <psi_a|psi_b> of the internal states of the n = sum(x) photons,
+        in the order of s2p(x)
+    outputs : array_like, optional
+        output occupations of shape (M, N), by default all of them in rank order (see Fock.rank)
+    order : int, optional
+        maximal number of moved photons, by default None, exact
+    chunk : int, optional
+        Gray-code steps evaluated at once
+
+    Returns
+    -------
+    tuple
+        (states, probs), states of shape (M, N) and dtype Fock.STATE, probs of shape (M,)
+
+    >>> U = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+    >>> states, probs = partial_distribution(U, [1, 1], [[1, 0.5], [0.5, 1]])
+    >>> np.round(probs, 3).tolist()
+    [0.312, 0.375, 0.312]
+    """
+    U, x = _check(U, x)
+    S, norm = _gram(gram, x)
+    N, n = len(x), int(x.sum())
+    states = all_states(N, n) if outputs is None else np.asarray(outputs, dtype=STATE).reshape(-1, N)
+    if np.any(states.sum(axis=1, dtype=np.int64) != n):
+        raise ValueError(f'Outputs should have {n} photons.')
+    fact = np.array([factorial(k) for k in range(n + 1)], dtype=float)
+    rows = U[s2p(x.tolist())]
+    taus = moves(n, order) if order is not None and order < n and num_moves(n, order) < 1 << (n - 1) else None
+    probs = np.array([gram_permanent(rows[:, s2p(y)], S, order, chunk, taus).real for y in states.tolist()])
+    return states, probs / (norm * np.prod(fact[states], axis=1))
+
+def partial_samp(mat, x, y, gram, order=None, chunk=CHUNK):
+    """
+    Probability of output occupation y for input occupation x of partially
+    distinguishable photons, see partial_distribution.
+    """
+    return partial_distribution(mat, x, gram, [y], order, chunk)[1][0]
 
 class Interferometer(object):
     """
@@ -60,49 +317,303 @@ class Interferometer(object):
     Clements, William R., et al. "Optimal design for universal multiport interferometers." Optica 3.12 (2016): 1460-1465.
     This transformation is parametrized by BS[2] (theta) which determines the beam splitter reflectivity, and by BS[3] (phi).
     The interferometer also contains a list of output phases described by output_phases.
+
+    The beam splitters are stored as arrays, modes (K, 2), theta (K,) and phi (K,),
+    BS_list is a list-like view of them.
+    With ext='right', U = T_1 T_2 ... T_K D as built by square_decomposition_right,
+    with ext='left', U = D T_K ... T_1, every beam splitter acting on the left.
     """
     
     def __init__(self, ext='right'):
         assert ext in ['right', 'left']
-        self.BS_list = []
-        self.output_phases = []
+        self._k = 0
+        # buffers with room for more beam splitters, the first _k are used
+        self._modes = np.zeros((16, 2), dtype=np.int64)
+        self._theta = np.zeros(16)
+        self._phi = np.zeros(16)
+        self._phases = np.zeros(0)
         self.ext = ext
+
+    @classmethod
+    def from_decomposition(cls, BS, output_phases, ext='right'):
+        """Interferometer of the (K, 4) rows [mode1, mode2, theta, phi] and output phases"""
+        I = cls(ext)
+        I.BS_list = BS
+        I._phases = np.array(output_phases, dtype=float)
+        return I
+
+    def __len__(self):
+        return self._k
+
+    @property
+    def modes(self):
+        """Labels of the two modes of the beam splitters, (K, 2) view of the stored array"""
+        return self._modes[:self._k]
+
+    @modes.setter
+    def modes(self, modes):
+        self._modes[:self._k] = modes
+
+    @property
+    def theta(self):
+        """theta of the beam splitters, (K,) view of the stored array"""
+        return self._theta[:self._k]
+
+    @theta.setter
+    def theta(self, theta):
+        self._theta[:self._k] = theta
+
+    @property
+    def phi(self):
+        """phi of the beam splitters, (K,) view of the stored array"""
+        return self._phi[:self._k]
+
+    @phi.setter
+    def phi(self, phi):
+        self._phi[:self._k] = phi
+
+    @property
+    def BS_list(self):
+        """Beam splitters as (mode1, mode2, theta, phi) tuples
+
+        This used to be a list. It is now a view of the arrays: appending, setting, inserting or
+        deleting beam splitters changes the interferometer, and assigning a sequence replaces all
+        of them. The items are tuples, a beam splitter is changed by assigning a new one.
+
+        >>> I = Interferometer()
+        >>> I.BS_list = [[1, 2, .5, 0]]
+        >>> I.BS_list.append([2, 3, .25, 1])
+        >>> I.BS_list[0] = (1, 2, .75, 0)
+        >>> list(I.BS_list), I.theta.tolist()
+        ([(1, 2, 0.75, 0.0), (2, 3, 0.25, 1.0)], [0.75, 0.25])
+        """
+        return _BeamSplitters(self)
+
+    @BS_list.setter
+    def BS_list(self, BS):
+        BS = np.asarray(BS, dtype=float).reshape(-1, 4)
+        self._k = len(BS)
+        self._modes, self._theta, self._phi = BS[:, :2].astype(np.int64), BS[:, 2].copy(), BS[:, 3].copy()
+
+    @property
+    def output_phases(self):
+        """Output phases as a float array, zero where not set
+
+        This used to be a list. It is now the backing array of the phases: items are set in
+        place (I.output_phases[m] = p) and assigning a sequence replaces all of them, but it
+        has no append, add_phase extends it.
+
+        >>> I = Interferometer()
+        >>> I.output_phases = [0, .5]
+        >>> I.output_phases[0] = .25
+        >>> I.add_phase([3, 1.])
+        >>> I.output_phases.tolist()
+        [0.25, 0.5, 1.0]
+        """
+        return self._phases
+
+    @output_phases.setter
+    def output_phases(self, phases):
+        self._phases = np.array(phases, dtype=float).reshape(-1)
         
     def add_BS(self,BS):
         """Use this to manually add a beam splitter at the output of the current interferometer"""
-        self.BS_list.append(BS)
+        if self._k == len(self._theta):
+            self._modes = np.concatenate([self._modes, np.zeros((max(self._k, 1), 2), dtype=np.int64)])
+            self._theta = np.concatenate([self._theta, np.zeros(max(self._k, 1))])
+            self._phi = np.concatenate([self._phi, np.zeros(max(self._k, 1))])
+        self._modes[self._k] = BS[0], BS[1]
+        self._theta[self._k], self._phi[self._k] = BS[2], BS[3]
+        self._k += 1
         
     def add_phase(self,phase):    
         """Use this to manually add a phase shift to a selected mode at the output of the interferometer"""
-        while phase[0] > np.size(self.output_phases) :
-            self.output_phases.append(0)
-        self.output_phases[phase[0]-1] = phase[1]
+        if phase[0] > len(self._phases):
+            self._phases = np.concatenate([self._phases, np.zeros(phase[0] - len(self._phases))])
+        self._phases[phase[0]-1] = phase[1]
     
     def n_modes(self):          
         """Calculate number of modes involved in the transformation. 
         This is required for unitary_transformation and draw_interferometer"""
-        list_modes = []
-        for BS in self.BS_list:
-            list_modes.append([BS[0],BS[1]])
-        return np.max(list_modes)
+        return int(np.max(self.modes))
 
-    
-    def unitary_transformation_right(self):       
-        """Calculate unitary matrix describing the transformation implemented by the interferometer"""
-        N = int(self.n_modes())
-        U = np.eye(N,dtype=np.complex_)
-        for BS in self.BS_list:
-            T = np.eye(N,dtype=np.complex_)
-            T[BS[0]-1,BS[0]-1] = np.exp(1j*BS[3])*np.sin(BS[2])
-            T[BS[0]-1,BS[1]-1] = np.exp(1j*BS[3])*np.cos(BS[2])
-            T[BS[1]-1,BS[0]-1] = np.cos(BS[2])
-            T[BS[1]-1,BS[1]-1] = -np.sin(BS[2])
-            U = np.matmul(U,T)
-        while np.size(self.output_phases) < N:      #Autofill for users who don't want to bother with output phases
-            self.output_phases.append(0)
-        D = np.diag(np.exp([1j*i for i in self.output_phases]))
-        U = np.matmul(U,D)           
-        return U
+    def _params(self, theta, phi, output_phases):
+        """Stored parameters where not given, as (B, K), (B, K) and (B, N) arrays"""
+        N = self.n_modes()
+        theta = self.theta if theta is None else np.asarray(theta, dtype=float)
+        phi = self.phi if phi is None else np.asarray(phi, dtype=float)
+        if output_phases is None:
+            #Autofill for users who don't want to bother with output phases
+            output_phases = np.concatenate([self._phases, np.zeros(max(N - len(self._phases), 0))])
+        output_phases = np.asarray(output_phases, dtype=float)
+        batch = [len(a) for a in (theta, phi, output_phases) if a.ndim == 2]
+        B = max(batch, default=1)
+        theta = np.broadcast_to(theta, (B, self._k))
+        phi = np.broadcast_to(phi, (B, self._k))
+        output_phases = np.broadcast_to(output_phases, (B, output_phases.shape[-1]))
+        return N, theta, phi, output_phases, len(batch) != 0
+
+    def unitary_transformation(self, theta=None, phi=None, output_phases=None):
+        """Unitary of the interferometer, see unitary_transformation_right and unitary_transformation_left"""
+        if self.ext == 'right':
+            return self.unitary_transformation_right(theta, phi, output_phases)
+        return self.unitary_transformation_left(theta, phi, output_phases)
+
+    def unitary_transformation_right(self, theta=None, phi=None, output_phases=None):       
+        """Calculate unitary matrix describing the transformation implemented by the interferometer
+
+        U = T_1 T_2 ... T_K D, every beam splitter only mixes two columns.
+
+        Parameters
+        ----------
+        theta, phi : array_like, optional
+            shape (K,) or (B, K) for a batch, by default the stored values
+        output_phases : array_like, optional
+            shape (N,) or (B, N), by default the stored values
+
+        Returns
+        -------
+        np.array
+            N x N, or (B, N, N) if any parameter has a batch axis
+        """
+        N, theta, phi, phases, batch = self._params(theta, phi, output_phases)
+        U = np.broadcast_to(np.eye(N, dtype=np.complex_), (len(theta), N, N)).copy()
+        s, c, e = np.sin(theta), np.cos(theta), np.exp(1j*phi)
+        for k, (m1, m2) in enumerate(self.modes - 1):
+            _rotate_cols(U, m1, m2, e[:, k]*s[:, k], c[:, k]+0j, e[:, k]*c[:, k], -s[:, k]+0j)
+        U *= np.exp(1j*phases)[:, None, :]
+        return U if batch else U[0]
+
+    def unitary_transformation_left(self, theta=None, phi=None, output_phases=None):
+        """Calculate unitary matrix describing the transformation implemented by the interferometer
+
+        U = D T_K ... T_1, every beam splitter only mixes two rows. Parameters as in unitary_transformation_right.
+        """
+        N, theta, phi, phases, batch = self._params(theta, phi, output_phases)
+        U = np.broadcast_to(np.eye(N, dtype=np.complex_), (len(theta), N, N)).copy()
+        s, c, e = np.sin(theta), np.cos(theta), np.exp(1j*phi)
+        for k, (m1, m2) in enumerate(self.modes - 1):
+            _rotate_rows(U, m1, m2, e[:, k]*s[:, k], e[:, k]*c[:, k], c[:, k]+0j, -s[:, k]+0j)
+        U *= np.exp(1j*phases)[:, :, None]
+        return U if batch else U[0]
+
+class _BeamSplitters(MutableSequence):
+    """Interferometer.BS_list, (mode1, mode2, theta, phi) tuples read from and written to the arrays"""
+
+    def __init__(self, interferometer):
+        self._I = interferometer
+
+    def __len__(self):
+        return self._I._k
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(len(self))[i]]
+        k = range(len(self))[i]
+        I = self._I
+        return (int(I._modes[k, 0]), int(I._modes[k, 1]), float(I._theta[k]), float(I._phi[k]))
+
+    def __setitem__(self, i, BS):
+        if isinstance(i, slice):
+            rows = list(self)
+            rows[i] = BS
+            self._I.BS_list = rows
+            return
+        k = range(len(self))[i]
+        I = self._I
+        I._modes[k] = BS[0], BS[1]
+        I._theta[k], I._phi[k] = BS[2], BS[3]
+
+    def __delitem__(self, i):
+        rows = list(self)
+        del rows[i]
+        self._I.BS_list = rows
+
+    def insert(self, i, BS):
+        if i >= len(self):
+            return self._I.add_BS(BS)
+        rows = list(self)
+        rows.insert(i, BS)
+        self._I.BS_list = rows
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+def _rotate_rows(U, r0, r1, a, b, c, d):
+    """Rows r0, r1 of the stack U become a U[r0] + b U[r1] and c U[r0] + d U[r1], in place"""
+    u0, u1 = U[:, r0, :].copy(), U[:, r1, :]
+    U[:, r0, :] = a[:, None]*u0 + b[:, None]*u1
+    U[:, r1, :] = c[:, None]*u0 + d[:, None]*u1
+
+def _rotate_cols(U, c0, c1, a, b, c, d):
+    """Columns c0, c1 of the stack U become a U[:, c0] + b U[:, c1] and c U[:, c0] + d U[:, c1], in place"""
+    u0, u1 = U[:, :, c0].copy(), U[:, :, c1]
+    U[:, :, c0] = a[:, None]*u0 + b[:, None]*u1
+    U[:, :, c1] = c[:, None]*u0 + d[:, None]*u1
+
+def _null_angles(num, den):
+    """theta = arctan(|num / den|) and num * conj(den), of the phase of num / den, without dividing
+
+    A zero entry gives theta = 0 or pi / 2, for which the element is nulled whatever phi,
+    the callers then take phi = 0, e.g. for identities and permutations.
+    """
+    return np.arctan2(np.abs(num), np.abs(den)), num * np.conj(den)
+
+def square_decomposition_right_batch(U):
+    """
+    square_decomposition_right for a stack of unitaries at once.
+
+    Every nulling step only mixes two rows or two columns, so it is applied in place,
+    O(N) per beam splitter and O(N^3) in total instead of a full N x N product each.
+
+    Parameters
+    ----------
+    U : array_like
+        shape (B, N, N)
+
+    Returns
+    -------
+    tuple
+        (BS, output_phases), BS of shape (B, N(N-1)/2, 4) with rows [mode1, mode2, theta, phi]
+        as in square_decomposition_right, output_phases of shape (B, N)
+    """
+    U = np.array(U, dtype=np.complex_)
+    B, N = U.shape[0], U.shape[-1]
+    BS = np.zeros((B, N*(N-1)//2, 4))
+    right_T = []
+    k = 0
+    for ii in range(N-1):
+        for jj in range(ii+1):
+            if np.mod(ii, 2) == 0:
+                # left, null U[ii-jj+1, N-jj-1] mixing rows
+                r0, r1, col = ii-jj, ii-jj+1, N-jj-1
+                theta, ratio = _null_angles(U[:, r1, col], U[:, r0, col])
+                phi = np.where(ratio != 0, -np.angle(-ratio), 0)
+                s, c, e = np.sin(theta), np.cos(theta), np.exp(-1j*phi)
+                _rotate_rows(U, r0, r1, e*s, c+0j, e*c, -s+0j)
+                BS[:, k] = np.column_stack([np.full(B, r0+1), np.full(B, r1+1), theta, phi])
+                k += 1
+            else:
+                # right, null U[jj, N+jj-ii-2] mixing columns
+                c0, c1 = N+jj-ii-2, N+jj-ii-1
+                theta, ratio = _null_angles(U[:, jj, c0], U[:, jj, c1])
+                phi = np.where(ratio != 0, -np.angle(ratio), 0)
+                s, c, e = np.sin(theta), np.cos(theta), np.exp(1j*phi)
+                _rotate_cols(U, c0, c1, e*s, c+0j, e*c, -s+0j)
+                right_T.append((c0, c1, theta, phi))
+    for c0, c1, theta, phi in right_T[::-1]:
+        s, c, e = np.sin(theta), np.cos(theta), np.exp(-1j*phi)
+        _rotate_cols(U, c0, c1, e*s, e*c, c+0j, -s+0j)
+        theta, ratio = _null_angles(U[:, c0, c0], U[:, c1, c0])
+        phi = np.where(ratio != 0, np.angle(ratio), 0)
+        s, c, e = np.sin(theta), np.cos(theta), np.exp(-1j*phi)
+        _rotate_rows(U, c0, c1, e*s, c+0j, e*c, -s+0j)
+        BS[:, k] = np.column_stack([np.full(B, c0+1), np.full(B, c1+1), theta, phi])
+        k += 1
+    return BS, np.angle(np.diagonal(U, axis1=1, axis2=2))
 
 def square_decomposition_right(U):
     """
@@ -111,65 +622,11 @@ def square_decomposition_right(U):
     Note here the 2x2 unitary is different from the one in paper, which is defined as 
     [np.exp(1j*phi)*np.sin(theta),  np.exp(1j*phi)*np.cos(theta)
      np.cos(theta),                 -np.sin(theta)              ]
+    The nulling steps are in-place two-row/two-column updates, see square_decomposition_right_batch.
     """
+    U = np.asarray(U)
     N = int(np.sqrt(U.size))
-    right_T = []
-    BS_list = []
-    for ii in range(N-1):
-        if np.mod(ii,2) == 0:
-            # left
-            for jj in range(ii+1):
-                modes = [ii-jj+1,ii+2-jj]
-                try:
-                    theta = np.arctan(np.abs(U[ii-jj+1,N-jj-1]/U[ii-jj,N-jj-1]))
-                except:
-                    theta = np.pi/2
-                try:
-                    phi = -np.angle(-U[ii-jj+1,N-jj-1]/U[ii-jj,N-jj-1])
-                except:
-                    phi = 0
-                invT = np.eye(N,dtype=np.complex_)
-                invT[modes[0]-1,modes[0]-1] = np.exp(-1j*phi)*np.sin(theta)
-                invT[modes[0]-1,modes[1]-1] = np.cos(theta)
-                invT[modes[1]-1,modes[0]-1] = np.exp(-1j*phi)*np.cos(theta)
-                invT[modes[1]-1,modes[1]-1] = -np.sin(theta)
-                U = np.matmul(invT,U)
-                BS_list.append([modes[0],modes[1],theta,phi])
-        else:
-            # right
-            for jj in range(ii+1):
-                modes = [N+jj-ii-1,N+jj-ii]
-                try:
-                    theta = np.arctan(np.abs(U[jj,N-ii+jj-2]/U[jj,N-ii+jj-1]))
-                except:
-                    theta = np.pi/2
-                try:
-                    phi = -np.angle(U[jj,N-ii+jj-2]/U[jj,N-ii+jj-1])
-                except:
-                    phi = 0
-                T = np.eye(N,dtype=np.complex_)
-                T[modes[0]-1,modes[0]-1] = np.exp(1j*phi)*np.sin(theta)
-                T[modes[0]-1,modes[1]-1] = np.exp(1j*phi)*np.cos(theta)
-                T[modes[1]-1,modes[0]-1] = np.cos(theta)
-                T[modes[1]-1,modes[1]-1] = -np.sin(theta)
-                U = np.matmul(U,T)
-                right_T.append([modes[0],modes[1],theta,phi])
-    for BS in np.flip(right_T,0):
-        modes = [int(BS[0]),int(BS[1])]
-        invT = np.eye(N,dtype=np.complex_)
-        invT[modes[0]-1,modes[0]-1] = np.exp(-1j*BS[3])*np.sin(BS[2])
-        invT[modes[0]-1,modes[1]-1] = np.cos(BS[2])
-        invT[modes[1]-1,modes[0]-1] = np.exp(-1j*BS[3])*np.cos(BS[2])
-        invT[modes[1]-1,modes[1]-1] = -np.sin(BS[2])
-        U = np.matmul(U,invT)
-        theta = np.arctan(np.abs(U[modes[0]-1,modes[0]-1]/U[modes[1]-1,modes[0]-1]))
-        phi = np.angle(U[modes[0]-1,modes[0]-1]/U[modes[1]-1,modes[0]-1])        
-        invT[modes[0]-1,modes[0]-1] = np.exp(-1j*phi)*np.sin(theta)
-        invT[modes[0]-1,modes[1]-1] = np.cos(theta)
-        invT[modes[1]-1,modes[0]-1] = np.exp(-1j*phi)*np.cos(theta)
-        invT[modes[1]-1,modes[1]-1] = -np.sin(theta)
-        U = np.matmul(invT,U)
-        BS_list.append([modes[0],modes[1],theta,phi])
-    phases = np.diag(U)
-    output_phases = [np.angle(i) for i in phases]
+    BS, phases = square_decomposition_right_batch(U.reshape(1, N, N))
+    BS_list = [[int(m1), int(m2), theta, phi] for m1, m2, theta, phi in BS[0]]
+    output_phases = list(phases[0])
     return BS_list, output_phases
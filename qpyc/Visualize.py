@@ -1,5 +1,3 @@
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 import numpy as np
 # from qpyc.Device import Circuit
 
@@ -37,6 +35,7 @@ def plot(Circ, ax):
         A plotted Axes with all elements
     """
     # assert type(Circ) is Circuit
+    import matplotlib.patches as patches
     WIDTH = Circ.depth * LX
     HEIGTH = Circ.width * LY 
 
@@ -0,0 +1,60 @@
+"""Scaling of Circuit.matrix, layered engine vs. the dense reference.
+
+python test/bench_matrix.py
+"""
+import time
+import numpy as np
+from qpyc.Device import Circuit, MZI
+from qpyc.Engine import dense_matrix
+from qpyc.Mesh import clements_layout, ClementsMesh
+
+def mesh(N):
+    C = Circuit()
+    C.extend([MZI(theta=np.random.rand(), phi=np.random.rand(), addr=[int(x), int(y)]) for x, y in clements_layout(N)])
+    return C
+
+def timeit(func, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+if __name__ == "__main__":
+    print(f'{"N":>5} {"MZIs":>7} {"layered (s)":>12} {"dense (s)":>12}')
+    for N in [8, 16, 32, 64, 128]:
+        C = mesh(N)
+        t_layer = timeit(lambda: C._invalidate() or C.matrix)
+        t_dense = timeit(lambda: dense_matrix(C._devices, C.width), repeat=1) if N <= 64 else np.nan
+        print(f'{N:>5} {len(C._devices):>7} {t_layer:>12.4f} {t_dense:>12.4f}')
+
+    # re-reading the matrix after tuning a single MZI
+    print(f'{"N":>5} {"full (s)":>12} {"tuning (s)":>12}')
+    for N in [16, 32, 64, 128]:
+        C = mesh(N)
+        mzi = C[(N//2, 0)]
+        C.matrix
+        t_full = timeit(lambda: C._invalidate() or C.matrix)
+        def tune():
+            mzi.theta = np.random.rand()
+            C.matrix
+        tune()
+        t_tune = timeit(tune, repeat=10)
+        print(f'{N:>5} {t_full:>12.4f} {t_tune:>12.6f}')
+
+    # ClementsMesh.unitary throughput at 32 modes, in unitaries per second of the best repeat.
+    # On one shared core of an Intel Xeon with OpenBLAS, over several runs: 550-1100/s for
+    # single calls, 1800-2700/s for batches of 32 to 2000 in chunks of 32, 1150-1400/s for
+    # 2000 unchunked. The 3300/s once quoted for batches of 2000 was not reproduced.
+    M = ClementsMesh(32)
+    K = len(clements_layout(32))
+    print(f'{"batch":>7} {"chunk":>7} {"unitaries/s":>12}')
+    for B in [1, 32, 256, 2000]:
+        for chunk in [32] if B <= 32 else [32, B]:
+            theta, phi = np.random.rand(B, K), np.random.rand(B, K)
+            if B == 1:
+                t = timeit(lambda: [M.unitary(th, ph) for th, ph in zip(theta, phi)], repeat=50)
+            else:
+                t = timeit(lambda: M.unitary(theta, phi, chunk=chunk))
+            print(f'{B:>7} {chunk:>7} {B/t:>12.0f}')
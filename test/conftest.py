@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from qpyc.Device import Circuit, MZI, PhaseShifter
+from qpyc.Mesh import clements_layout
+
+def random_mesh(N, seed=0, phases=True):
+    """Circuit of random biased MZIs in the Clements layout (Mesh.clements_layout)
+
+    With phases, a PhaseShifter sits on the free port of every column that has one.
+    """
+    rng = np.random.default_rng(seed)
+    layout = clements_layout(N)
+    C = Circuit()
+    for x in range(N):
+        ys = layout[layout[:, 0] == x, 1]
+        C.extend([MZI(theta=rng.random(), phi=rng.random(), bias=rng.normal(0, .01, 2), addr=[x, int(y)]) for y in ys])
+        free = sorted(set(range(N)) - set((ys[:, None] + [0, 1]).ravel().tolist()))
+        if phases and len(free) != 0:
+            C.add(PhaseShifter(phase=rng.random(), addr=[x, free[-1] if x % 2 == 0 else free[0]]))
+    return C
+
+@pytest.fixture
+def mesh_circuit():
+    """random_mesh, the random mesh circuit shared by the tests"""
+    return random_mesh
@@ -0,0 +1,108 @@
+import numpy as np
+from qpyc.Device import Component, Circuit, MZI, BeamSpiliter, Waveguide
+from qpyc.Array import ArrayCircuit, MZIView
+from qpyc.Mesh import ClementsMZI, ClementsMesh
+
+def circuit(mesh, N, seed=0):
+    """mesh(N, seed) followed by a BeamSpiliter, a Waveguide and a generic Component"""
+    C = mesh(N, seed)
+    C.add(BeamSpiliter(bias=.02, addr=[N, 0]), Waveguide(dom=3, addr=[N, 2]))
+    comp = Component(addr=[N+1, 1], dom=2)
+    comp.matrix = [[0, 1], [1, 0]]
+    C.add(comp)
+    return C
+
+def test_matrix(mesh_circuit):
+    C = circuit(mesh_circuit, 7)
+    A = ArrayCircuit.from_circuit(C)
+    assert len(A) == len(C._devices)
+    assert A.width == C.width and A.depth == C.depth and A.addrs == C.addrs
+    assert np.allclose(A.matrix, C.matrix)
+    assert np.allclose(A.to_circuit().matrix, C.matrix)
+
+def test_views(mesh_circuit):
+    C = circuit(mesh_circuit, 5)
+    A = ArrayCircuit.from_circuit(C)
+    mzi = A[(1, 1)]
+    assert isinstance(mzi, MZIView) and not hasattr(mzi, '__dict__')
+    assert mzi.phase == C[(1, 1)].phase and mzi.ports == [1, 2]
+    mzi.theta, mzi.bias = .2, [.01, .02]
+    C[(1, 1)].theta, C[(1, 1)].bias = .2, [.01, .02]
+    A[(0, 4)].phase = .7
+    C[(0, 4)].phase = .7
+    assert np.allclose(A.matrix, C.matrix)
+    B = A.copy()
+    B.remove((1, 1))
+    assert (1, 1) not in B.addrs and (1, 1) in A.addrs
+    try:
+        A[(0, 0)].y = 1
+        A.matrix
+        assert False
+    except Warning:
+        pass
+
+def test_plot(mesh_circuit):
+    A = ArrayCircuit.from_circuit(circuit(mesh_circuit, 5))
+    A.plot()
+    for addr in [(5, 0), (5, 2), (6, 1)]:
+        A.remove(addr)
+    A.plot(label='phase')
+
+def test_propagate(mesh_circuit):
+    A = ArrayCircuit.from_circuit(circuit(mesh_circuit, 7))
+    fields = np.random.default_rng(1).normal(size=(A.width, 5))
+    assert np.allclose(A.propagate(fields), A.matrix @ fields)
+    assert np.allclose(A.propagate(fields[:, 0]), A.matrix @ fields[:, 0])
+
+def test_matrix_batch(mesh_circuit, tmp_path):
+    C = circuit(mesh_circuit, 5)
+    A = ArrayCircuit.from_circuit(C)
+    rng = np.random.default_rng(1)
+    M = 7
+    theta = A.theta + rng.normal(0, .1, (M, len(A)))
+    bias = A.bias + rng.normal(0, .01, (M, len(A), 2))
+    mats = A.matrix_batch(theta=theta, bias=bias)
+    assert mats.shape == (M, A.width, A.width)
+    for m in range(M):
+        B = A.copy()
+        B.theta[:], B.bias[:] = theta[m], bias[m]
+        assert np.allclose(mats[m], B.to_circuit().matrix)
+    assert np.allclose(A.matrix_batch(theta=theta, bias=bias, chunk=3), mats)
+    assert np.allclose(A.matrix_batch(theta=theta, bias=bias, processes=2), mats)
+    # the workers write into a file-backed output, or return chunks copied into a view of it
+    out = np.memmap(tmp_path / 'mats', dtype=complex, mode='w+', shape=(M + 1, A.width, A.width))
+    assert A.matrix_batch(theta=theta, bias=bias, chunk=2, processes=2, out=out[:M]) is not None
+    assert np.allclose(out[:M], mats)
+    out = np.memmap(tmp_path / 'mats', dtype=complex, mode='w+', shape=(M, A.width, A.width))
+    A.matrix_batch(theta=theta, bias=bias, chunk=2, processes=2, out=out)
+    assert np.allclose(np.memmap(tmp_path / 'mats', dtype=complex, mode='r', shape=mats.shape), mats)
+    for d in C.devices.values():
+        if isinstance(d, MZI):
+            d.phi = 0
+    assert np.allclose(C.matrix_batch(phi=np.zeros((2, len(A))))[1], C.matrix)
+
+def test_save_load(mesh_circuit, tmp_path):
+    C = circuit(mesh_circuit, 5)
+    C.add(ClementsMZI(theta=.3, phi=.1, bias=[.01, -.02], addr=[7, 0]))
+    path = str(tmp_path / 'circ.qpyc')
+    C.save(path)
+    A = ArrayCircuit.load(path)
+    assert isinstance(A.theta, np.memmap)
+    D = Circuit.load(path)
+    assert type(D) is Circuit and D.addrs == C.addrs
+    for addr, d in C.devices.items():
+        e = D[addr]
+        assert type(e) is type(d) and e.dom == d.dom and e.addr == d.addr
+        assert vars(e).keys() == vars(d).keys()
+        for k in vars(d):
+            if k != '_circuits':
+                assert np.array_equal(vars(e)[k], vars(d)[k])
+    A[(0, 0)].theta = 0
+    assert ArrayCircuit.load(path)[(0, 0)].theta == C[(0, 0)].theta
+
+    M = ClementsMesh(5)
+    M[(1, 1)].theta = .4
+    M.save(path)
+    L = Circuit.load(path)
+    assert type(L) is ClementsMesh and L.dimension == 5 and L.N == M.N and L.pin_array is None
+    assert L.addrs == M.addrs and L[(1, 1)].theta == .4
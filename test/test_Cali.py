@@ -24,5 +24,27 @@ def test_calidata():
     pin_ma = np.ma.masked_not_equal(pins, -1).mask
     calidata_int['pin'] = pins
 
+def test_plan():
+    from qpyc.Cali import plan_calibration
+    from qpyc.Mesh import ClementsMesh, route_table
+    for N in (2, 5, 8):
+        mesh = ClementsMesh(N)
+        plan, total = plan_calibration(mesh)
+        assert sorted(map(tuple, plan['addr'].tolist())) == mesh.addrs
+        assert np.all(np.diff(plan['start']) > 0) and total > plan['start'][-1]
+        # the MZIs of the input path are calibrated first
+        seen = set()
+        for row in plan:
+            k = mesh.order(tuple(row['addr'].tolist()))
+            path = route_table(N)['route'][k][row['diagonal'][0]]
+            assert all(tuple(a) in seen for a in path.tolist() if a[1] <= N - 2)
+            assert row['port_in'] == route_table(N)['port_in'][k, row['diagonal'][0]]
+            seen.add(tuple(row['addr'].tolist()))
+        _, storage = plan_calibration(mesh, order=mesh.addrs, settle_time=.1)
+        assert total <= storage
+    mesh = ClementsCali(6, new_calidata(6))
+    plan, total = mesh.plan(sweep_time=0)
+    assert np.isclose(total, plan_calibration(ClementsMesh(6), sweep_time=0)[1])
+
 if __name__ == "__main__":
-    test_calidata()
\ No newline at end of file
+    test_calidata()
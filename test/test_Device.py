@@ -1,7 +1,12 @@
 import numpy as np
+import copy
+import pickle
 from qpyc.Device import Component, Waveguide, PhaseShifter, BeamSpiliter, MZI
-from qpyc.Device import Circuit
+from qpyc.Device import Circuit, mzi_matrices, bs_matrices, ps_matrices
+from qpyc.Engine import dense_matrix
+from scipy.stats import unitary_group
 import doctest
+import pytest
 
 W1 = Waveguide(dom=1)
 W2 = Waveguide(dom=2)
@@ -28,6 +33,193 @@ def test_circuit():
     C.add(BeamSpiliter(addr=(1,1)))
     C.plot()
 
+def test_batch_matrices():
+    rng = np.random.default_rng(1)
+    theta, phi, bias = rng.random(5), rng.random(5), rng.normal(0, .05, (5, 2))
+    mats = mzi_matrices(theta, phi, bias)
+    assert mats.shape == (5, 2, 2)
+    for m, t, p, b in zip(mats, theta, phi, bias):
+        mzi = PhaseShifter(p) @ Waveguide() >> BeamSpiliter(b[0]) >> PhaseShifter(t) @ Waveguide() >> BeamSpiliter(b[1])
+        assert np.allclose(m, mzi.matrix)
+        assert np.allclose(m, MZI(t, p, b).matrix)
+    assert np.allclose(bs_matrices(bias[:, 0])[2], BeamSpiliter(bias[2, 0]).matrix)
+    assert ps_matrices(theta).shape == (5, 1, 1)
+    assert PhaseShifter(.2).matrix.shape == (1, 1)
+
+def test_layered_matrix(mesh_circuit):
+    C = mesh_circuit(7)
+    mat = C.matrix
+    assert np.allclose(mat, dense_matrix(C._devices, C.width))
+    assert np.allclose(mat @ mat.conj().T, np.eye(C.width))
+
+def test_index(mesh_circuit):
+    C = mesh_circuit(7)
+    assert C.width == 7 and C.depth == 6
+    mzi = C[(2, 2)]
+    assert isinstance(mzi, MZI) and mzi in C
+    # ports overlap, not only identical addresses
+    try:
+        C.add(BeamSpiliter(addr=[2, 1]))
+        assert False
+    except Warning:
+        pass
+    try:
+        mzi.y = 3
+        assert False
+    except Warning:
+        assert C[(2, 2)] is mzi
+    C.remove(mzi)
+    mzi.addr = [7, 0]
+    C.add(mzi)
+    assert C[(7, 0)] is mzi and C.depth == 7
+    mzi.x = 8
+    assert C.addrs[-1] == (8, 0) and C.depth == 8
+    # the address only changes through the setters
+    with pytest.raises(TypeError):
+        mzi.addr[0] = 9
+    assert mzi.addr == (8, 0) and C[(8, 0)] is mzi
+    C.remove((8, 0))
+    assert mzi not in C and C.depth == 6
+    C2 = C.copy() >> C.copy()
+    assert C2.depth == 13 and len(C2.addrs) == 2*len(C.addrs)
+
+def test_incremental(mesh_circuit):
+    C = mesh_circuit(9, seed=2)
+    C.matrix
+    rng = np.random.default_rng(3)
+    for addr in [(4, 2), (4, 2), (4, 6), (1, 1), (8, 0)]:
+        d = C[addr]
+        if isinstance(d, MZI):
+            d.theta = rng.random()
+            d.phi = rng.random()
+        else:
+            d.phase = rng.random()
+        assert np.allclose(C.matrix, dense_matrix(C._devices, C.width))
+    # several columns at once, bias and moves
+    C[(2, 2)].bias = [.01, -.01]
+    C[(3, 3)].theta = .5
+    assert np.allclose(C.matrix, dense_matrix(C._devices, C.width))
+    C.remove((8, 0))
+    C[(7, 1)].x = 9
+    assert np.allclose(C.matrix, dense_matrix(C._devices, C.width))
+    C2 = C.copy()
+    C[(4, 2)].theta = .1
+    C2[(4, 2)].theta = .2
+    assert not np.allclose(C.matrix, C2.matrix)
+    assert np.allclose(C2.matrix, dense_matrix(C2._devices, C2.width))
+    # biases are only changed by assignment
+    with pytest.raises(TypeError):
+        C[(4, 2)].bias[0] = .1
+    assert MZI().bias == (0, 0) and MZI(bias=np.array([.1, .2])).bias == (.1, .2)
+
+def test_incremental_sweep(mesh_circuit, monkeypatch):
+    import qpyc.Device
+    C = mesh_circuit(9, seed=4)
+    C.matrix
+    rng = np.random.default_rng(4)
+    # tuning the MZIs one after another across the columns never evaluates the matrix again
+    monkeypatch.setattr(qpyc.Device, 'layered_matrix', None)
+    for addrs in (sorted(C.addrs), sorted(C.addrs, reverse=True), [(6, 2), (1, 1), (5, 3), (0, 0)]):
+        for addr in addrs:
+            if isinstance(C[addr], MZI):
+                C[addr].theta = rng.random()
+                assert np.allclose(C.matrix, dense_matrix(C._devices, C.width))
+
+def test_propagate(mesh_circuit):
+    C = mesh_circuit(9)
+    fields = np.random.default_rng(1).normal(size=(C.width, 4)) + 0j
+    assert np.allclose(C.propagate(fields), C.matrix @ fields)
+    assert np.allclose(C.propagate(fields[:, 0]), C.matrix @ fields[:, 0])
+    try:
+        C.propagate(fields[:-1])
+        assert False
+    except ValueError:
+        pass
+
+def test_compose_shared():
+    B = Circuit()
+    B.add(MZI(theta=.3, phi=.1, addr=[0, 0]), MZI(theta=.2, addr=[0, 2]), MZI(theta=.7, phi=.4, addr=[1, 1]))
+    C = B
+    for _ in range(999):
+        C = C >> B
+    assert C.depth == 1999
+    assert np.allclose(C.matrix, np.linalg.matrix_power(B.matrix, 1000))
+    # copy-on-write in both directions
+    C = B >> B
+    M = C.matrix
+    B[(0, 0)].theta = 1.2
+    assert np.allclose(C.matrix, M)
+    D = C.copy()
+    D[(2, 0)].theta = .9
+    assert C[(2, 0)].theta == .3 and np.allclose(C.matrix, M)
+    assert np.allclose(D.matrix, dense_matrix(D._devices, D.width))
+    S = B @ C
+    assert S.width == 8 and np.allclose(S.matrix[:4, :4], B.matrix) and np.allclose(S.matrix[4:, 4:], M)
+    assert np.allclose(S.propagate(np.eye(8)), S.matrix)
+
+
+def test_compose_lazy(mesh_circuit):
+    C = mesh_circuit(8)
+    D = C.copy() >> C.copy()
+    M = D.matrix
+    # reads use the shared blocks
+    assert len(D.addrs) == 2*len(C.addrs) and D.width == 8 and C[(0, 0)] not in D
+    assert pickle.loads(pickle.dumps(D)).addrs == D.addrs and len(D._own) == 0
+    P = PhaseShifter(.3, addr=[20, 0])
+    D.add(P)
+    assert len(D._own) == 1 and np.allclose(D.matrix[:, 0], M[:, 0]*P.matrix[0, 0])
+    # only the block looked up is copied, changes stay in the copy
+    P.phase = .5
+    d = D[(0, 0)]
+    assert len(D._own) == 1 + len(C.addrs) and len(D._blocks) == 1
+    assert np.allclose(D.matrix, dense_matrix(D._flat(), D.width))
+    U = C.matrix
+    d.theta = C[(0, 0)].theta + .1
+    assert d is not C[(0, 0)] and np.allclose(C.matrix, U)
+    assert np.allclose(D.matrix, dense_matrix(D._flat(), D.width))
+    D.remove(P)
+    assert D.depth == 15 and D.width == 8 and len(D._blocks) == 1
+    with pytest.raises(Warning):
+        D.add(BeamSpiliter(addr=[10, 3]))
+
+
+def test_compose_release(mesh_circuit):
+    C = mesh_circuit(8)
+    d, e = C[(0, 0)], C[(1, 1)]
+    for i in range(50):
+        D = C.copy()
+        e.theta = i/50
+    # only C and the snapshot D shares hold the devices
+    assert len(d._circuits) == 2 and len(e._circuits) == 1
+    del D
+    assert len(d._circuits) == 1
+    assert len(copy.deepcopy(d)._circuits) == 0
+
+
+def test_jacobian(mesh_circuit):
+    N, e = 5, 1e-6
+    C = mesh_circuit(N, 3)
+    keys, grads = C.jacobian()
+    assert len(keys) == grads.shape[0] == 2*len([d for d in C.devices.values() if isinstance(d, MZI)]) + \
+        len([d for d in C.devices.values() if isinstance(d, PhaseShifter)])
+    for (addr, name), g in zip(keys, grads):
+        d = C[addr]
+        val = getattr(d, name)
+        setattr(d, name, val + e)
+        plus = C.matrix
+        setattr(d, name, val - e)
+        minus = C.matrix
+        setattr(d, name, val)
+        assert np.allclose(g, (plus - minus)/2/e, atol=1e-6)
+
+    U = unitary_group.rvs(N, random_state=1)
+    F, fkeys, grad = C.fidelity_gradient(U)
+    assert fkeys == keys
+    assert np.isclose(F, C.fidelity(U))
+    tr = np.trace(U.conj().T @ C.matrix)
+    expected = 2*np.real(np.conj(tr)*np.einsum('ij,kji->k', U.conj().T, grads))/N**2
+    assert np.allclose(grad, expected)
+
 if __name__ == "__main__":
     # test_MZI()
     test_circuit()
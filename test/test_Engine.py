@@ -0,0 +1,22 @@
+import numpy as np
+from qpyc.Device import mzi_matrices, mzi_derivatives
+from qpyc.Engine import set_backend, get_backend, layered_matrix
+
+def test_backend(mesh_circuit):
+    ref = mesh_circuit(3).matrix
+    assert get_backend() == 'numpy'
+    set_backend('jax')
+    try:
+        import jax
+        import jax.numpy as jnp
+        C = mesh_circuit(3)
+        mat = C.matrix
+        assert isinstance(mat, jax.Array) and np.allclose(mat, ref)
+        C[(1, 1)].theta = .5
+        assert np.allclose(C.matrix, layered_matrix(C._own, C.width))
+        assert np.allclose(C.propagate(np.eye(3)), C.matrix)
+        grad = jax.grad(lambda t: jnp.real(mzi_matrices(t, .2)[0, 1]))(.3)
+        assert np.isclose(grad, np.real(mzi_derivatives(.3, .2)[0][0, 1]))
+    finally:
+        set_backend('numpy')
+    assert isinstance(mesh_circuit(3).matrix, np.ndarray)
@@ -0,0 +1,21 @@
+import numpy as np
+from itertools import product
+from qpyc.Fock import num_states, rank, unrank, all_states, patterns, states, STATE
+from qpyc.Unitary import p2s, s2p
+
+def test_rank():
+    for modes, photons in [(1, 3), (3, 0), (4, 3), (6, 4)]:
+        S = all_states(modes, photons)
+        assert S.dtype == STATE and len(S) == num_states(modes, photons)
+        brute = sorted((s2p(list(s)), list(s)) for s in product(range(photons + 1), repeat=modes) if sum(s) == photons)
+        assert S.tolist() == [s for _, s in brute]
+        assert np.array_equal(rank(S), np.arange(len(S)))
+        assert np.array_equal(unrank(rank(S[::-1]), modes, photons), S[::-1])
+    assert rank([0, 1, 1]) == rank([[0, 1, 1]])[0]
+
+def test_patterns():
+    S = all_states(5, 3)
+    P = patterns(S)
+    assert P.tolist() == [s2p(list(s)) for s in S]
+    assert np.array_equal(states(P, 5), S)
+    assert [p2s(p, 5) for p in P.tolist()] == S.tolist()
@@ -1,6 +1,10 @@
 import numpy as np
 import doctest
-from qpyc.Mesh import ClementsMesh
+from qpyc.Mesh import ClementsMesh, ClementsMZI, clements_layout, reck_layout, mesh_residuals, _mesh_columns
+from qpyc.Array import ArrayCircuit
+from qpyc.Device import Circuit, Waveguide
+import pytest
+from scipy.stats import unitary_group
 
 mesh = ClementsMesh(dimension=10) 
 d1 = mesh[0,2]
@@ -32,5 +36,113 @@ def test_route():
     print('Ports to enter from', ports_in)
     print('Ports to eixt from',  ports_out)
 
+    assert route_path_left_upper.tolist() == [[0, 2], [1, 3]] and ports_in.tolist() == [2, 4]
+    assert route_path_right_upper.tolist() == [[3, 3], [4, 2], [5, 1]] and ports_out.tolist() == [3, 1]
+    # the tables are shared by the meshes of a dimension
+    assert ClementsMesh(dimension=6).Route((2, 4))[0] is route_path_left_upper
+    in1, in2, out1, out2, port_in, port_out = mesh.RouteExt((2, 2))
+    assert in1.tolist() == [[0, 0]] and out1.tolist() == [[4, 2], [5, 3]] and port_out.tolist() == [4, 0]
+    with pytest.raises(ValueError):
+        mesh.RouteExt((0, 0))
+
+def test_compile():
+    from qpyc.Mesh import COMPILE_CACHE
+    for N in (2, 5, 6):
+        U = unitary_group.rvs(N, random_state=N)
+        mesh = ClementsMesh(N)
+        theta, phi, phases = mesh.compile(U, program=True)
+        assert len(theta) == len(mesh.devices) == N*(N-1)//2
+        mat = np.eye(N, dtype=complex)
+        for addr, d in mesh.devices.items():
+            t, p = theta[mesh.order(addr)], phi[mesh.order(addr)]
+            assert d.theta == t and d.phi == p
+            T = np.eye(N, dtype=complex)
+            T[addr[1]:addr[1]+2, addr[1]:addr[1]+2] = [[np.exp(1j*p)*np.sin(t), np.exp(1j*p)*np.cos(t)], [np.cos(t), -np.sin(t)]]
+            mat = mat @ T
+        assert np.allclose(mat @ np.diag(np.exp(1j*phases)), U)
+        size = len(COMPILE_CACHE)
+        assert all(np.array_equal(a, b) for a, b in zip(mesh.compile(U.copy()), (theta, phi, phases)))
+        assert len(COMPILE_CACHE) == size
+        # identities and permutations null zero entries
+        for P in (np.eye(N), np.eye(N)[::-1], np.roll(np.eye(N), 1, axis=0), -1j*np.eye(N)):
+            theta, phi, phases = mesh.compile(P)
+            assert np.all(np.isfinite(theta)) and np.all(np.isfinite(phi))
+            assert np.allclose(mesh.unitary(theta, phi) @ np.diag(np.exp(1j*phases)), P)
+        size = len(COMPILE_CACHE)
+        with pytest.raises(ValueError):
+            mesh.compile(np.full((N, N), np.nan))
+        assert len(COMPILE_CACHE) == size
+
+def test_layout():
+    for N in range(2, 9):
+        K = N*(N-1)//2
+        theta, phi = np.arange(K) * .1, np.arange(K) * .2
+        for layout in ('clements', 'reck'):
+            mesh = ClementsMesh(N, theta=theta, phi=phi, layout=layout)
+            assert len(mesh.devices) == K and mesh.N == N
+            for k, (addr, d) in enumerate(mesh.devices.items()):
+                assert mesh.order(addr) == k and d.theta == theta[k] and d.phi == phi[k]
+        # the same layout as adding the MZIs one by one
+        ref = ClementsMesh.__new__(ClementsMesh)
+        Circuit.__init__(ref)
+        for xx in range(N):
+            for yy in range(xx % 2, N-1, 2):
+                ref.add(ClementsMZI(addr=[xx, yy]))
+        assert ref.addrs == [tuple(a) for a in clements_layout(N).tolist()] == ClementsMesh(N).addrs
+    assert reck_layout(4).tolist() == [[0, 0], [1, 1], [2, 0], [2, 2], [3, 1], [4, 0]]
+    mesh = ClementsMesh(4)
+    with pytest.raises(Warning):
+        mesh.extend([Waveguide(addr=[5, 0]), Waveguide(dom=2, addr=[0, 3])])
+    assert len(mesh.devices) == 6 and mesh.width == 4
+    with pytest.raises(ValueError):
+        ClementsMesh(4, theta=np.zeros(5))
+
+def test_unitary():
+    rng = np.random.default_rng(8)
+    for layout in ('clements', 'reck'):
+        for N in (2, 5, 6):
+            K = N*(N-1)//2
+            theta, phi = rng.uniform(0, 2*np.pi, (2, 9, K))
+            mesh = ClementsMesh(N, theta=theta[4], phi=phi[4], layout=layout)
+            U = mesh.matrix
+            assert np.allclose(U @ U.conj().T, np.eye(N))
+            mats = mesh.unitary(theta.reshape(3, 3, K), phi.reshape(3, 3, K), chunk=2)
+            assert mats.shape == (3, 3, N, N) and np.allclose(mats[1, 1], U)
+            assert np.allclose(mesh.unitary(), U)
+            assert np.allclose(ArrayCircuit.from_circuit(mesh).matrix_batch(theta, phi)[4], U)
+            # analytic derivatives in radian
+            e = 1e-6
+            keys, grads = mesh.jacobian()
+            for ((x, y), name), grad in zip(keys, grads):
+                k = mesh.order((x, y))
+                t, p = theta[4].copy(), phi[4].copy()
+                (t if name == 'theta' else p)[k] += e
+                assert np.allclose(grad, (mesh.unitary(t, p) - U) / e, atol=1e-5)
+
+def test_fit():
+    rng = np.random.default_rng(9)
+    for layout in ('clements', 'reck'):
+        N, K = 5, 10
+        mesh = ClementsMesh(N, layout=layout)
+        bias = rng.normal(0, .02, (K, 2))
+        for addr, b in zip(map(tuple, mesh.placement.tolist()), bias):
+            mesh.devices[addr].bias = b
+        assert np.allclose(mesh.unitary(), mesh.matrix)
+        # analytic Jacobian of the residuals
+        x = rng.uniform(0, 2*np.pi, 2*K + N)
+        U = unitary_group.rvs(N, random_state=3)
+        r, J, M = mesh_residuals(x, U, bias, _mesh_columns(mesh.placement))
+        e = 1e-6
+        num = [(mesh_residuals(x + e*d, U, bias, _mesh_columns(mesh.placement))[0] - r) / e for d in np.eye(len(x))]
+        assert np.allclose(np.transpose(num), J, atol=1e-5)
+        # a target reachable with the biases
+        U = mesh.unitary(*rng.uniform(0, 2*np.pi, (2, K))) @ np.diag(np.exp(1j*rng.uniform(0, 2*np.pi, N)))
+        theta, phi, phases, F = mesh.fit(U, starts=3, seed=0, program=True)
+        assert F > 1 - 1e-10
+        assert np.allclose(mesh.unitary(theta, phi) @ np.diag(np.exp(1j*phases)), U, atol=1e-4)
+        assert np.allclose(mesh.matrix @ np.diag(np.exp(1j*phases)), U, atol=1e-4)
+    with pytest.raises(ValueError):
+        mesh.fit(np.eye(4))
+
 if __name__ == '__main__':
-    test_plot_phase()
\ No newline at end of file
+    test_plot_phase()
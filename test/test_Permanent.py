@@ -0,0 +1,63 @@
+import numpy as np
+from qpyc.Permanent import permanent, glynn, ryser, brute, multiplicity, fock_permanent, gram_permanent, moves, num_moves
+from itertools import permutations
+from qpyc.Unitary import samp, nnperm, s2p
+from math import factorial
+from scipy.stats import unitary_group
+
+def test_brute():
+    rng = np.random.default_rng(0)
+    for n in range(1, 8):
+        M = rng.normal(size=(n, n)) + 1j*rng.normal(size=(n, n))
+        ref = brute(M)
+        assert np.isclose(permanent(M), ref)
+        assert np.isclose(glynn(M, chunk=3), ref)
+        assert np.isclose(ryser(M, chunk=5), ref)
+    R = rng.normal(size=(5, 5))
+    assert np.isrealobj(permanent(R)) and np.isclose(permanent(R), brute(R))
+    assert permanent(np.zeros((0, 0))) == 1
+    assert np.isclose(nnperm(np.arange(16).reshape(4, 4)), brute(np.arange(16).reshape(4, 4)))
+
+def test_processes():
+    M = unitary_group.rvs(12, random_state=0)
+    assert np.isclose(glynn(M, chunk=64, processes=3), glynn(M))
+    assert np.isclose(permanent(M, backend='ryser', chunk=64, processes=2), glynn(M))
+
+def test_samp():
+    U = unitary_group.rvs(4, random_state=1)
+    x = [1, 1, 0, 0]
+    total = sum(abs(samp(U, x, [i, j, k, l]))**2
+                for i in range(3) for j in range(3) for k in range(3) for l in range(3) if i+j+k+l == 2)
+    assert np.isclose(total, 1)
+
+def test_multiplicity():
+    rng = np.random.default_rng(2)
+    U = unitary_group.rvs(5, random_state=2)
+    for x, y in [([3, 0, 2, 0, 0], [1, 1, 1, 1, 1]), ([2, 2, 0, 0, 1], [0, 4, 0, 1, 0]),
+                 ([1, 0, 1, 0, 0], [0, 0, 0, 2, 0]), ([0]*5, [0]*5)]:
+        full = U[s2p(x)][:, s2p(y)]
+        ref = brute(full)
+        for backend in ('auto', 'multiplicity', 'glynn'):
+            assert np.isclose(fock_permanent(U, x, y, backend=backend), ref)
+    M = rng.normal(size=(2, 3))
+    assert np.isclose(multiplicity(M, [4, 2], [1, 3, 2]), brute(np.repeat(np.repeat(M, [4, 2], 0), [1, 3, 2], 1)))
+    assert np.isclose(samp(U, [3, 0, 2, 0, 0], [1, 1, 1, 1, 1]),
+                      brute(U[[0, 0, 0, 2, 2]]) / np.sqrt(factorial(3)*factorial(2)))
+
+def test_gram_permanent():
+    rng = np.random.default_rng(3)
+    for n in range(1, 7):
+        M = rng.normal(size=(n, n)) + 1j*rng.normal(size=(n, n))
+        V = rng.normal(size=(n, 2)) + 1j*rng.normal(size=(n, 2))
+        V /= np.linalg.norm(V, axis=1)[:, None]
+        S = V.conj() @ V.T
+        terms = {tau: np.prod(S[np.arange(n), tau]) * brute(M[list(tau)] * M.conj()) for tau in permutations(range(n))}
+        assert np.isclose(gram_permanent(M, S), sum(terms.values()))
+        assert np.isclose(gram_permanent(M, np.ones((n, n))), abs(brute(M))**2)
+        assert np.isclose(gram_permanent(M, np.eye(n)), brute(abs(M)**2))
+        for order in range(n):
+            assert len(moves(n, order)) == num_moves(n, order)
+            # the exact sum is taken when it is cheaper than the truncation
+            exact = num_moves(n, order) >= 2**(n - 1)
+            ref = sum(t for tau, t in terms.items() if exact or sum(np.array(tau) != np.arange(n)) <= order)
+            assert np.isclose(gram_permanent(M, S, order, chunk=4), ref)
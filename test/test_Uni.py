@@ -1,11 +1,12 @@
-from qpyc.Unitary import nnperm, samp, s2p, p2s
-from qpyc.Unitary import square_decomposition_right
+from qpyc.Unitary import nnperm, samp, s2p, p2s, output_distribution, boson_sampling, partial_distribution, partial_samp
+from qpyc.Unitary import square_decomposition_right, square_decomposition_right_batch, Interferometer
 from scipy.stats import unitary_group
 
 
 
 import numpy as np
 from math import factorial
+import pytest
 
 x = [1, 2, 0, 0]
 y = [1, 1, 1, 0]
@@ -24,6 +25,107 @@ def test_decom():
     # uni = np.eye(6)
     print(square_decomposition_right(uni))
 
+def test_output_distribution():
+    U = unitary_group.rvs(5, random_state=3)
+    for x in ([1, 1, 1, 0, 0], [2, 0, 1, 0, 1], [0, 3, 0, 0, 0], [0]*5):
+        states, probs = output_distribution(U, x)
+        assert len(states) == len({tuple(s) for s in states.tolist()})
+        assert np.isclose(probs.sum(), 1)
+        for y, p in zip(states.tolist(), probs):
+            assert np.isclose(p, abs(samp(U, x, y))**2)
+        blocks = list(output_distribution(U, x, stream=True, chunk=7))
+        assert np.allclose(np.concatenate([p for _, p in blocks]), probs)
+        assert np.array_equal(np.concatenate([s for s, _ in blocks]), states)
+
+def test_boson_sampling():
+    U = unitary_group.rvs(4, random_state=4)
+    x = [1, 1, 0, 1]
+    samples = boson_sampling(U, x, size=4000, seed=1, chunk=500)
+    assert samples.shape == (4000, 4) and np.all(samples.sum(axis=1) == 3)
+    assert np.array_equal(boson_sampling(U, x, size=1000, seed=1, chunk=500, processes=2), samples[:1000])
+    states, probs = output_distribution(U, x)
+    freq = np.array([np.all(samples == s, axis=1).mean() for s in states])
+    assert np.abs(freq - probs).max() < .03
+    assert np.all(boson_sampling(U, [0]*4, size=3) == 0)
+
+def test_decom_batch():
+    Us = unitary_group.rvs(5, size=4, random_state=5)
+    BS, phases = square_decomposition_right_batch(Us)
+    assert BS.shape == (4, 10, 4) and phases.shape == (4, 5)
+    for U, bs, ph in zip(Us, BS, phases):
+        BS_list, output_phases = square_decomposition_right(U)
+        assert np.allclose(np.array(BS_list), bs) and np.allclose(output_phases, ph)
+        I = Interferometer()
+        for b in BS_list:
+            I.add_BS(b)
+        for m, p in enumerate(output_phases):
+            I.add_phase([m+1, p])
+        assert np.allclose(I.unitary_transformation_right(), U)
+
+def test_interferometer():
+    Us = unitary_group.rvs(6, size=50, random_state=6)
+    BS, phases = square_decomposition_right_batch(Us)
+    I = Interferometer.from_decomposition(BS[0], phases[0])
+    assert len(I) == 15 and I.n_modes() == 6
+    assert np.allclose(I.unitary_transformation_right(BS[:, :, 2], BS[:, :, 3], phases), Us)
+    L = Interferometer(ext='left')
+    for b in I.BS_list:
+        L.BS_list.append(b)
+    assert L.BS_list == I.BS_list and L.theta.shape == (15,) and L.modes.shape == (15, 2)
+    L.add_phase([2, .3])
+    T = np.eye(6, dtype=complex)
+    for m1, m2, t, p in L.BS_list:
+        G = np.eye(6, dtype=complex)
+        G[np.ix_([m1-1, m2-1], [m1-1, m2-1])] = [[np.exp(1j*p)*np.sin(t), np.exp(1j*p)*np.cos(t)], [np.cos(t), -np.sin(t)]]
+        T = G @ T
+    D = np.diag(np.exp(1j*np.array([0, .3, 0, 0, 0, 0])))
+    assert np.allclose(L.unitary_transformation(), D @ T)
+    L.output_phases = [0, .3, 0, 0, 0, .1]
+    L.output_phases[0] = .2
+    D = np.diag(np.exp(1j*np.array([.2, .3, 0, 0, 0, .1])))
+    assert np.allclose(L.unitary_transformation(), D @ T)
+    # the beam splitters are changed through BS_list or the arrays
+    L.BS_list[0] = (1, 2, .1, .2)
+    L.theta[1] = .3
+    del L.BS_list[-1]
+    assert len(L) == 14 and L.BS_list[:2] == [(1, 2, .1, .2), I.BS_list[1][:2] + (.3, I.phi[1])]
+    with pytest.raises(TypeError):
+        L.BS_list[0][2] = 0
+    L.BS_list = I.BS_list[:3]
+    assert len(L) == 3 and L.theta.shape == (3,) and np.array_equal(L.phi, I.phi[:3])
+
+def test_partial_distribution():
+    U = unitary_group.rvs(5, random_state=7)
+    rng = np.random.default_rng(7)
+    for x in ([1, 1, 1, 0, 0], [2, 0, 1, 0, 0], [0, 3, 0, 0, 1]):
+        n = sum(x)
+        states, ideal = output_distribution(U, x)
+        out, probs = partial_distribution(U, x, np.ones((n, n)))
+        assert np.array_equal(out, states) and np.allclose(probs, ideal)
+        V = rng.normal(size=(n, 2)) + 1j*rng.normal(size=(n, 2))
+        V /= np.linalg.norm(V, axis=1)[:, None]
+        _, probs = partial_distribution(U, x, V.conj() @ V.T)
+        assert np.isclose(probs.sum(), 1) and np.all(probs > -1e-12)
+        _, probs = partial_distribution(U, x, np.eye(n), outputs=states[:3])
+        assert np.allclose(probs, [partial_samp(U, x, y, np.eye(n)) for y in states[:3]])
+    S = 0.1 + 0.9*np.eye(4)
+    exact = partial_distribution(U, [1, 1, 1, 1, 0], S)[1]
+    assert np.abs(partial_distribution(U, [1, 1, 1, 1, 0], S, order=2)[1] - exact).max() < 1e-2
+
+def test_output_distribution_memory():
+    import tracemalloc
+    def peak(N, chunk):
+        U = unitary_group.rvs(N, random_state=N)
+        tracemalloc.start()
+        total = sum(p.sum() for _, p in output_distribution(U, [1, 1, 1] + [0]*(N-3), stream=True, chunk=chunk))
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert np.isclose(total, 1)
+        return size
+    # 364 and 19600 outputs, the whole result of N = 48 takes about 1.1 MB
+    assert peak(48, 64) < 4 * peak(12, 64)
+    assert peak(48, 64) < 2e5 < peak(48, 1 << 12)
+
 if __name__ == '__main__':
     # test_perm()
-    test_decom()
\ No newline at end of file
+    test_decom()
@@ -0,0 +1,11 @@
+import sys
+import subprocess
+
+def test_import():
+    # heavy dependencies are only imported by the features using them
+    code = ('import sys; '
+            'import qpyc, qpyc.Device, qpyc.Engine, qpyc.Array, qpyc.Mesh, qpyc.Unitary, '
+            'qpyc.Permanent, qpyc.Fock, qpyc.Cali, qpyc.Visualize; '
+            'print(*[m for m in ("jax", "matplotlib", "scipy") if m in sys.modules])')
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert out.split() == []